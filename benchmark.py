@@ -0,0 +1,1812 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo de benchmarks do servidor de arquivos
+
+Cada função de benchmark monta os consoles necessários dentro do próprio
+processo e retorna um dicionário com os resultados medidos.
+
+A suíte (``suite``) executa as cargas de ``SUITE``, cada uma em um processo
+novo, e grava os resultados em JSON (vazão, latências p50 e p99 e pico de
+memória), para comparar versões do servidor.
+
+Example:
+    $ python3 benchmark.py messages
+    $ python3 benchmark.py suite resultado.json
+
+"""
+
+from console import Console, CODECS, KEY_FILES, import_key
+from client import Client, ClientPool
+from host import Host, AsyncHost, MultiHost
+from sessions import SessionRegistry, SHARDS
+from metadata import MetadataStore
+from journal import UserJournal, read_users, write_users
+from Crypto.PublicKey import RSA
+import host
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import platform
+import random
+import subprocess
+import selectors
+import socket
+import sys
+import time
+import tempfile
+import threading
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def console_pair(**kwargs):
+    """Cria um par de consoles conectados e com as chaves públicas trocadas
+
+    Kwargs:
+        repassados aos construtores dos dois consoles
+
+    Returns:
+        (tuple) console do servidor e console do cliente
+    """
+    a, b = socket.socketpair()
+    tmp = tempfile.mkdtemp()
+    # arquivos inexistentes fazem com que start_key gere novas chaves
+    server = Console(sock = a, key_file = os.path.join(tmp, 'server'),
+                     **kwargs)
+    client = Console(sock = b, key_file = os.path.join(tmp, 'client'),
+                     **kwargs)
+    server_pub, client_pub = server.publickey, client.publickey
+    server.publickey = RSA.importKey(client_pub)
+    client.publickey = RSA.importKey(server_pub)
+    return server, client
+
+
+def bench_messages(session = True, n = 1000, msg = "show"):
+    """Mede quantas mensagens por segundo passam por ``send``/``receive``
+
+    Args:
+        session (bool): True para usar o modo de sessão AES-GCM, False para
+            usar RSA a cada mensagem
+        n (int): quantidade de mensagens enviadas
+        msg (str): mensagem enviada
+
+    Returns:
+        (dict) modo, quantidade de mensagens e mensagens por segundo
+    """
+    server, client = console_pair()
+    server.offer_session(session)
+    client.accept_session()
+    start = time.perf_counter()
+    for i in range(n):
+        client.send(msg)
+        server.receive()
+    elapsed = time.perf_counter() - start
+    server.sock.close()
+    client.sock.close()
+    return {'mode': 'session' if session else 'rsa', 'messages': n,
+            'msg_per_s': n / elapsed}
+
+
+def bench_transfer(size, stream = True, chunk_size = 256 * 1024, window = 0,
+                   encrypt_files = True):
+    """Mede a taxa de ``send_file``/``receive_file`` no modo de sessão
+
+    Args:
+        size (int): tamanho do arquivo transferido, em bytes
+        stream (bool): True para o modo de streaming, False para 'ack' a cada
+            segmento de 1024 bytes
+        chunk_size (int): tamanho dos segmentos no modo de streaming
+        window (int): janela de créditos, 0 para desativar
+        encrypt_files (bool): False para o envio sem cópias com ``sendfile``
+
+    Returns:
+        (dict) parâmetros da transferência e taxa alcançada em MB/s
+    """
+    tmp = tempfile.mkdtemp()
+    src, dst = os.path.join(tmp, 'src'), os.path.join(tmp, 'dst')
+    with open(src, 'wb') as file:
+        file.write(os.urandom(size))
+    server, client = console_pair(chunk_size = chunk_size, window = window,
+                                  encrypt_files = encrypt_files)
+    server.offer_session(True)
+    client.accept_session()
+    receiver = threading.Thread(target = lambda: list(
+            server.receive_file(dst)))
+    receiver.start()
+    for p in client.send_file(src, stream):
+        pass
+    receiver.join()
+    server.sock.close()
+    client.sock.close()
+    return {'stream': stream, 'chunk_size': chunk_size if stream else 1024,
+            'window': window, 'encrypt_files': encrypt_files, 'bytes': size,
+            'mb_per_s': p.rate}
+
+
+def start_host(cls = Host, **kwargs):
+    """Inicia um servidor em uma porta livre e em um diretório temporário
+
+    Args:
+        cls (type): Host ou AsyncHost
+
+    Kwargs:
+        repassados ao construtor do servidor
+
+    Returns:
+        (Host) servidor em execução; a porta está em ``server.port``
+    """
+    tmp = tempfile.mkdtemp()
+    server = cls(port = 0, root = os.path.join(tmp, 'root'),
+                 key_file = os.path.join(tmp, 'host.key'),
+                 file_usr = os.path.join(tmp, 'usr.txt'), **kwargs)
+    server.port = server.sock.getsockname()[1]
+    server.tmp = tmp
+    server.start()
+    # Aguarda o servidor entrar no modo de escuta
+    for i in range(100):
+        try:
+            socket.create_connection(('localhost', server.port)).close()
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+        else:
+            break
+    return server
+
+
+def stop_host(server):
+    """Finaliza um servidor iniciado por ``start_host``"""
+    server.stop(file_usr = os.path.join(server.tmp, 'usr.txt'),
+                file_config = os.path.join(server.tmp, 'host.txt'))
+
+
+CLIENT_KEYS = []
+
+
+def client_keys():
+    """Gera uma única vez o par de chaves usado pelos clientes simulados
+
+    Importar a chave a cada cliente custaria mais que o próprio handshake.
+
+    Returns:
+        (tuple) chave privada e inicializador da chave pública
+    """
+    if not CLIENT_KEYS:
+        key_file = os.path.join(tempfile.gettempdir(), 'tcpy_bench.key')
+        if not os.path.exists(key_file):
+            with open(key_file, 'wb') as file:
+                file.write(RSA.generate(1024).exportKey())
+        CLIENT_KEYS.extend(Console.start_key(key_file))
+    return tuple(CLIENT_KEYS)
+
+
+def open_session(port, usr, psw = 'bench', **kwargs):
+    """Conecta um cliente simulado e cadastra o usuário ``usr``
+
+    Args:
+        port (int): porta do servidor
+        usr (str): nome de usuário a ser cadastrado
+        psw (str): senha do usuário
+
+    Kwargs:
+        repassados ao construtor do ``Client``
+
+    Returns:
+        (Client) cliente conectado e autenticado
+    """
+    client = Client(host_port = port, key_file = '', **kwargs)
+    client.privatekey, client.publickey = client_keys()
+    # Uma conexão perdida pelo servidor deve falhar em vez de travar a medição
+    client.sock.settimeout(60)
+    for i in range(50):
+        try:
+            client.sock.connect(client.peer)
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+        else:
+            break
+    client.handshake()
+    client.receive()
+    client.send('signup {0} {1}'.format(usr, psw))
+    client.receive()
+    client.send('ack')
+    client.receive()
+    client.usr = usr
+    return client
+
+
+def login_session(port, usr, psw = 'bench', **kwargs):
+    """Conecta um cliente simulado e entra como um usuário já cadastrado
+
+    Args:
+        port (int): porta do servidor
+        usr (str): nome de usuário
+        psw (str): senha do usuário
+
+    Kwargs:
+        repassados ao construtor do ``Client``
+
+    Returns:
+        (Client) cliente conectado; ``usr`` continua 'guest' se o servidor
+            recusar o login
+    """
+    client = Client(host_port = port, key_file = '', **kwargs)
+    client.privatekey, client.publickey = client_keys()
+    client.sock.settimeout(60)
+    client.sock.connect(client.peer)
+    client.handshake()
+    client.receive()
+    client.send('login {0} {1}'.format(usr, psw))
+    if client.receive() == '1':
+        client.usr = usr
+    return client
+
+
+def close_session(client):
+    """Encerra a sessão de um cliente simulado"""
+    client.send('sair')
+    client.sock.close()
+
+
+def bench_sessions(cls = Host, sessions = 500, commands = 20, threads = 16,
+                   **kwargs):
+    """Mantém ``sessions`` clientes conectados e mede comandos por segundo
+
+    Todos os clientes são conectados antes da medição, de modo que o servidor
+    precisa sustentar as sessões ociosas enquanto atende os comandos.
+
+    Args:
+        cls (type): Host, AsyncHost ou MultiHost
+        sessions (int): quantidade de sessões simultâneas
+        commands (int): quantidade de comandos 'show' por sessão
+        threads (int): threads usadas pelos clientes simulados
+
+    Kwargs:
+        repassados ao construtor do servidor
+
+    Returns:
+        (dict) sessões, tempo de conexão, threads ativas e comandos por
+            segundo
+    """
+    client_keys()
+    kwargs.setdefault('max_sessions', sessions)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(cls, **kwargs)
+        prefix = cls.__name__ + str(server.port)
+        pool = concurrent.futures.ThreadPoolExecutor(threads)
+        start = time.perf_counter()
+        clients = list(pool.map(lambda i: open_session(
+                server.port, prefix + '_' + str(i)), range(sessions)))
+        connect = time.perf_counter() - start
+        active = threading.active_count()
+
+        def run(client):
+            for i in range(commands):
+                client.send('show')
+                client.receive()
+
+        start = time.perf_counter()
+        list(pool.map(run, clients))
+        elapsed = time.perf_counter() - start
+        list(pool.map(close_session, clients))
+        pool.shutdown()
+        stop_host(server)
+    return {'host': cls.__name__, 'sessions': sessions,
+            'connect_s': connect, 'threads': active,
+            'cmd_per_s': sessions * commands / elapsed}
+
+
+def percentile(values, p):
+    """Percentil ``p`` (0 a 100) de uma lista de valores"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_storm(cls = Host, clients = 10000, inflight = 4000, timeout = 60,
+                **kwargs):
+    """Mede a latência de estabelecimento de conexão sob uma rajada
+
+    Todas as conexões são abertas sem bloqueio a partir de uma única thread,
+    mantendo até ``inflight`` conexões pendentes ao mesmo tempo (o limite
+    evita estourar a quantidade de descritores do processo, já que o servidor
+    roda no mesmo processo). A latência de cada conexão vai do ``connect``
+    até a chegada do primeiro byte da chave pública do servidor.
+
+    Args:
+        cls (type): Host ou AsyncHost
+        clients (int): quantidade total de conexões
+        inflight (int): quantidade máxima de conexões pendentes
+        timeout (float): tempo máximo da rajada, em segundos
+
+    Kwargs:
+        repassados ao construtor do servidor
+
+    Returns:
+        (dict) conexões concluídas e falhas, conexões por segundo e
+            latências p50, p99 e máxima em milissegundos
+    """
+    # A rajada mede o estabelecimento das conexões, não a admissão
+    kwargs.setdefault('max_pending', clients)
+    kwargs.setdefault('max_sessions', inflight)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(cls, **kwargs)
+        address = ('localhost', server.port)
+        selector = selectors.DefaultSelector()
+        latencies = []
+        failed = opened = 0
+        start = time.perf_counter()
+        while len(latencies) + failed < clients:
+            if time.perf_counter() - start > timeout:
+                failed = clients - len(latencies)
+                break
+            while opened < clients and opened - len(latencies) - failed \
+                    < inflight:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                sock.connect_ex(address)
+                selector.register(sock, selectors.EVENT_READ,
+                                  time.perf_counter())
+                opened += 1
+            for key, events in selector.select(1):
+                try:
+                    data = key.fileobj.recv(1)
+                except OSError:
+                    data = b''
+                if data:
+                    latencies.append(time.perf_counter() - key.data)
+                else:
+                    failed += 1
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+        elapsed = time.perf_counter() - start
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+        stop_host(server)
+    return {'host': cls.__name__, 'clients': clients,
+            'connected': len(latencies), 'failed': failed,
+            'conn_per_s': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies) * 1000}
+
+
+def bench_metadata(files = 100000, ops = 10000):
+    """Mede o banco de dados de arquivos com um usuário dono de ``files``
+    arquivos
+
+    Os arquivos são criados no formato antigo ``<usuário>.bd`` e importados
+    pela migração. Em seguida são medidas as operações de cada comando.
+
+    Args:
+        files (int): quantidade de arquivos do usuário
+        ops (int): quantidade de operações de cada tipo
+
+    Returns:
+        (dict) tempo da migração, do antigo regravamento do arquivo .bd e da
+            listagem completa, em segundos, e operações por segundo
+    """
+    root = os.path.join(tempfile.mkdtemp(), 'root')
+    os.makedirs(os.path.join(root, 'ana'))
+    os.makedirs(os.path.join(root, 'bruno'))
+    bdfile = os.path.join(root, 'ana', 'ana.bd')
+    names = ['arquivo{0}.txt'.format(i) for i in range(files)]
+    start = time.perf_counter()
+    with open(bdfile, 'w') as file:
+        for name in names:
+            file.write(name + ' ana 2018-05-01 12:00:00.000000\n')
+    # O servidor antigo regravava o arquivo inteiro a cada logout
+    rewrite = time.perf_counter() - start
+    store = MetadataStore(os.path.join(root, '.metadata.db'))
+    start = time.perf_counter()
+    store.migrate(root)
+    migrate = time.perf_counter() - start
+    result = {'files': files, 'migrate_s': migrate, 'legacy_rewrite_s': rewrite}
+    sample = random.sample(names, min(ops, files))
+    timestamp = '2018-05-02 12:00:00.000000'
+    for op, func in (
+            ('lookup', lambda name: store.lookup('ana', name)),
+            ('add', lambda name: store.add('ana', 'novo_' + name, timestamp)),
+            ('share', lambda name: store.share('ana', name, 'bruno')),
+            ('remove', lambda name: store.remove('bruno', name))):
+        start = time.perf_counter()
+        for name in sample:
+            func(name)
+        result[op + '_per_s'] = len(sample) / (time.perf_counter() - start)
+    start = time.perf_counter()
+    listed = sum(1 for entry in store.files('ana'))
+    result['list_s'] = time.perf_counter() - start
+    result['listed'] = listed
+    store.close()
+    return result
+
+
+def bench_users(users = 1000000, signups = 2000, threads = 16, delay = 0.002,
+                binary = True):
+    """Mede a inicialização e os cadastros com ``users`` usuários
+
+    Args:
+        users (int): quantidade de usuários já cadastrados
+        signups (int): quantidade de novos cadastros
+        threads (int): sessões cadastrando ao mesmo tempo
+        delay (float): espera antes de cada ``fsync`` do diário
+        binary (bool): False para o formato antigo dos arquivos, em Base85
+
+    Returns:
+        (dict) tempo de carga dos usuários, da antiga gravação completa no
+            ``stop`` e da compactação, em segundos, e latências dos cadastros
+            em milissegundos
+    """
+    filename = os.path.join(tempfile.mkdtemp(), 'usr.txt')
+    write_users(filename, (('usr{0}'.format(i), 'senha')
+                           for i in range(users)), binary)
+    start = time.perf_counter()
+    usr_dict = Host.load_users(filename)
+    result = {'users': len(usr_dict), 'binary': binary,
+              'load_s': time.perf_counter() - start}
+    start = time.perf_counter()
+    Host.save_users(usr_dict, filename + '.old', binary)
+    result['legacy_save_s'] = time.perf_counter() - start
+    journal = UserJournal(filename, delay = delay, binary = binary)
+
+    def signup(i):
+        start = time.perf_counter()
+        journal.append('novo{0}'.format(i), 'senha')
+        return time.perf_counter() - start
+
+    pool = concurrent.futures.ThreadPoolExecutor(threads)
+    start = time.perf_counter()
+    latencies = list(pool.map(signup, range(signups)))
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    result.update({'signup_per_s': signups / elapsed,
+                   'signup_p50_ms': percentile(latencies, 50) * 1000,
+                   'signup_p99_ms': percentile(latencies, 99) * 1000})
+    start = time.perf_counter()
+    journal.compact()
+    result['compact_s'] = time.perf_counter() - start
+    journal.close()
+    return result
+
+
+def bench_encoding(n = 10000, session = True, size = 64):
+    """Mede a cifragem e a decifragem de mensagens com e sem o Base85
+
+    Args:
+        n (int): quantidade de mensagens
+        session (bool): True para o modo de sessão, False para o RSA
+        size (int): tamanho de cada mensagem, em bytes
+
+    Returns:
+        (dict) microssegundos por mensagem para cifrar e decifrar e bytes
+            cifrados de cada mensagem, no modo Base85 ('a85') e no binário
+    """
+    server, client = console_pair()
+    if session:
+        server.session_key = client.session_key = os.urandom(32)
+    msg = bytes(random.getrandbits(8) for i in range(size))
+    result = {'n': n, 'session': session, 'size': size}
+    for name, binary in (('a85', False), ('binary', True)):
+        server.binary_wire = client.binary_wire = binary
+        start = time.perf_counter()
+        for i in range(n):
+            data = client.encrypt(msg)
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(n):
+            server.decrypt(data)
+        decode = time.perf_counter() - start
+        assert server.decrypt(data) == msg
+        result.update({name + '_encode_us': encode / n * 1e6,
+                       name + '_decode_us': decode / n * 1e6,
+                       name + '_bytes': len(data)})
+    server.sock.close()
+    client.sock.close()
+    return result
+
+
+def bench_users_file(users = 1000000):
+    """Mede a gravação e a leitura do arquivo de usuários nos dois formatos
+
+    Args:
+        users (int): quantidade de usuários
+
+    Returns:
+        (dict) segundos para gravar e ler e tamanho do arquivo, no formato
+            Base85 ('a85') e no binário
+    """
+    filename = os.path.join(tempfile.mkdtemp(), 'usr.txt')
+    pairs = [('usr{0}'.format(i), 'senha{0}'.format(i)) for i in range(users)]
+    result = {'users': users}
+    for name, binary in (('a85', False), ('binary', True)):
+        start = time.perf_counter()
+        write_users(filename, pairs, binary)
+        write = time.perf_counter() - start
+        loaded = dict()
+        start = time.perf_counter()
+        read_users(filename, loaded)
+        read = time.perf_counter() - start
+        assert len(loaded) == users
+        result.update({name + '_write_s': write, name + '_read_s': read,
+                       name + '_bytes': os.path.getsize(filename)})
+        os.remove(filename)
+    return result
+
+
+def bench_listing(files = 10000, repeat = 5, **options):
+    """Mede a latência do ``show`` para um usuário com ``files`` arquivos
+
+    Args:
+        files (int): quantidade de arquivos do usuário
+        repeat (int): quantidade de listagens medidas
+
+    Kwargs:
+        opções do ``show`` (prefixo, ordem, pagina e limite)
+
+    Returns:
+        (dict) arquivos exibidos, latências até o primeiro lote e até o fim
+            da listagem, em milissegundos, e listagens por segundo
+    """
+    client_keys()
+    command = ' '.join(['show'] + ['{0}={1}'.format(key, options[key])
+                                   for key in options])
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        usr = 'lista' + str(server.port)
+        client = open_session(server.port, usr)
+        bdfile = os.path.join(str(server.root), usr, usr + '.bd')
+        with open(bdfile, 'w') as file:
+            for i in range(files):
+                file.write('arquivo{0}.txt {1} 2018-05-01 12:00:{2:02d}\n'
+                           .format(i, usr, i % 60))
+        server.store.migrate(server.root)
+        first, total = [], []
+        for i in range(repeat):
+            start = time.perf_counter()
+            client.send(command)
+            msg = client.receive()
+            first.append(time.perf_counter() - start)
+            shown = 0
+            while not msg.startswith('EOF'):
+                shown += msg.count('\n') + 1
+                msg = client.receive()
+            total.append(time.perf_counter() - start)
+        close_session(client)
+        stop_host(server)
+    return {'files': files, 'command': command, 'shown': shown,
+            'first_batch_ms': percentile(first, 50) * 1000,
+            'total_ms': percentile(total, 50) * 1000,
+            'total_p99_ms': percentile(total, 99) * 1000,
+            'show_per_s': repeat / sum(total)}
+
+
+def post_file(client, filename):
+    """Envia um arquivo por um cliente simulado
+
+    Args:
+        client (Client): cliente conectado
+        filename (str): endereço do arquivo
+
+    Returns:
+        (str) resposta final do servidor
+    """
+    client.send('post ' + filename)
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        client.post(filename)
+    return out.getvalue().strip().split('\n')[-1]
+
+
+def bench_dedup(users = 20, size_mb = 16, unique = 0.1):
+    """Mede o disco ocupado e o tempo de upload com conteúdo repetido
+
+    Cada usuário envia um arquivo de ``size_mb`` MiB em que apenas a fração
+    ``unique`` dos blocos é exclusiva dele; o restante é igual para todos.
+
+    Args:
+        users (int): quantidade de usuários
+        size_mb (int): tamanho de cada arquivo, em MiB
+        unique (float): fração de blocos exclusivos de cada usuário
+
+    Returns:
+        (dict) bytes enviados pelos usuários e ocupados no disco, e tempo do
+            primeiro upload e mediano dos demais, em segundos
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    block = 1024 * 1024
+    shared = os.urandom(size_mb * block)
+    exclusive = int(size_mb * unique)
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        for i in range(users):
+            filename = os.path.join(tmp, 'dados{0}.bin'.format(i))
+            with open(filename, 'wb') as file:
+                file.write(os.urandom(exclusive * block))
+                file.write(shared[exclusive * block:])
+            client = open_session(server.port, 'dedup{0}_{1}'.format(
+                    server.port, i))
+            start = time.perf_counter()
+            post_file(client, filename)
+            times.append(time.perf_counter() - start)
+            close_session(client)
+            os.remove(filename)
+        blocks, disk = server.blobs.usage()
+        stop_host(server)
+    return {'users': users, 'unique': unique,
+            'logical_bytes': users * size_mb * block, 'disk_bytes': disk,
+            'first_upload_s': times[0],
+            'duplicate_upload_s': percentile(times[1:], 50)}
+
+
+def bench_delta(size_mb = 64, change = 'append', amount = 0.01):
+    """Mede o reenvio e o download de um arquivo alterado
+
+    Args:
+        size_mb (int): tamanho do arquivo, em MiB
+        change (str): 'append' para acrescentar dados ao fim do arquivo ou
+            'insert' para inserir trechos em 10 posições ao longo dele
+        amount (float): fração do tamanho do arquivo alterada
+
+    Returns:
+        (dict) bytes transferidos e tempos, em segundos, do primeiro envio,
+            do reenvio por diferença e do download por diferença de uma
+            cópia da versão anterior
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'dump.log')
+    line = b'2018-05-01 12:00:00 registro de exemplo do servidor\n'
+    data = line * (size_mb * 1024 * 1024 // len(line))
+    with open(filename, 'wb') as file:
+        file.write(data)
+    new = os.urandom(int(len(data) * amount))
+    if change == 'append':
+        data += new
+    else:
+        piece = len(new) // 10
+        for i in range(10, 0, -1):
+            at = len(data) * i // 11
+            data = data[:at] + new[(i - 1) * piece:i * piece] + data[at:]
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = tmp
+    os.mkdir(os.path.join(tmp, 'Downloads'))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = start_host(Host)
+            client = open_session(server.port, 'delta{0}'.format(server.port))
+            start = time.perf_counter()
+            post_file(client, filename)
+            full = time.perf_counter() - start
+            client.send('get dump.log')
+            client.get('dump.log')
+            with open(filename, 'wb') as file:
+                file.write(data)
+            start = time.perf_counter()
+            reply = post_file(client, filename)
+            upload = time.perf_counter() - start
+            start = time.perf_counter()
+            client.send('get dump.log')
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                client.get('dump.log')
+            download = time.perf_counter() - start
+            close_session(client)
+            stop_host(server)
+    finally:
+        if home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = home
+    sent = int(reply.split(', ')[-1].split(' ')[0])
+    received = int(out.getvalue().rsplit('(', 1)[-1].split(' ')[0])
+    return {'size': len(data), 'change': change, 'amount': amount,
+            'full_upload_s': full, 'delta_upload_s': upload,
+            'delta_upload_bytes': sent, 'delta_get_s': download,
+            'delta_get_bytes': received}
+
+
+class DelayProxy(object):
+    """Proxy TCP que simula um enlace com latência
+
+    Cada sentido de cada conexão entrega os dados ``delay`` segundos depois
+    de recebê-los e mantém no máximo ``window`` bytes sem confirmação, que só
+    é considerada ``2 * delay`` segundos depois (o tempo de ida e volta),
+    como a janela do TCP. Assim, uma única conexão fica limitada a cerca de
+    ``window / (2 * delay)`` bytes por segundo, como em um enlace de longa
+    distância.
+
+    Attributes:
+        port (int): porta local do proxy
+    """
+    def __init__(self, port, delay = 0.02, window = 1024 * 1024):
+        """Inicia o proxy
+
+        Args:
+            port (int): porta local do servidor
+            delay (float): latência de cada sentido, em segundos
+            window (int): bytes em trânsito por sentido de cada conexão
+        """
+        self.target = ('127.0.0.1', port)
+        self.delay = delay
+        self.window = window
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(socket.SOMAXCONN)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target = self.accept_loop, daemon = True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            for sock in (conn, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.pipe(conn, upstream)
+            self.pipe(upstream, conn)
+
+    def pipe(self, src, dst):
+        """Encaminha um sentido da conexão com atraso
+
+        Args:
+            src (socket.socket): socket de origem
+            dst (socket.socket): socket de destino
+        """
+        delivery = collections.deque()
+        cond = threading.Condition()
+
+        def reader():
+            credits = collections.deque()
+            inflight = 0
+            while True:
+                now = time.perf_counter()
+                while credits and credits[0][0] <= now:
+                    inflight -= credits.popleft()[1]
+                if inflight >= self.window:
+                    time.sleep(credits[0][0] - now)
+                    continue
+                try:
+                    data = src.recv(min(256 * 1024, self.window - inflight))
+                except OSError:
+                    data = b''
+                now = time.perf_counter()
+                credits.append((now + 2 * self.delay, len(data)))
+                inflight += len(data)
+                with cond:
+                    delivery.append((now + self.delay, data))
+                    cond.notify()
+                if not data:
+                    return
+
+        def writer():
+            while True:
+                with cond:
+                    while not delivery:
+                        cond.wait()
+                    due, data = delivery.popleft()
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    if not data:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target = reader, daemon = True).start()
+        threading.Thread(target = writer, daemon = True).start()
+
+    def close(self):
+        self.listener.close()
+
+
+def bench_parallel(size_mb = 1024, streams = 1, delay = 0.02,
+                   window = 1024 * 1024):
+    """Mede a vazão de ``post`` e ``get`` pelos canais de dados
+
+    O cliente conversa com o servidor através de um ``DelayProxy``.
+
+    Args:
+        size_mb (int): tamanho do arquivo, em MiB
+        streams (int): quantidade de canais de dados (1 para não usá-los)
+        delay (float): latência de cada sentido, em segundos
+        window (int): bytes em trânsito por sentido de cada conexão
+
+    Returns:
+        (dict) vazão do upload e do download, em MB/s
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'grande.bin')
+    with open(filename, 'wb') as file:
+        for i in range(size_mb):
+            file.write(os.urandom(1024 * 1024))
+    size = os.path.getsize(filename)
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = tmp
+    os.mkdir(os.path.join(tmp, 'Downloads'))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = start_host(Host)
+            proxy = DelayProxy(server.port, delay, window)
+            client = open_session(proxy.port, 'par{0}'.format(server.port))
+            client.streams = streams
+            start = time.perf_counter()
+            post_file(client, filename)
+            upload = time.perf_counter() - start
+            start = time.perf_counter()
+            client.send('get grande.bin')
+            client.get('grande.bin')
+            download = time.perf_counter() - start
+            client.close_channels()
+            close_session(client)
+            proxy.close()
+            stop_host(server)
+    finally:
+        if home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = home
+    same = Console.manifest(filename) == Console.manifest(os.path.join(
+            tmp, 'Downloads', 'grande.bin'))
+    os.remove(filename)
+    os.remove(os.path.join(tmp, 'Downloads', 'grande.bin'))
+    return {'size': size, 'streams': streams, 'delay': delay,
+            'window': window, 'post_MBps': size / upload / 1e6,
+            'get_MBps': size / download / 1e6, 'verified': same}
+
+
+def bench_compression(size_mb = 64, kind = 'text', compression = 'zlib',
+                      delay = 0):
+    """Mede os bytes na rede e o tempo de ``post`` e ``get`` com compressão
+
+    Args:
+        size_mb (int): tamanho do arquivo, em MiB
+        kind (str): 'text' para um arquivo de log ou 'random' para dados que
+            não se comprimem
+        compression (str): compressor pedido pelo cliente, ou '' para não
+            comprimir
+        delay (float): latência de cada sentido, em segundos, simulada por um
+            ``DelayProxy``; 0 para conectar diretamente
+
+    Returns:
+        (dict) bytes na rede e tempos, em segundos, do upload e do download
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'dados.log')
+    with open(filename, 'wb') as file:
+        for i in range(size_mb):
+            if kind == 'text':
+                file.write(b''.join(
+                        '2018-05-01 12:{0:02d}:{1:02d} GET /arquivos/{2} 200 '
+                        '{3} ms\n'.format(i % 60, j % 60, j, j % 97).encode()
+                        for j in range(24000))[:1024 * 1024])
+            else:
+                file.write(os.urandom(1024 * 1024))
+    size = os.path.getsize(filename)
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = tmp
+    os.mkdir(os.path.join(tmp, 'Downloads'))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = start_host(Host)
+            port = server.port
+            if delay:
+                proxy = DelayProxy(server.port, delay)
+                port = proxy.port
+            client = open_session(port, 'zip{0}'.format(server.port),
+                                  compression = compression)
+            start = time.perf_counter()
+            client.send('post ' + filename)
+            with contextlib.redirect_stdout(io.StringIO()) as up:
+                client.post(filename)
+            upload = time.perf_counter() - start
+            start = time.perf_counter()
+            client.send('get dados.log')
+            with contextlib.redirect_stdout(io.StringIO()) as down:
+                client.get('dados.log')
+            download = time.perf_counter() - start
+            close_session(client)
+            if delay:
+                proxy.close()
+            stop_host(server)
+    finally:
+        if home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = home
+    wire = [int(out.getvalue().rsplit(' pela rede', 1)[0].rsplit(' ', 1)[-1])
+            for out in (up, down)]
+    same = Console.manifest(filename) == Console.manifest(os.path.join(
+            tmp, 'Downloads', 'dados.log'))
+    return {'size': size, 'kind': kind, 'compression': compression or '-',
+            'delay': delay, 'post_wire_bytes': wire[0], 'post_s': upload,
+            'get_wire_bytes': wire[1], 'get_s': download, 'verified': same}
+
+
+def bench_pool(files = 200, size_kb = 16, size = 4, delay = 0.02):
+    """Compara uma conexão por arquivo com o conjunto de sessões do cliente
+
+    Sem o conjunto, cada arquivo exige uma conexão, a troca de chaves e o
+    login, e os arquivos são enviados um de cada vez; com o ``ClientPool``,
+    até ``size`` sessões autenticadas são reaproveitadas e usadas ao mesmo
+    tempo.
+
+    Args:
+        files (int): quantidade de arquivos
+        size_kb (int): tamanho de cada arquivo, em KiB
+        size (int): quantidade de sessões do conjunto
+        delay (float): latência de cada sentido, em segundos, simulada por um
+            ``DelayProxy``; 0 para conectar diretamente
+
+    Returns:
+        (dict) arquivos por segundo no envio e no download, por conexão e
+            pelo conjunto
+    """
+    client_keys()
+    key_file = os.path.join(tempfile.gettempdir(), 'tcpy_bench.key')
+    tmp = tempfile.mkdtemp()
+    source = os.path.join(tmp, 'origem')
+    os.mkdir(source)
+    for i in range(files):
+        with open(os.path.join(source, 'arq{0}.bin'.format(i)), 'wb') as file:
+            file.write(os.urandom(size_kb * 1024))
+    result = {'files': files, 'size_kb': size_kb, 'sessions': size,
+              'delay': delay}
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        port = server.port
+        if delay:
+            proxy = DelayProxy(server.port, delay)
+            port = proxy.port
+        usr = 'pool{0}'.format(server.port)
+        close_session(open_session(port, usr))
+
+        def connect():
+            return login_session(port, usr, quiet = True, downloads =
+                                 os.path.join(tmp, 'conexoes'))
+
+        names = sorted(os.listdir(source))
+        start = time.perf_counter()
+        for name in names:
+            client = connect()
+            client.send('post {0} um/{1}'.format(os.path.join(source, name),
+                                                 name))
+            client.post(os.path.join(source, name), 'um/' + name)
+            close_session(client)
+        result['connection_post_per_s'] = files / (time.perf_counter() -
+                                                   start)
+        start = time.perf_counter()
+        for name in names:
+            client = connect()
+            client.send('get um/' + name)
+            client.get('um/' + name)
+            close_session(client)
+        result['connection_get_per_s'] = files / (time.perf_counter() - start)
+        with ClientPool(usr, 'bench', 'localhost', port, key_file,
+                        size) as pool:
+            start = time.perf_counter()
+            sent = pool.put_tree(source, 'conjunto/')
+            result['pool_post_per_s'] = files / (time.perf_counter() - start)
+            start = time.perf_counter()
+            received = pool.fetch_tree(os.path.join(tmp, 'conjunto'),
+                                       'conjunto/')
+            result['pool_get_per_s'] = files / (time.perf_counter() - start)
+        result['errors'] = sum(isinstance(value, Exception) for value in
+                               list(sent.values()) + list(received.values()))
+        if delay:
+            proxy.close()
+        stop_host(server)
+    return result
+
+
+def bench_pipeline(commands = 200, depth = 32, delay = 0.025):
+    """Mede comandos por segundo em uma conexão com e sem comandos em paralelo
+
+    Os comandos alternam ``share`` e ``show``. Com ``depth`` 0, cada comando
+    aguarda a resposta do anterior (o protocolo sem ids de requisição); caso
+    contrário, são enviados com ``Client.batch``.
+
+    Args:
+        commands (int): quantidade de comandos
+        depth (int): comandos pendentes ao mesmo tempo, 0 para nenhum
+        delay (float): latência de cada sentido, em segundos, simulada por um
+            ``DelayProxy``; 0 para conectar diretamente
+
+    Returns:
+        (dict) comandos por segundo e tempo total, em segundos
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'lista.txt')
+    with open(filename, 'w') as file:
+        file.write('dados')
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        port = server.port
+        if delay:
+            proxy = DelayProxy(server.port, delay)
+            port = proxy.port
+        usr = 'pipe{0}'.format(server.port)
+        close_session(open_session(port, usr + 'b'))
+        client = open_session(port, usr)
+        post_file(client, filename)
+        batch = ['share lista.txt {0}b'.format(usr) if i % 2 else
+                 'show limite=10' for i in range(commands)]
+        start = time.perf_counter()
+        if depth:
+            replies = client.batch(batch, depth)
+        else:
+            replies = []
+            for command in batch:
+                client.send(command)
+                if command.startswith('show'):
+                    replies.append(list(client.entries()))
+                else:
+                    replies.append(client.receive())
+        elapsed = time.perf_counter() - start
+        close_session(client)
+        if delay:
+            proxy.close()
+        stop_host(server)
+    return {'commands': commands, 'depth': depth, 'delay': delay,
+            'commands_per_s': commands / elapsed, 'total_s': elapsed,
+            'replies': len(replies)}
+
+
+def bench_handshake(n = 50, mode = 'resume', delay = 0.025):
+    """Mede o tempo entre a conexão e a resposta do primeiro comando
+
+    Cada medição cria um novo ``Client``, como uma execução curta da linha
+    de comando, conecta, entra como o usuário e envia um ``show``.
+
+    Args:
+        n (int): quantidade de conexões
+        mode (str): 'cold' para gerar a chave do cliente a cada conexão e
+            decodificar as chaves recebidas do zero (o comportamento anterior
+            à persistência das chaves), 'warm' para a chave persistida e as
+            chaves em memória, com troca de chaves e login completos, ou
+            'resume' para retomar a sessão com um bilhete
+        delay (float): latência de cada sentido, em segundos, simulada por um
+            ``DelayProxy``; 0 para conectar diretamente
+
+    Returns:
+        (dict) mediana e percentil 99 da latência, em milissegundos
+    """
+    tmp = tempfile.mkdtemp()
+    key_file = os.path.join(tmp, 'cliente.key')
+    ticket_file = os.path.join(tmp, 'sessao.txt')
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        port = server.port
+        if delay:
+            proxy = DelayProxy(server.port, delay)
+            port = proxy.port
+        usr = 'hs{0}'.format(server.port)
+        client = open_session(port, usr, ticket_file = ticket_file)
+        client.request_ticket()
+        close_session(client)
+        for i in range(n):
+            while host.SESSIONS.online(usr):
+                time.sleep(0.001)
+            if mode == 'cold':
+                KEY_FILES.clear()
+                import_key.cache_clear()
+                if os.path.exists(key_file):
+                    os.remove(key_file)
+            start = time.perf_counter()
+            client = Client(host_port = port, key_file = key_file,
+                            ticket_file = ticket_file if mode == 'resume'
+                            else '')
+            client.sock.connect(client.peer)
+            client.handshake()
+            client.receive()
+            if client.resume_usr is None:
+                client.send('login {0} bench'.format(usr))
+                client.receive()
+            client.send('show')
+            list(client.entries())
+            latencies.append(time.perf_counter() - start)
+            close_session(client)
+        if delay:
+            proxy.close()
+        stop_host(server)
+    return {'mode': mode, 'delay': delay, 'connections': n,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+
+
+def bench_registry(cycles = 20000, threads = 16, users = 64,
+                   shards = SHARDS):
+    """Estresse do registro de sessões com conexões, logins, avisos e logouts
+
+    Cada ciclo conta uma conexão e tenta entrar como um usuário sorteado;
+    com a sessão aberta, avisa outro usuário sorteado, retira os próprios
+    avisos e sai. Ao final, verifica que nenhum usuário teve duas sessões ao
+    mesmo tempo, que todo aviso aceito foi entregue (retirado ou devolvido
+    no logout) e que o registro ficou vazio.
+
+    Args:
+        cycles (int): quantidade de ciclos
+        threads (int): threads executando ciclos ao mesmo tempo
+        users (int): quantidade de usuários sorteados; menos usuários
+            aumentam a disputa pelas mesmas sessões
+        shards (int): quantidade de partes do registro
+
+    Returns:
+        (dict) ciclos por segundo e contadores da verificação
+
+    Raises:
+        AssertionError: se o registro ficar inconsistente
+    """
+    registry = SessionRegistry(shards, limit = None)
+    names = ['usr{0}'.format(i) for i in range(users)]
+    totals = collections.Counter()
+    lock = threading.Lock()
+
+    def work(count):
+        rng = random.Random()
+        counter = collections.Counter()
+        for i in range(count):
+            registry.connect()
+            usr, token = rng.choice(names), object()
+            if registry.login(usr, token):
+                counter['logins'] += 1
+                counter['sent'] += registry.notify(rng.choice(names), usr)
+                counter['received'] += len(registry.notices(usr, token))
+                if registry.session(usr) is not token:
+                    counter['violations'] += 1
+                counter['received'] += len(registry.logout(usr, token))
+            else:
+                counter['refused'] += 1
+            registry.disconnect()
+        with lock:
+            totals.update(counter)
+
+    share = [cycles // threads + (i < cycles % threads)
+             for i in range(threads)]
+    workers = [threading.Thread(target = work, args = (n,)) for n in share]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    assert totals['violations'] == 0, totals
+    assert totals['sent'] == totals['received'], totals
+    assert len(registry) == 0 and registry.connections == 0, registry
+    assert not any(shard.notices for shard in registry.shards)
+    return {'shards': shards, 'threads': threads, 'users': users,
+            'cycles': cycles, 'cycles_per_s': cycles / elapsed,
+            'logins': totals['logins'], 'refused': totals['refused'],
+            'notices': totals['sent']}
+
+
+def latency_stats(latencies, elapsed, size = 0):
+    """Resume as latências de uma fase da suíte
+
+    Args:
+        latencies (list): duração de cada operação, em segundos
+        elapsed (float): duração total da fase, em segundos
+        size (int): bytes transferidos na fase, para a vazão em MB/s
+
+    Returns:
+        (dict) operações, operações por segundo e latências p50 e p99 em
+            milissegundos, além da vazão quando ``size`` for dado
+    """
+    result = {'ops': len(latencies),
+              'ops_per_s': len(latencies) / elapsed if elapsed else None,
+              'p50_ms': None, 'p99_ms': None}
+    if latencies:
+        result['p50_ms'] = percentile(latencies, 50) * 1000
+        result['p99_ms'] = percentile(latencies, 99) * 1000
+    if size:
+        result['mb_per_s'] = size / elapsed / 1e6
+    return result
+
+
+def random_file(filename, size, seed):
+    """Grava um arquivo pseudoaleatório, o mesmo para a mesma semente
+
+    Args:
+        filename (str): endereço do arquivo
+        size (int): tamanho em bytes
+        seed (int): semente do gerador
+    """
+    rng = random.Random(seed)
+    with open(filename, 'wb') as file:
+        while size:
+            n = min(size, 1024 * 1024)
+            file.write(rng.getrandbits(8 * n).to_bytes(n, 'little'))
+            size -= n
+
+
+def wait_logout(timeout = 10):
+    """Aguarda o servidor encerrar as sessões fechadas pelos clientes"""
+    limit = time.perf_counter() + timeout
+    while host.SESSIONS.count() and time.perf_counter() < limit:
+        time.sleep(0.01)
+
+
+def bench_auth(clients = 200, threads = 16):
+    """Rajada de cadastros seguida de uma rajada de logins
+
+    Cada operação vai da conexão até a resposta do servidor, incluindo a
+    troca de chaves, como um cliente novo que acaba de abrir o programa.
+
+    Args:
+        clients (int): quantidade de usuários cadastrados e depois logados
+        threads (int): clientes conectando ao mesmo tempo
+
+    Returns:
+        (dict) vazão e latências dos cadastros e dos logins
+    """
+    client_keys()
+    result = {'clients': clients, 'threads': threads}
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        prefix = 'auth{0}_'.format(server.port)
+
+        def signup(i):
+            start = time.perf_counter()
+            client = open_session(server.port, prefix + str(i))
+            elapsed = time.perf_counter() - start
+            close_session(client)
+            return elapsed
+
+        def login(i):
+            start = time.perf_counter()
+            client = login_session(server.port, prefix + str(i))
+            elapsed = time.perf_counter() - start
+            logged = client.usr != 'guest'
+            close_session(client)
+            return elapsed if logged else None
+
+        pool = concurrent.futures.ThreadPoolExecutor(threads)
+        for phase, function in (('signup', signup), ('login', login)):
+            start = time.perf_counter()
+            latencies = list(pool.map(function, range(clients)))
+            elapsed = time.perf_counter() - start
+            result[phase] = latency_stats([x for x in latencies
+                                           if x is not None], elapsed)
+            result[phase]['failed'] = latencies.count(None)
+            wait_logout()
+        pool.shutdown()
+        stop_host(server)
+    return result
+
+
+def bench_uploads(clients = 16, files = 50, size_kb = 16):
+    """Muitos uploads pequenos de vários clientes ao mesmo tempo
+
+    Cada cliente envia ``files`` arquivos diferentes, em sequência, pela
+    própria sessão.
+
+    Args:
+        clients (int): clientes conectados enviando ao mesmo tempo
+        files (int): arquivos enviados por cliente
+        size_kb (int): tamanho de cada arquivo, em KiB
+
+    Returns:
+        (dict) uploads por segundo, MB/s e latências de cada ``post``
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    size = size_kb * 1024
+    for i in range(clients * files):
+        random_file(os.path.join(tmp, 'peq{0}.bin'.format(i)), size, i)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        sessions = [open_session(server.port, 'up{0}_{1}'.format(
+                server.port, i), quiet = True) for i in range(clients)]
+
+        def run(i):
+            latencies = []
+            for j in range(i * files, (i + 1) * files):
+                filename = os.path.join(tmp, 'peq{0}.bin'.format(j))
+                start = time.perf_counter()
+                sessions[i].send('post ' + filename)
+                sessions[i].post(filename)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        pool = concurrent.futures.ThreadPoolExecutor(clients)
+        start = time.perf_counter()
+        latencies = sum(pool.map(run, range(clients)), [])
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        for client in sessions:
+            close_session(client)
+        stop_host(server)
+    result = {'clients': clients, 'files': files, 'size_kb': size_kb}
+    result.update(latency_stats(latencies, elapsed, size * len(latencies)))
+    return result
+
+
+def bench_pooled(users = 4, files = 50, size_kb = 16, sessions = 4):
+    """Uploads e downloads pela API do ``ClientPool``, de vários usuários
+
+    Cada usuário tem o próprio conjunto de sessões, e todos os arquivos de
+    todos os usuários são enviados com ``put`` e depois baixados com
+    ``fetch`` ao mesmo tempo, exercitando os bilhetes do comando ``canal``, a
+    reutilização das sessões livres e a disputa pelas vagas do conjunto.
+
+    Args:
+        users (int): usuários, cada um com um ``ClientPool``
+        files (int): arquivos enviados e baixados por usuário
+        size_kb (int): tamanho de cada arquivo, em KiB
+        sessions (int): sessões de trabalho de cada conjunto
+
+    Returns:
+        (dict) MB/s e latências dos ``put`` e dos ``fetch``, e se os arquivos
+            baixados conferem com os originais
+    """
+    client_keys()
+    key_file = os.path.join(tempfile.gettempdir(), 'tcpy_bench.key')
+    tmp = tempfile.mkdtemp()
+    size = size_kb * 1024
+    jobs = []
+    for i in range(users):
+        for j in range(i * files, (i + 1) * files):
+            jobs.append((i, os.path.join(tmp, 'pool{0}.bin'.format(j))))
+            random_file(jobs[-1][1], size, j)
+    result = {'users': users, 'files': files, 'size_kb': size_kb,
+              'sessions': sessions}
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host, max_sessions = users * (sessions + 1) + 16)
+        pools = []
+        for i in range(users):
+            usr = 'pool{0}_{1}'.format(server.port, i)
+            close_session(open_session(server.port, usr))
+            pools.append(ClientPool(usr, 'bench', 'localhost', server.port,
+                                    key_file, sessions, downloads =
+                                    os.path.join(tmp, 'baixados', str(i))))
+
+        def put(job):
+            start = time.perf_counter()
+            pools[job[0]].put(job[1])
+            return time.perf_counter() - start
+
+        def fetch(job):
+            start = time.perf_counter()
+            path = pools[job[0]].fetch(os.path.basename(job[1]))
+            return time.perf_counter() - start, path
+
+        executor = concurrent.futures.ThreadPoolExecutor(users * sessions)
+        try:
+            start = time.perf_counter()
+            latencies = list(executor.map(put, jobs))
+            result['put'] = latency_stats(latencies,
+                                          time.perf_counter() - start,
+                                          size * len(jobs))
+            start = time.perf_counter()
+            fetched = list(executor.map(fetch, jobs))
+            result['fetch'] = latency_stats(
+                    [latency for latency, path in fetched],
+                    time.perf_counter() - start, size * len(jobs))
+            result['verified'] = all(
+                    Console.manifest(path) == Console.manifest(job[1])
+                    for job, (latency, path) in zip(jobs, fetched))
+        finally:
+            executor.shutdown()
+            for pool in pools:
+                pool.close()
+            stop_host(server)
+    return result
+
+
+def bench_large(size_mb = 128, repeat = 3):
+    """Upload e download de arquivos grandes por uma sessão
+
+    Cada repetição usa um arquivo diferente e remove a cópia baixada, para
+    que nem a deduplicação nem o download por diferença encurtem a medição.
+
+    Args:
+        size_mb (int): tamanho de cada arquivo, em MiB
+        repeat (int): quantidade de arquivos enviados e baixados
+
+    Returns:
+        (dict) MB/s e latências do upload e do download, e se os arquivos
+            baixados conferem com os originais
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    downloads = os.path.join(tmp, 'Downloads')
+    size = size_mb * 1024 * 1024
+    result = {'size_mb': size_mb, 'repeat': repeat, 'verified': True}
+    uploads, gets = [], []
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host)
+        client = open_session(server.port, 'grande{0}'.format(server.port),
+                              quiet = True, downloads = downloads)
+        for i in range(repeat):
+            name = 'grande{0}.bin'.format(i)
+            filename = os.path.join(tmp, name)
+            random_file(filename, size, i)
+            start = time.perf_counter()
+            client.send('post ' + filename)
+            client.post(filename)
+            uploads.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            client.send('get ' + name)
+            client.get(name)
+            gets.append(time.perf_counter() - start)
+            copy = os.path.join(downloads, name)
+            if Console.manifest(copy) != Console.manifest(filename):
+                result['verified'] = False
+            os.remove(copy)
+            os.remove(filename)
+        close_session(client)
+        stop_host(server)
+    result['upload'] = latency_stats(uploads, sum(uploads), size * repeat)
+    result['download'] = latency_stats(gets, sum(gets), size * repeat)
+    return result
+
+
+def bench_fanout(recipients = 100, size_kb = 1024, threads = 16,
+                 **options):
+    """Um arquivo compartilhado com muitos usuários e baixado por todos
+
+    Args:
+        recipients (int): usuários que recebem o arquivo
+        size_kb (int): tamanho do arquivo, em KiB
+        threads (int): destinatários baixando ao mesmo tempo
+
+    Kwargs:
+        repassados ao construtor do servidor, como as opções do cache
+
+    Returns:
+        (dict) vazão e latências dos ``share`` e dos downloads, e os
+            contadores do cache de arquivos
+    """
+    client_keys()
+    tmp = tempfile.mkdtemp()
+    size = size_kb * 1024
+    filename = os.path.join(tmp, 'popular.bin')
+    random_file(filename, size, 0)
+    result = {'recipients': recipients, 'size_kb': size_kb,
+              'threads': threads}
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = start_host(Host, max_sessions = recipients + 16,
+                            **options)
+        prefix = 'fan{0}_'.format(server.port)
+        owner = open_session(server.port, prefix + 'dono', quiet = True)
+        post_file(owner, filename)
+        pool = concurrent.futures.ThreadPoolExecutor(threads)
+        clients = list(pool.map(lambda i: open_session(
+                server.port, prefix + str(i), quiet = True,
+                downloads = os.path.join(tmp, str(i))), range(recipients)))
+        latencies = []
+        start = time.perf_counter()
+        for client in clients:
+            begin = time.perf_counter()
+            owner.send('share popular.bin ' + client.usr)
+            owner.share('popular.bin', client.usr)
+            latencies.append(time.perf_counter() - begin)
+        result['share'] = latency_stats(latencies,
+                                        time.perf_counter() - start)
+
+        def download(client):
+            start = time.perf_counter()
+            client.send('get popular.bin')
+            client.get('popular.bin')
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = list(pool.map(download, clients))
+        result['download'] = latency_stats(
+                latencies, time.perf_counter() - start, size * recipients)
+        result['cache'] = server.cache.stats()
+        list(pool.map(close_session, clients + [owner]))
+        pool.shutdown()
+        stop_host(server)
+    return result
+
+
+def peak_rss_kb():
+    """Pico de memória residente do processo
+
+    Returns:
+        (int) pico em KiB, ou None onde o módulo ``resource`` não existe
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # No macOS o valor vem em bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def git_commit():
+    """Commit do repositório do servidor, se disponível
+
+    Returns:
+        (str) hash do commit, com '+' se houver alterações não registradas,
+            ou None fora de um repositório git
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = folder,
+                                capture_output = True, check = True,
+                                text = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '-uno'],
+                               cwd = folder, capture_output = True,
+                               check = True, text = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def run_workload(name, quick = False):
+    """Executa uma carga da suíte no processo atual
+
+    Args:
+        name (str): nome da carga em ``SUITE``
+        quick (bool): True para os parâmetros reduzidos
+
+    Returns:
+        (dict) parâmetros, resultados, duração e pico de memória do processo
+    """
+    function, params, small = SUITE[name]
+    params = small if quick else params
+    start = time.perf_counter()
+    result = function(**params)
+    return {'params': params, 'result': result,
+            'elapsed_s': time.perf_counter() - start,
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def run_suite(names = None, quick = False):
+    """Executa as cargas da suíte, cada uma em um processo novo
+
+    O processo novo faz com que o pico de memória de uma carga não inclua o
+    das anteriores e que o estado global do servidor comece sempre vazio.
+
+    Args:
+        names (list): cargas a executar, por padrão todas de ``SUITE``
+        quick (bool): True para os parâmetros reduzidos
+
+    Returns:
+        (dict) ambiente da medição e resultados de cada carga
+    """
+    report = {'timestamp': datetime.datetime.now().isoformat(),
+              'commit': git_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'quick': quick, 'workloads': collections.OrderedDict()}
+    context = multiprocessing.get_context('spawn')
+    for name in names or SUITE:
+        with concurrent.futures.ProcessPoolExecutor(
+                1, mp_context = context) as executor:
+            report['workloads'][name] = executor.submit(
+                    run_workload, name, quick).result()
+    return report
+
+
+def flatten(data, prefix = ''):
+    """Valores numéricos de um relatório, pelo caminho das chaves
+
+    Args:
+        data (dict): relatório ou parte dele
+        prefix (str): caminho até ``data``
+
+    Returns:
+        (dict) valor de cada caminho 'chave.chave...'
+    """
+    values = collections.OrderedDict()
+    for key, value in data.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def messages(n = 1000):
+    """Compara o modo RSA por mensagem com o modo de sessão"""
+    for session in (False, True):
+        print(bench_messages(session, int(n)))
+
+
+def transfer(size_mb = 64):
+    """Compara o envio com 'ack' por segmento com o modo de streaming"""
+    size = int(size_mb) * 1024 * 1024
+    print(bench_transfer(size, stream = False))
+    for chunk_size in (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+        print(bench_transfer(size, True, chunk_size))
+        print(bench_transfer(size, True, chunk_size, window = 8))
+        print(bench_transfer(size, True, chunk_size, encrypt_files = False))
+
+
+def sessions(n = 500, commands = 20):
+    """Compara o Host (uma thread por conexão) com o AsyncHost"""
+    for cls in (Host, AsyncHost):
+        print(bench_sessions(cls, int(n), int(commands)))
+
+
+def processes(n = 500, commands = 20, count = 0):
+    """Compara o Host com o MultiHost de ``count`` processos (0 = núcleos)"""
+    count = int(count) or os.cpu_count()
+    print(bench_sessions(Host, int(n), int(commands)))
+    for engine in ('Host', 'AsyncHost'):
+        print(bench_sessions(MultiHost, int(n), int(commands),
+                             processes = count, engine = engine))
+
+
+def metadata(files = 100000):
+    """Banco de dados de arquivos com um usuário dono de ``files`` arquivos"""
+    print(bench_metadata(int(files)))
+
+
+def users(n = 1000000):
+    """Inicialização e cadastros com ``n`` usuários, com e sem agrupamento"""
+    for delay in (0, 0.002):
+        print(bench_users(int(n), delay = delay))
+
+
+def encoding(n = 10000, users = 1000000):
+    """Codificação das mensagens e do arquivo de usuários, Base85 e binária"""
+    for session in (False, True):
+        for size in (64, 4096):
+            count = int(n) if session else int(n) // 10
+            print(bench_encoding(count, session, size))
+    print(bench_users_file(int(users)))
+
+
+def listing(files = 100000):
+    """Latência do ``show`` conforme o catálogo cresce"""
+    size = 100
+    while size <= int(files):
+        print(bench_listing(size))
+        size *= 10
+    print(bench_listing(size // 10, ordem = 'data', limite = 100, pagina = 5))
+    print(bench_listing(size // 10, prefixo = 'arquivo99'))
+
+
+def dedup(users = 20, size_mb = 16):
+    """Disco e tempo de upload com arquivos repetidos entre usuários"""
+    for unique in (0.0, 0.1, 0.5, 1.0):
+        print(bench_dedup(int(users), int(size_mb), unique))
+
+
+def delta(size_mb = 64):
+    """Reenvio e download por diferença de arquivos de log alterados"""
+    for change in ('append', 'insert'):
+        for amount in (0.001, 0.01, 0.1):
+            print(bench_delta(int(size_mb), change, amount))
+
+
+def parallel(size_mb = 1024, delay = 0.02):
+    """Vazão conforme a quantidade de canais de dados, com latência"""
+    for streams in (1, 2, 4, 8):
+        print(bench_parallel(int(size_mb), streams, float(delay)))
+
+
+def compression(size_mb = 64, delay = 0):
+    """Bytes na rede com e sem compressão, para logs e dados aleatórios"""
+    for kind in ('text', 'random'):
+        for codec in ('',) + tuple(CODECS):
+            print(bench_compression(int(size_mb), kind, codec, float(delay)))
+
+
+def pool(files = 200, size_kb = 16, delay = 0.02):
+    """Muitos arquivos pequenos, uma conexão por arquivo ou um conjunto"""
+    for size in (1, 4, 8):
+        print(bench_pool(int(files), int(size_kb), size, float(delay)))
+
+
+def pipeline(commands = 200, delay = 0.025):
+    """Comandos por segundo em uma conexão conforme os comandos pendentes"""
+    for depth in (0, 1, 8, 32, 64):
+        print(bench_pipeline(int(commands), depth, float(delay)))
+
+
+def handshake(n = 50, delay = 0.025):
+    """Conexão até o primeiro comando: chave gerada, persistida e retomada"""
+    for mode in ('cold', 'warm', 'resume'):
+        print(bench_handshake(int(n), mode, float(delay)))
+
+
+def registry(cycles = 20000, threads = 16):
+    """Estresse do registro de sessões, com uma única parte e dividido"""
+    for users in (16, 1024):
+        for shards in (1, SHARDS):
+            print(bench_registry(int(cycles), int(threads), users, shards))
+
+
+def cache(recipients = 50, size_kb = 1024):
+    """Downloads de um arquivo popular sem cache, com LRU e com ARC"""
+    for options in ({'cache_size': 0}, {'cache_policy': 'lru'},
+                    {'cache_policy': 'arc'},
+                    {'cache_map_size': 0}):
+        result = bench_fanout(int(recipients), int(size_kb), **options)
+        print(options, result['download'], result['cache'])
+
+
+def storm(clients = 10000):
+    """Rajada de conexões contra o Host e o AsyncHost"""
+    for cls in (Host, AsyncHost):
+        print(bench_storm(cls, int(clients)))
+
+
+def suite(output = '-', mode = 'completa'):
+    """Suíte de cargas, em JSON no arquivo ``output`` (``-`` para a tela)
+
+    ``mode`` 'rapida' usa parâmetros reduzidos, para conferir a suíte.
+    """
+    report = run_suite(quick = mode == 'rapida')
+    text = json.dumps(report, indent = 2, ensure_ascii = False)
+    if output == '-':
+        print(text)
+    else:
+        with open(output, 'w', encoding = 'utf-8') as file:
+            file.write(text + '\n')
+        print("Resultados gravados em " + output)
+
+
+def compare(old, new):
+    """Compara dois relatórios da suíte, valor por valor"""
+    reports = []
+    for filename in (old, new):
+        with open(filename, encoding = 'utf-8') as file:
+            report = json.load(file)
+        reports.append(flatten(report['workloads']))
+        print("{0}: {1} ({2})".format(filename, report['commit'],
+                                      report['timestamp']))
+    for key, before in reports[0].items():
+        after = reports[1].get(key)
+        if after is None or '.params.' in key:
+            continue
+        change = (after - before) / before * 100 if before else 0
+        print("{0:<50} {1:>14.2f} {2:>14.2f} {3:>+8.1f}%".format(
+                key, before, after, change))
+
+
+# Cargas da suíte: função, parâmetros e parâmetros reduzidos
+SUITE = collections.OrderedDict([
+    ('auth', (bench_auth, {'clients': 200, 'threads': 16},
+              {'clients': 20, 'threads': 4})),
+    ('small_uploads', (bench_uploads,
+                       {'clients': 16, 'files': 50, 'size_kb': 16},
+                       {'clients': 4, 'files': 10, 'size_kb': 16})),
+    ('pooled_transfers', (bench_pooled,
+                          {'users': 4, 'files': 50, 'size_kb': 16,
+                           'sessions': 4},
+                          {'users': 2, 'files': 10, 'size_kb': 16,
+                           'sessions': 2})),
+    ('large_transfer', (bench_large, {'size_mb': 128, 'repeat': 3},
+                        {'size_mb': 8, 'repeat': 2})),
+    ('catalog', (bench_listing, {'files': 100000, 'repeat': 10},
+                 {'files': 5000, 'repeat': 3})),
+    ('share_fanout', (bench_fanout,
+                      {'recipients': 100, 'size_kb': 1024, 'threads': 16},
+                      {'recipients': 10, 'size_kb': 256, 'threads': 4})),
+])
+
+BENCHMARKS = {'messages': messages, 'transfer': transfer,
+              'sessions': sessions, 'processes': processes, 'storm': storm,
+              'metadata': metadata, 'users': users,
+              'listing': listing, 'dedup': dedup, 'delta': delta,
+              'parallel': parallel, 'compression': compression,
+              'encoding': encoding, 'pool': pool, 'pipeline': pipeline,
+              'handshake': handshake, 'registry': registry,
+              'cache': cache, 'suite': suite, 'compare': compare}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("Uso: benchmark.py <" + '|'.join(BENCHMARKS) + "> [args]")
+    else:
+        BENCHMARKS[sys.argv[1]](*sys.argv[2:])
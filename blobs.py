@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo do armazenamento de blocos do servidor
+
+O conteúdo dos arquivos é guardado em blocos identificados pelo hash SHA-256
+(``<raiz>/.blobs/ab/abcdef...``), de modo que o mesmo conteúdo enviado por
+vários usuários ocupa o disco uma única vez. A lista de blocos de cada
+arquivo e a contagem de referências de cada bloco ficam no banco de dados
+(``MetadataStore``); este módulo cuida apenas dos arquivos dos blocos.
+
+Example:
+    >> blobs = BlobStore('root/.blobs')
+    >> tmp = blobs.temp(digest)
+    >> # ... o conteúdo do bloco é gravado em tmp ...
+    >> blobs.commit(tmp, digest)
+
+"""
+
+import hashlib
+import os
+import pathlib
+import re
+import threading
+
+# Nome padrão do diretório de blocos dentro do diretório raiz do servidor
+BLOBS_DIR = ".blobs"
+
+# Hash SHA-256 em hexadecimal, o único nome aceito para um bloco
+DIGEST = re.compile('[0-9a-f]{64}')
+
+# Tamanho das leituras ao conferir o hash de um bloco recebido
+HASH_CHUNK = 1024 * 1024
+
+
+def valid_digest(digest):
+    """Verifica se um hash recebido pode nomear um bloco
+
+    O hash vira parte do endereço do bloco, então qualquer outro texto
+    poderia apontar para fora do diretório de blocos.
+
+    Args:
+        digest (str): hash hexadecimal do bloco
+
+    Returns:
+        (bool) True se for um SHA-256 em hexadecimal minúsculo
+
+    """
+    return isinstance(digest, str) and DIGEST.fullmatch(digest) is not None
+
+
+class BlobStore(object):
+    """Diretório de blocos endereçados pelo conteúdo
+
+    Attributes:
+        directory (pathlib.Path): diretório dos blocos
+
+    """
+    def __init__(self, directory):
+        """Método construtor do armazenamento
+
+        Args:
+            directory (str): diretório dos blocos, criado caso não exista
+
+        """
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents = True, exist_ok = True)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        """Endereço do arquivo de um bloco
+
+        Args:
+            digest (str): hash hexadecimal do bloco
+
+        Returns:
+            (str) endereço do bloco
+
+        Raises:
+            ValueError: se ``digest`` não for um hash válido
+
+        """
+        self.check(digest)
+        return str(self.directory.joinpath(digest[:2], digest))
+
+    def temp(self, digest):
+        """Endereço temporário e exclusivo para receber um bloco
+
+        Args:
+            digest (str): hash hexadecimal esperado do bloco
+
+        Returns:
+            (str) endereço temporário, no mesmo diretório do bloco
+
+        Raises:
+            ValueError: se ``digest`` não for um hash válido
+
+        """
+        self.check(digest)
+        with self.lock:
+            self.counter += 1
+            n = self.counter
+        folder = self.directory.joinpath(digest[:2])
+        folder.mkdir(exist_ok = True)
+        return str(folder.joinpath('{0}.{1}.{2}.tmp'.format(
+                digest, os.getpid(), n)))
+
+    @staticmethod
+    def check(digest):
+        """Recusa hashes que não podem nomear um bloco (veja ``valid_digest``)
+
+        Args:
+            digest (str): hash hexadecimal do bloco
+
+        Raises:
+            ValueError: se ``digest`` não for um hash válido
+
+        """
+        if not valid_digest(digest):
+            raise ValueError("Hash de bloco inválido: {0!r}".format(digest))
+
+    def scratch(self, name = None):
+        """Endereço temporário para dados que não são um bloco
+
+        Args:
+            name (str): nome fixo, para dados que precisam ser encontrados
+                depois, como os de um envio interrompido. Por padrão, um nome
+                exclusivo
+
+        Returns:
+            (str) endereço temporário, na raiz do diretório de blocos
+
+        """
+        if name is not None:
+            return str(self.directory.joinpath(name + '.tmp'))
+        with self.lock:
+            self.counter += 1
+            n = self.counter
+        return str(self.directory.joinpath('scratch.{0}.{1}.tmp'.format(
+                os.getpid(), n)))
+
+    def commit(self, tmp, digest):
+        """Verifica o hash de um bloco recebido e o coloca no lugar
+
+        Se outra sessão gravou o mesmo bloco ao mesmo tempo, a substituição
+        não tem efeito, pois o conteúdo é o mesmo. O bloco é lido em trechos
+        de ``HASH_CHUNK`` bytes, sem ser carregado inteiro na memória.
+
+        Args:
+            tmp (str): endereço temporário onde o bloco foi gravado
+            digest (str): hash hexadecimal esperado
+
+        Returns:
+            (bool) False se o conteúdo não corresponder ao hash; nesse caso o
+                arquivo temporário é removido
+
+        """
+        actual = hashlib.sha256()
+        with open(tmp, 'rb') as file:
+            for data in iter(lambda: file.read(HASH_CHUNK), b''):
+                actual.update(data)
+        if actual.hexdigest() != digest:
+            self.discard(tmp)
+            return False
+        os.replace(tmp, self.path(digest))
+        return True
+
+    def discard(self, tmp):
+        """Remove um arquivo temporário, se existir
+
+        Args:
+            tmp (str): endereço temporário
+
+        """
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+
+    def remove(self, digest):
+        """Remove o arquivo de um bloco sem referências
+
+        Registros com hashes inválidos, gravados antes da verificação dos
+        manifestos, não têm arquivo no diretório de blocos e são ignorados.
+
+        Args:
+            digest (str): hash hexadecimal do bloco
+
+        """
+        if valid_digest(digest):
+            self.discard(self.path(digest))
+
+    def usage(self):
+        """Espaço ocupado pelos blocos
+
+        Returns:
+            (tuple) quantidade de blocos e total de bytes
+
+        """
+        count = size = 0
+        for path in self.directory.glob('*/*'):
+            if not path.name.endswith('.tmp'):
+                count += 1
+                size += path.stat().st_size
+        return count, size
+
+    def __repr__(self):
+        return "BlobStore({0!r})".format(str(self.directory))
@@ -4,18 +4,52 @@
 
 """
 
-from console import Console
+from console import Console, PartWriter, Progress, BLOCK_SIZE
+from console import CommandRegistry, FLAG_NOTICE
+from blobs import valid_digest
+import delta
+import concurrent.futures
+import hashlib
+import mmap
+import ntpath
 import os
+import queue
+import socket
+import threading
+import time
 import sys
 import pathlib
 
+# Transferências menores que isso não usam os canais de dados
+PARALLEL_MIN = 8 * 1024 * 1024
+
+# Tentativas de concluir uma transferência pelos canais de dados
+PARALLEL_ROUNDS = 3
+
+# Quantidade padrão de sessões do ClientPool
+POOL_SIZE = 4
+
+# Comandos em paralelo enviados por ``Client.batch`` sem aguardar resposta
+PIPELINE_DEPTH = 32
+
+# Segundos de espera por cada resposta de um lote enviado por ``Client.batch``
+BATCH_TIMEOUT = 60
+
+
+class ServerError(Exception):
+    """Recusa ou falha informada pelo servidor em resposta a um comando
+    
+    """
+
+
 class Client(Console):
     """Classe do objeto Cliente
     
     Cliente tcp do servidor de armazenamento de arquivos
     
     Attributes:
-        CMD_DICT (dict): dicionário de comandos do cliente
+        CMD_DICT (CommandRegistry): dicionário de comandos do cliente, com as
+            rotinas que tratam a resposta de cada comando do servidor
     
     Methods:
         pass
@@ -23,10 +57,10 @@ class Client(Console):
     Undocumented:
         receive_key, receive, send
     """
-    CMD_DICT = {}
+    CMD_DICT = CommandRegistry()
     
     def __init__(self, host_ip = "localhost", host_port = 4400,
-                 key_file = ".pvtkey.txt"):
+                 key_file = ".pvtkey.txt", **kwargs):
         """Método construtor do cliente
         
         Inicia um socket em uma porta livre
@@ -35,10 +69,36 @@ class Client(Console):
             host_ip (str): endereço de IP do servidor
             host_port (int): porta do servidor
             key_file (str): arquivo com as informações da cahve
+        
+        Kwargs:
+            chunk_size (int): tamanho dos segmentos enviados pelo ``post``
+            window (int): janela de créditos do ``post``, 0 para desativar
+            streams (int): quantidade de conexões de dados usadas em
+                paralelo nas transferências grandes. Por padrão 1, sem
+                conexões adicionais
+            compression (str): compressores aceitos, em ordem de preferência,
+                ou '' para não comprimir
+            binary (bool): False para não usar o modo binário nas mensagens
+            downloads (str): diretório onde os arquivos baixados são salvos.
+                Por padrão "~/Downloads"
+            quiet (bool): True para não exibir mensagens nem o progresso das
+                transferências, no uso programático
+            ticket_file (str): arquivo onde os bilhetes de retomada de sessão
+                são guardados, um por servidor, ou '' para sempre fazer a
+                troca de chaves completa e o login. Por padrão ''
         """
-        Console.__init__(self, key_file = key_file)
+        Console.__init__(self, key_file = key_file, **kwargs)
         self.peer = (host_ip, host_port)
         self.usr = 'guest'
+        self.streams = int(kwargs.get('streams', 1))
+        self.downloads = kwargs.get('downloads')
+        self.quiet = bool(kwargs.get('quiet', False))
+        self.ticket_file = kwargs.get('ticket_file', '')
+        # Usuário do bilhete aceito pelo servidor na troca de chaves
+        self.resume_usr = None
+        # O servidor indicou que há avisos para o usuário (ver ``notices``)
+        self.noticed = False
+        self.channels = []
     
     def connect(self):
         """Método connect
@@ -56,11 +116,150 @@ class Client(Console):
             print("Erro!\nServidor indisponível.")
         else:
             self.active = True
-            tmp = self.publickey
-            self.publickey = self.receive_key()
-            self.sock.send(tmp)
-            self.run()
+            try:
+                self.handshake()
+            except ConnectionAbortedError as reason:
+                print("Erro!\n" + str(reason))
+                self.sock.close()
+            else:
+                self.run()
+    
+    def handshake(self):
+        """Troca de chaves com o servidor logo após a conexão
+        
+        Recebe a chave pública do servidor, envia a do cliente junto com os
+        recursos aceitos (compressores e modo binário) e, por fim, recebe a
+        chave de sessão, caso o servidor use o modo de sessão, e os recursos
+        escolhidos.
+        
+        Com um bilhete de retomada guardado para este servidor, o bilhete
+        segue junto com a chave e os recursos vão cifrados com a chave do
+        bilhete. Se o servidor aceitar, a nova chave de sessão chega sem o
+        RSA e o usuário entra sem login; um bilhete recusado é descartado.
+        
+        """
+        tmp = self.publickey
+        self.publickey = self.receive_key()
+        saved = self.load_ticket()
+        self.send_key(tmp, features = True, ticket = saved and saved[1])
+        self.session_key = saved[2] if saved else None
+        self.offer_features()
+        resumed = self.accept_session()
+        self.accept_features()
+        if saved and resumed:
+            self.resume_usr = saved[0]
+        elif saved:
+            self.forget_ticket()
+    
+    def tickets(self):
+        """Lê os bilhetes de retomada guardados em ``ticket_file``
+        
+        Returns:
+            (dict) linhas do arquivo, "<usuário> <bilhete> <chave>
+                <validade>", por servidor ("<endereço>:<porta>")
+        
+        """
+        try:
+            with open(self.ticket_file) as file:
+                lines = [line.split(' ', 1) for line in file.read().split('\n')
+                         if line]
+        except FileNotFoundError:
+            return dict()
+        return dict(line for line in lines if len(line) == 2)
+    
+    def write_tickets(self, tickets):
+        """Grava os bilhetes de retomada, legíveis só pelo usuário
+        
+        Args:
+            tickets (dict): linhas de cada servidor, como em ``tickets``
+        
+        """
+        tmp = self.ticket_file + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            file.write(''.join('{0} {1}\n'.format(*item)
+                               for item in tickets.items()))
+        os.replace(tmp, self.ticket_file)
+    
+    def load_ticket(self):
+        """Bilhete de retomada guardado para o servidor desta conexão
+        
+        Returns:
+            (tuple) usuário, bilhete e chave, ou None se não houver um
+                bilhete válido
+        
+        """
+        if not self.ticket_file:
+            return None
+        line = self.tickets().get('{0}:{1}'.format(*self.peer), '').split(' ')
+        if len(line) != 4 or not line[3].isdigit() or int(
+                line[3]) <= time.time():
+            return None
+        try:
+            return line[0], bytes.fromhex(line[1]), bytes.fromhex(line[2])
+        except ValueError:
+            return None
+    
+    def forget_ticket(self):
+        """Descarta o bilhete de retomada do servidor desta conexão
+        
+        """
+        tickets = self.tickets()
+        if tickets.pop('{0}:{1}'.format(*self.peer), None) is not None:
+            self.write_tickets(tickets)
+    
+    def request_ticket(self):
+        """Pede ao servidor um bilhete de retomada e o guarda
         
+        Returns:
+            (str) validade do bilhete, em segundos desde a época
+        
+        Raises:
+            ServerError: se o servidor não emitir bilhetes, por não usar o
+                modo de sessão ou por ser anterior à retomada
+        
+        """
+        self.send('retomada')
+        msg = self.receive().split(' ')
+        if len(msg) != 3 or not msg[2].isdigit():
+            raise ServerError(' '.join(msg))
+        tickets = self.tickets()
+        tickets['{0}:{1}'.format(*self.peer)] = ' '.join([self.usr] + msg)
+        self.write_tickets(tickets)
+        return msg[2]
+        
+    def echo(self, text = '', end = '\n'):
+        """Exibe uma mensagem, a menos que o cliente esteja em silêncio
+        
+        Args:
+            text (str): mensagem
+            end (str): terminação, '' para o progresso das transferências
+        
+        """
+        if not self.quiet:
+            sys.stdout.write(text + end)
+    
+    def target(self, filename):
+        """Endereço local de um arquivo baixado
+        
+        Os subdiretórios do nome são criados dentro do diretório de
+        downloads; componentes que sairiam dele ('..', por exemplo) são
+        descartados.
+        
+        Args:
+            filename (str): nome do arquivo no servidor
+        
+        Returns:
+            (pathlib.Path) endereço do arquivo
+        
+        """
+        parts = [part for part in filename.replace('\\', '/').split('/')
+                 if part not in ('', '.', '..')]
+        p = pathlib.Path(self.downloads or os.path.join(
+                os.path.expanduser("~"), "Downloads")).joinpath(*parts or '_')
+        p.parent.mkdir(parents = True, exist_ok = True)
+        return p
+    
     def run(self):
         """Fluxo de execução do programa do cliente
         
@@ -71,33 +270,223 @@ class Client(Console):
         """
         print("Conexão Estabelecida com " + str(self.peer[0]))
         print("\nDigite 'ajuda' para aprender sobre os comandos disponíveis.")
-        print('\n'+self.receive())
-        while True:
-            msg = input('\n'+self.usr+": ")
-            self.send(msg)
-            cmd = msg.split(' ')
-            if cmd[0] == 'sair':
-                break
-            try:
-                self.__getattribute__(cmd[0])(*cmd[1:])
-                del cmd
-            except AttributeError:
-                print(self.receive())
-            except TypeError:
-                print(self.receive())
+        try:
+            msg = self.receive()
+            print('\n' + msg)
+            if self.resume_usr is not None and msg.endswith(
+                    "Sessão retomada: " + self.resume_usr):
+                self.usr = self.resume_usr
+            while True:
+                msg = input('\n'+self.usr+": ")
+                commands = [part.strip() for part in msg.split(';')
+                            if part.strip()]
+                if len(commands) > 1 and self.pipeline_wire and all(
+                        self.pipelined(command) for command in commands):
+                    self.run_batch(commands)
+                    self.show_notices()
+                    continue
+                self.send(msg)
+                cmd = msg.split(' ')
+                if cmd[0] == 'sair':
+                    break
+                entry = self.CMD_DICT.get(cmd[0])
+                try:
+                    if entry is None:
+                        print(self.receive())
+                    else:
+                        entry.function(self, *cmd[1:])
+                except TypeError:
+                    print(self.receive())
+                except ServerError as error:
+                    print(error)
+                if cmd[0] != 'avisos':
+                    self.show_notices()
+        except ConnectionAbortedError as reason:
+            print("\n" + str(reason))
+        except ConnectionError:
+            print("\nConexão perdida com o servidor.")
+        self.close_channels()
         self.sock.close()
         print("Conexão Encerrada!")
     
-    def show(self):
+    def receive(self):
+        """Recebe uma mensagem, anotando se o servidor indicou avisos
+        
+        Returns:
+            (str) mensagem decifrada
+        
+        """
+        msg = Console.receive(self)
+        if self.frame_flags & FLAG_NOTICE:
+            self.noticed = True
+        return msg
+    
+    def notices(self):
+        """Busca os avisos pendentes do usuário, como os de compartilhamento
+        
+        Returns:
+            (list) avisos, do mais antigo ao mais recente
+        
+        """
+        self.noticed = False
+        self.send('avisos')
         msg = self.receive()
-        while msg != "EOF":
-            print(msg)
-            self.send('ack')
-            msg = self.receive()
+        self.noticed = False
+        return msg.split('\n') if msg else []
+    
+    def show_notices(self):
+        """Exibe os avisos, se o servidor tiver indicado algum
+        
+        """
+        if self.noticed:
+            for msg in self.notices():
+                print("\n[aviso] " + msg)
+    
+    def pipelined(self, command):
+        """Verifica se um comando pode ser enviado em paralelo a outros
+        
+        Args:
+            command (str): comando completo
+        
+        Returns:
+            (bool) True para os comandos registrados com ``pipeline``
+        
+        """
+        entry = self.CMD_DICT.get(command.split(' ')[0])
+        return entry is not None and entry.pipeline
+    
+    def batch(self, commands, depth = PIPELINE_DEPTH, timeout = BATCH_TIMEOUT):
+        """Envia vários comandos sem aguardar a resposta de cada um
+        
+        Cada comando segue com um id de requisição ("#<id> <comando>"); até
+        ``depth`` comandos ficam pendentes ao mesmo tempo, de modo que a
+        latência da rede é paga uma vez por lote, e não por comando. As
+        respostas podem chegar fora de ordem e são agrupadas pelo id. Como o
+        servidor pode executar os comandos ao mesmo tempo, um comando que
+        depende do resultado de outro deve ir em um lote seguinte.
+        
+        Args:
+            commands (list): comandos aceitos em paralelo (ver ``pipelined``)
+            depth (int): quantidade máxima de comandos pendentes
+            timeout (float): segundos de espera por cada resposta, ou None
+                para esperar sempre
+        
+        Returns:
+            (list) mensagens da resposta de cada comando, na ordem de
+                ``commands``
+        
+        Raises:
+            ServerError: se o servidor não aceitar comandos em paralelo
+            ConnectionError: se uma resposta não chegar em ``timeout``
+                segundos; as respostas seguintes chegariam fora de lugar, por
+                isso a conexão não pode continuar
+        
+        """
+        if not self.pipeline_wire:
+            raise ServerError("O servidor não aceita comandos em paralelo")
+        replies = [[] for command in commands]
+        sent = pending = 0
+        previous = self.sock.gettimeout()
+        self.sock.settimeout(timeout)
+        try:
+            while sent < len(commands) or pending:
+                if sent < len(commands) and pending < max(1, depth):
+                    self.send('#{0} {1}'.format(sent, commands[sent]))
+                    sent += 1
+                    pending += 1
+                    continue
+                tag, _, msg = self.receive().partition(' ')
+                replies[int(tag[1:])].append(msg)
+                if tag[0] == '#':
+                    pending -= 1
+        except socket.timeout:
+            raise ConnectionError("O servidor não respondeu ao lote")
+        finally:
+            self.sock.settimeout(previous)
+        return replies
+    
+    def run_batch(self, commands):
+        """Executa um lote de comandos digitados em uma única linha
+        
+        Os comandos são separados por ';' e enviados com ``batch``; as
+        respostas são exibidas na ordem dos comandos.
+        
+        Args:
+            commands (list): comandos aceitos em paralelo
+        
+        """
+        for command, reply in zip(commands, self.batch(commands)):
+            print('\n> ' + command)
+            if command.split(' ')[0] == 'show':
+                try:
+                    self.show(messages = reply)
+                except ServerError as error:
+                    print(error)
+            else:
+                print('\n'.join(reply))
+    
+    @CMD_DICT.command(pipeline = True)
+    def show(self, *options, messages = None):
+        """Rotina de listagem dos arquivos
+        
+        Cada lote de arquivos é exibido assim que chega do servidor.
+        
+        Args:
+            messages (list): resposta já recebida por ``batch``, em vez de
+                recebê-la agora
+        
+        """
+        info = "{0}\nProprietário: {1}, Última atualização: {2}\n"
+        for entry in self.entries(messages):
+            print(info.format(*entry))
+        print("{0} de {1} arquivos exibidos".format(*self.footer))
+    
+    def entries(self, messages = None):
+        """Recebe a listagem enviada pelo servidor em resposta ao ``show``
+        
+        Ao final, ``footer`` guarda a quantidade de arquivos exibidos e o
+        total.
+        
+        Args:
+            messages (list): resposta já recebida por ``batch``, em vez de
+                recebê-la do socket
+        
+        Yields:
+            (tuple) nome, proprietário e data de atualização de cada arquivo
+        
+        Raises:
+            ServerError: se o servidor recusar as opções da listagem
+        
+        """
+        receive = self.receive if messages is None else iter(messages).__next__
+        msg = receive()
+        while not msg.startswith("EOF"):
+            for line in msg.split('\n'):
+                yield tuple(line.split('\t'))
+            msg = receive()
+        footer = msg[4:].split(' ')
+        if len(footer) != 2 or not all(n.isdigit() for n in footer):
+            raise ServerError(msg[4:])
+        self.footer = tuple(int(n) for n in footer)
     
-    def share(self, usr):
-        print(self.receive())
+    @CMD_DICT.command(pipeline = True)
+    def share(self, filename, usr):
+        """Rotina de compartilhamento
+        
+        Returns:
+            (str) confirmação do servidor
         
+        Raises:
+            ServerError: se o usuário ou o arquivo não existirem
+        
+        """
+        msg = self.receive()
+        if msg != filename + " compartilhado com " + usr:
+            raise ServerError(msg)
+        self.echo(msg)
+        return msg
+        
+    @CMD_DICT.command()
     def login(self, usr, psw):
         """Rotina de login
         
@@ -106,9 +495,15 @@ class Client(Console):
         if msg == '1':
             self.usr = usr
             print("Seja bem-vindo, " + usr + ".")
+            if self.ticket_file:
+                try:
+                    self.request_ticket()
+                except ServerError:
+                    pass
         else:
             print(msg)
     
+    @CMD_DICT.command()
     def signup(self, usr, psw):
         """Rotina de cadastro
         
@@ -121,6 +516,7 @@ class Client(Console):
         else:
             print(msg)
     
+    @CMD_DICT.command()
     def ajuda(self):
         """Rotina de recebimento de ajuda
         
@@ -131,30 +527,785 @@ class Client(Console):
             self.send('ok')
             msg = self.receive()
     
-    def post(self, file_address):
+    @CMD_DICT.command()
+    def post(self, file_address, name = None):
         """Método de post de arquivos diretamente no diretório do cliente
         
-        Envia um arquivo através do método 
+        Envia o hash de cada bloco do arquivo e, em seguida, apenas os blocos
+        que o servidor ainda não tem. Se o servidor tiver uma versão anterior
+        do arquivo, esses blocos são comparados com as assinaturas dela e só
+        os trechos que não aparecem na versão anterior são enviados.
+        Se um envio anterior do mesmo conteúdo foi interrompido, o servidor
+        informa quantos bytes já recebeu e o envio continua desse ponto.
+        
+        Args:
+            file_address (str): endereço do arquivo
+            name (str): nome do arquivo no servidor, se diferente
+        
+        Returns:
+            (str) confirmação do servidor
+        
+        Raises:
+            ServerError: se o servidor recusar ou não concluir o envio
         """
         ack = self.receive()
-        size = os.path.getsize(file_address)
-        print("Enviando "+str(size)+" bytes")
-        for b in self.send_file(file_address):
-            sys.stdout.write('\r'+str(b)+" bytes enviados")
+        if ack != 'ack':
+            raise ServerError(ack)
+        size, hashes = self.manifest(file_address)
+        self.send(' '.join([str(size), str(BLOCK_SIZE)] + hashes))
+        reply = self.receive().split(' ')
+        if not reply[0].isdigit():
+            raise ServerError(' '.join(reply))
+        wanted = [int(i) for i in reply[1:]]
+        if wanted:
+            # Sequências de blocos consecutivos formam uma única região
+            regions = []
+            for i in wanted:
+                start = i * BLOCK_SIZE
+                end = min(start + BLOCK_SIZE, size)
+                if regions and regions[-1][1] == start:
+                    regions[-1][1] = end
+                else:
+                    regions.append([start, end])
+            msg = self.receive()
+            if msg == '-':
+                ops = [('l', start, end - start) for start, end in regions]
+            else:
+                sigs = delta.decode_signatures(msg)
+                ops = []
+                with open(file_address, 'rb') as file:
+                    with mmap.mmap(file.fileno(), 0,
+                                   access = mmap.ACCESS_READ) as data:
+                        for start, end in regions:
+                            ops += delta.scan(data, start, end, sigs)
+            self.send(delta.encode_ops(ops))
+            parts = delta.literal_parts(file_address, ops)
+            total = sum(part[2] for part in parts)
+            reply = self.receive()
+            if not reply.isdigit():
+                raise ServerError(reply)
+            offset = int(reply)
+            if offset:
+                self.echo("Retomando o envio a partir do byte " + str(offset))
+                parts = delta.slice_parts(parts, offset, total - offset)
+            self.echo("Enviando " + str(total - offset) + " de " + str(size) +
+                      " bytes")
+            if self.streams > 1 and total - offset >= PARALLEL_MIN:
+                self.post_channels(name or ntpath.basename(file_address),
+                                   parts, offset, total)
+            else:
+                self.send('-')
+                for p in self.send_file(file_address, parts = parts):
+                    self.echo('\r{0} bytes enviados, {1} pela rede '
+                              '({2:.2f} MB/s)'.format(p.done, p.wire, p.rate),
+                              end = '')
+            self.echo()
+        msg = self.receive()
+        if not msg.startswith((name or ntpath.basename(file_address)) +
+                              " salvo"):
+            raise ServerError(msg)
+        self.echo(msg)
+        return msg
+    
+    def post_channels(self, filename, parts, offset, total):
+        """Envia os trechos literais de um ``post`` pelos canais de dados
+        
+        Args:
+            filename (str): nome do arquivo no servidor
+            parts (list): trechos (endereço, início, tamanho) a enviar, a
+                partir de ``offset``
+            offset (int): bytes já recebidos pelo servidor
+            total (int): quantidade de bytes literais do envio
+        
+        """
+        self.send('canais')
+        reply = self.receive().split(' ')
+        
+        def work(channel, start, n, report):
+            channel.send('trecho {0} {1} {2}'.format(filename, offset + start,
+                                                     n))
+            msg = channel.receive()
+            if msg != 'ok':
+                raise ValueError(msg)
+            for p in channel.send_file(None, parts = delta.slice_parts(
+                    parts, start, n)):
+                report(p.done)
+            if channel.receive() != 'ok':
+                raise ValueError("Trecho não confirmado")
+        
+        try:
+            if reply[0] != 'ok':
+                raise ValueError(' '.join(reply))
+            p = self.parallel(reply[1], total - offset, work)
+        except (OSError, ValueError) as reason:
+            self.echo("\nErro nos canais de dados: " + str(reason))
+            self.send('falha')
+        else:
+            self.echo('\r{0} bytes enviados por {1} canais ({2:.2f} MB/s)'
+                      .format(p.done, len(self.channels), p.rate), end = '')
+            self.send('fim')
     
-    def get(self, filename):
+    def data_channels(self, ticket):
+        """Abre as conexões de dados que faltam para chegar a ``streams``
+        
+        Cada canal é um novo cliente, com a mesma chave, que se autentica com
+        o bilhete recebido na sessão principal.
+        
+        Args:
+            ticket (str): bilhete enviado pelo servidor
+        
+        Returns:
+            (list) canais abertos
+        
+        """
+        while len(self.channels) < self.streams:
+            self.channels.append(self.spawn(ticket))
+        return self.channels
+    
+    def spawn(self, ticket, mode = 'dados', **kwargs):
+        """Abre uma nova conexão do mesmo usuário, autenticada com um bilhete
+        
+        A nova conexão usa a mesma chave e as mesmas configurações deste
+        cliente.
+        
+        Args:
+            ticket (str): bilhete enviado pelo servidor
+            mode (str): 'dados' para um canal de dados ou 'sessao' para uma
+                sessão adicional, que aceita os comandos principais
+        
+        Kwargs:
+            configurações da nova conexão diferentes das deste cliente
+        
+        Returns:
+            (Client) conexão aberta
+        
+        Raises:
+            ValueError: se o servidor recusar o bilhete
+        
+        """
+        options = dict(chunk_size = self.chunk_size, window = self.window,
+                       encrypt_files = self.encrypt_files,
+                       compression = ' '.join(self.codecs),
+                       binary = self.binary, downloads = self.downloads,
+                       quiet = self.quiet)
+        options.update(kwargs)
+        channel = Client(self.peer[0], self.peer[1], key_file = '', **options)
+        channel.privatekey = self.privatekey
+        channel.publickey = self.privatekey.publickey().exportKey()
+        try:
+            channel.sock.connect(self.peer)
+            channel.handshake()
+            channel.receive()
+            channel.send('canal {0} {1} {2}'.format(self.usr, ticket, mode))
+            msg = channel.receive()
+        except OSError:
+            channel.sock.close()
+            raise
+        if msg != '1':
+            channel.sock.close()
+            raise ValueError(msg)
+        channel.usr = self.usr
+        return channel
+    
+    def close_channels(self):
+        """Encerra as conexões de dados
+        
+        """
+        for channel in self.channels:
+            try:
+                channel.send('sair')
+            except OSError:
+                pass
+            channel.sock.close()
+        self.channels = []
+    
+    def parallel(self, ticket, size, work):
+        """Divide uma transferência em pedaços distribuídos entre os canais
+        
+        Cada canal retira o próximo pedaço de uma fila, de modo que canais
+        mais rápidos transferem mais pedaços. O pedaço de um canal que falha
+        volta para a fila e o canal é descartado; os pedaços que sobrarem
+        são tentados de novo com novos canais, até ``PARALLEL_ROUNDS`` vezes.
+        
+        Args:
+            ticket (str): bilhete para abrir os canais que faltam
+            size (int): tamanho total da transferência
+            work (callable): função (canal, início, tamanho, relatório) que
+                transfere um pedaço; ``relatório`` recebe os bytes
+                transferidos até o momento no pedaço
+        
+        Returns:
+            (Progress) bytes transferidos e taxa alcançada
+        
+        Raises:
+            ConnectionError: se os canais falharem em todas as tentativas
+        
+        """
+        piece = max(BLOCK_SIZE, -(-size // (self.streams * 4)))
+        pieces = queue.Queue()
+        for start in range(0, size, piece):
+            pieces.put((start, min(piece, size - start)))
+        lock = threading.Lock()
+        done = [0]
+        
+        def worker(channel):
+            while True:
+                try:
+                    start, n = pieces.get_nowait()
+                except queue.Empty:
+                    return
+                last = [0]
+                
+                def report(count):
+                    with lock:
+                        done[0] += count - last[0]
+                    last[0] = count
+                
+                try:
+                    work(channel, start, n, report)
+                except (OSError, ValueError):
+                    with lock:
+                        done[0] -= last[0]
+                    pieces.put((start, n))
+                    self.channels.remove(channel)
+                    channel.sock.close()
+                    return
+        
+        begin = time.perf_counter()
+        for i in range(PARALLEL_ROUNDS):
+            channels = list(self.data_channels(ticket))
+            with concurrent.futures.ThreadPoolExecutor(len(channels)) as pool:
+                list(pool.map(worker, channels))
+            if pieces.empty():
+                break
+        else:
+            raise ConnectionError("Falha nos canais de dados")
+        return Progress(done[0], size, time.perf_counter() - begin)
+    
+    @CMD_DICT.command()
+    def get(self, filename, start = None, length = None):
         """Método de get de arquivos do servidor
         
+        O arquivo é recebido em "<arquivo>.parcial" e só então renomeado. Se
+        a transferência for interrompida, o progresso é guardado em
+        "<arquivo>.parcial.info", e o próximo get do mesmo arquivo continua
+        de onde parou, desde que o arquivo não tenha mudado no servidor.
+        
+        Se já houver uma cópia do arquivo em Downloads, envia as assinaturas
+        dela e recebe apenas os trechos que mudaram.
+        
+        Com ``start``, apenas o intervalo pedido é recebido e gravado na
+        posição correspondente do arquivo em Downloads.
+        
+        Returns:
+            (str) endereço do arquivo salvo
+        
+        Raises:
+            ServerError: se o arquivo não existir ou não puder ser recebido
+        
+        """
+        info = self.receive().split(' ')
+        if not info[0].isdigit():
+            raise ServerError(' '.join(info))
+        p = self.target(filename)
+        size, version = int(info[0]), info[1]
+        if start is not None:
+            start = int(start)
+            n = size - start
+            if length is not None:
+                n = min(int(length), n)
+            for b in self.receive_file(None, [(str(p), start, n)]):
+                self.echo('\r{0} bytes recebidos, {1} pela rede '
+                          '({2:.2f} MB/s)'.format(b.done, b.wire, b.rate),
+                          end = '')
+            self.echo('\nbytes {0} a {1} de {2} salvos em {3}'.format(
+                    start, start + n, filename, p))
+            return str(p)
+        partial = str(p) + '.parcial'
+        state = partial + '.info'
+        offset = 0
+        if os.path.exists(partial) and os.path.exists(state):
+            with open(state, 'r') as file:
+                saved = file.read().split()
+            if saved[:1] == [version]:
+                offset = min(int(saved[1]), size)
+        if not offset and p.is_file():
+            return self.get_delta(p, size)
+        if not offset and self.streams > 1 and size >= PARALLEL_MIN:
+            return self.get_channels(filename, p, size, version)
+        if offset:
+            self.echo("Retomando o download a partir do byte " + str(offset))
+            self.send('retomar ' + str(offset))
+        else:
+            self.send('-')
+            open(partial, 'wb').close()
+        done = 0
+        try:
+            for b in self.receive_file(None,
+                                       [(partial, offset, size - offset)]):
+                done = b.done
+                self.echo('\r{0} bytes recebidos, {1} pela rede '
+                          '({2:.2f} MB/s)'.format(b.done, b.wire, b.rate),
+                          end = '')
+        except (OSError, KeyboardInterrupt):
+            with open(state, 'w') as file:
+                file.write('{0} {1}'.format(version, offset + done))
+            raise
+        os.replace(partial, str(p))
+        if os.path.exists(state):
+            os.remove(state)
+        self.echo('\n'+filename+' salvo em '+str(p))
+        return str(p)
+    
+    def get_channels(self, filename, p, size, version):
+        """Baixa um arquivo em paralelo pelos canais de dados
+        
+        Os intervalos são gravados com escritas posicionadas no arquivo
+        parcial, já reservado com o tamanho final, e o resultado é conferido
+        com o hash de cada bloco antes de ser renomeado.
+        
+        Args:
+            filename (str): nome do arquivo no servidor
+            p (pathlib.Path): destino do arquivo
+            size (int): tamanho do arquivo
+            version (str): versão do arquivo informada pelo servidor
+        
+        Returns:
+            (str) endereço do arquivo salvo
+        
+        Raises:
+            ServerError: se os canais falharem ou o conteúdo divergir
+        
         """
-        p = pathlib.Path(os.path.expanduser("~"))
-        p = p.joinpath("Downloads").joinpath(filename)
-        for b in self.receive_file(str(p)):
-            sys.stdout.write('\r'+str(b)+" bytes recebidos")
-        print(filename+' salvo em '+p)
+        self.send('canais')
+        info = self.receive().split(' ')
+        ticket, block, hashes = info[0], int(info[1]), info[2:]
+        partial = str(p) + '.parcial'
+        with open(partial, 'wb') as file:
+            file.truncate(size)
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(file.fileno(), 0, size)
+        
+        def work(channel, start, n, report):
+            channel.send('get {0} {1} {2}'.format(filename, start, n))
+            reply = channel.receive().split(' ')
+            if reply[1:2] != [version]:
+                raise ValueError("o arquivo mudou durante o download")
+            for b in channel.receive_file(None, [(partial, start, n)]):
+                report(b.done)
+        
+        try:
+            b = self.parallel(ticket, size, work)
+        except (OSError, ValueError) as reason:
+            raise ServerError("Erro nos canais de dados: " + str(reason))
+        if self.manifest(partial, block)[1] != hashes:
+            os.remove(partial)
+            raise ServerError('Erro: ' + filename + ' recebido com conteúdo ' +
+                              'divergente')
+        os.replace(partial, str(p))
+        self.echo('\n{0} salvo em {1} ({2} canais, {3:.2f} MB/s)'.format(
+                filename, p, len(self.channels), b.rate))
+        return str(p)
+    
+    def get_delta(self, p, size):
+        """Atualiza por diferença a cópia de um arquivo em Downloads
+        
+        A nova versão é reconstruída ao lado da cópia e conferida antes de
+        substituí-la.
+        
+        Args:
+            p (pathlib.Path): endereço da cópia
+            size (int): tamanho da nova versão
+        
+        Returns:
+            (str) endereço do arquivo atualizado
+        
+        Raises:
+            ServerError: se a versão reconstruída divergir do servidor
+        
+        """
+        filename = p.name
+        old_parts = [(str(p), 0, p.stat().st_size)]
+        sigs = delta.signatures(old_parts)
+        self.send(delta.encode_signatures(sigs))
+        info = self.receive().split(' ', 1)
+        digest = info[0]
+        if not valid_digest(digest):
+            raise ServerError(' '.join(info))
+        ops = delta.decode_ops(info[1] if len(info) > 1 else '',
+                               len(sigs[2]), size)
+        literals, new = str(p) + '.delta', str(p) + '.novo'
+        done = 0
+        try:
+            for b in self.receive_file(literals):
+                done = b.done
+                self.echo('\r{0} bytes recebidos, {1} pela rede '
+                          '({2:.2f} MB/s)'.format(b.done, b.wire, b.rate),
+                          end = '')
+            open(new, 'wb').close()
+            writer = PartWriter([(new, 0, size)])
+            check = hashlib.sha256()
+            try:
+                delta.apply(ops, old_parts, sigs[0], literals, writer)
+                writer.close()
+                for data in self.read_parts([(new, 0, size)], BLOCK_SIZE):
+                    check.update(data)
+            except (ValueError, EOFError, StopIteration):
+                pass
+            finally:
+                writer.close()
+            if check.hexdigest() != digest:
+                raise ServerError('Erro: ' + filename + ' reconstruído com ' +
+                                  'conteúdo divergente; a cópia anterior foi ' +
+                                  'mantida')
+            os.replace(new, str(p))
+        finally:
+            for tmp in (literals, new):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        self.echo('\n{0} atualizado em {1} ({2} de {3} bytes recebidos)'
+                  .format(filename, p, done, size))
+        return str(p)
 
+    @CMD_DICT.command(pipeline = True)
     def delete(self, file):
-        print(self.receive())
+        """Rotina de exclusão
+        
+        Returns:
+            (str) confirmação do servidor
+        
+        Raises:
+            ServerError: se o arquivo não existir
+        
+        """
+        msg = self.receive()
+        if msg != file + " excluído":
+            raise ServerError(msg)
+        self.echo(msg)
+        return msg
+
+
+class ClientPool(object):
+    """Conjunto de sessões autenticadas para o uso programático do servidor
+    
+    Uma sessão de controle faz o login e emite os bilhetes; os comandos são
+    atendidos por sessões adicionais do mesmo usuário (o modo 'sessao' do
+    comando ``canal``), abertas sob demanda até ``size`` e reaproveitadas
+    entre as chamadas, sem uma nova troca de chaves a cada arquivo. Várias
+    threads podem usar o mesmo conjunto ao mesmo tempo; ``put_tree`` e
+    ``fetch_tree`` transferem uma árvore de diretórios inteira dessa forma.
+    
+    Example:
+        >> with ClientPool('ana', 'senha', 'localhost', 4400) as pool:
+        >>     pool.put('relatorio.pdf')
+        >>     pool.put_tree('fotos', prefix = 'fotos/')
+        >>     print(pool.list(prefixo = 'fotos/'))
+    
+    Attributes:
+        size (int): quantidade máxima de sessões de trabalho
+    
+    """
+    def __init__(self, usr, psw, host_ip = "localhost", host_port = 4400,
+                 key_file = ".pvtkey.txt", size = POOL_SIZE, **kwargs):
+        """Método construtor do conjunto
+        
+        Nenhuma conexão é aberta até o primeiro comando.
+        
+        Args:
+            usr (str): nome de usuário
+            psw (str): senha do usuário
+            host_ip (str): endereço de IP do servidor
+            host_port (int): porta do servidor
+            key_file (str): arquivo com a chave do cliente
+            size (int): quantidade máxima de sessões de trabalho
+        
+        Kwargs:
+            repassados ao construtor de cada ``Client``. Por padrão as sessões
+            são silenciosas (``quiet``)
+        
+        """
+        self.usr, self.psw = usr, psw
+        self.peer = (host_ip, host_port)
+        self.key_file = key_file
+        self.size = int(size)
+        self.options = dict(kwargs)
+        self.options.setdefault('quiet', True)
+        self.control = None
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.size)
+    
+    def login(self):
+        """Abre a sessão de controle e faz o login
+        
+        Raises:
+            ServerError: se o servidor recusar o login
+        
+        """
+        client = Client(self.peer[0], self.peer[1], self.key_file,
+                        **self.options)
+        try:
+            client.sock.connect(self.peer)
+            client.handshake()
+            client.receive()
+            client.send('login {0} {1}'.format(self.usr, self.psw))
+            msg = client.receive()
+        except OSError:
+            client.sock.close()
+            raise
+        if msg != '1':
+            client.sock.close()
+            raise ServerError(msg)
+        client.usr = self.usr
+        self.control = client
+    
+    def open_session(self):
+        """Abre uma nova sessão de trabalho com um bilhete da de controle
         
+        Se a sessão de controle tiver sido encerrada pelo servidor (por
+        inatividade, por exemplo), o login é refeito.
+        
+        Returns:
+            (Client) sessão aberta
+        
+        """
+        with self.lock:
+            for attempt in range(2):
+                if self.control is None:
+                    self.login()
+                try:
+                    self.control.send('canal')
+                    ticket = self.control.receive()
+                    break
+                except ConnectionError:
+                    self.control.sock.close()
+                    self.control = None
+                    if attempt:
+                        raise
+            return self.control.spawn(ticket, 'sessao')
+    
+    def call(self, command, action):
+        """Executa um comando em uma sessão livre
+        
+        Uma sessão encerrada pelo servidor enquanto estava livre é descartada
+        e o comando é repetido em outra, até que uma sessão recém-aberta
+        também falhe. Uma sessão em que o comando falhou no meio do protocolo
+        também é descartada.
+        
+        Args:
+            command (str): comando enviado ao servidor
+            action (callable): função que recebe a sessão e conclui o
+                comando
+        
+        Returns:
+            resultado de ``action``
+        
+        Raises:
+            ServerError: se o servidor recusar o comando
+        
+        """
+        with self.slots:
+            while True:
+                try:
+                    session, fresh = self.idle.get_nowait(), False
+                except queue.Empty:
+                    session, fresh = self.open_session(), True
+                try:
+                    session.send(command)
+                    result = action(session)
+                except ServerError:
+                    self.idle.put(session)
+                    raise
+                except ConnectionError:
+                    session.sock.close()
+                    if fresh:
+                        raise
+                    continue
+                except BaseException:
+                    session.sock.close()
+                    raise
+                self.idle.put(session)
+                return result
+    
+    @staticmethod
+    def check_name(name):
+        """Recusa nomes que o protocolo de comandos não comporta
+        
+        Args:
+            name (str): nome do arquivo no servidor
+        
+        Raises:
+            ValueError: se o nome tiver espaços
+        
+        """
+        if ' ' in name:
+            raise ValueError("Nomes com espaços não são suportados: " + name)
+    
+    def put(self, path, name = None):
+        """Envia um arquivo
+        
+        Args:
+            path (str): endereço do arquivo
+            name (str): nome no servidor, por padrão o nome do arquivo; pode
+                ter subdiretórios separados por '/'
+        
+        Returns:
+            (str) confirmação do servidor
+        
+        """
+        path = os.fspath(path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        name = name or os.path.basename(path)
+        self.check_name(name)
+        # O endereço local não é usado pelo servidor quando o nome é dado
+        return self.call('post - ' + name,
+                         lambda session: session.post(path, name))
+    
+    def fetch(self, name, directory = None):
+        """Baixa um arquivo
+        
+        Args:
+            name (str): nome do arquivo no servidor
+            directory (str): diretório de destino, por padrão o ``downloads``
+                das sessões
+        
+        Returns:
+            (str) endereço do arquivo salvo
+        
+        """
+        self.check_name(name)
+        
+        def action(session):
+            session.downloads = directory or self.options.get('downloads')
+            return session.get(name)
+        
+        return self.call('get ' + name, action)
+    
+    def list(self, **options):
+        """Lista os arquivos disponíveis
+        
+        Kwargs:
+            opções do comando ``show``: prefixo, ordem, pagina e limite
+        
+        Returns:
+            (list) tuplas (nome, proprietário, data de atualização)
+        
+        """
+        command = ' '.join(['show'] + ['{0}={1}'.format(key, value)
+                                       for key, value in options.items()])
+        return self.call(command, lambda session: list(session.entries()))
+    
+    def share(self, name, usr):
+        """Compartilha um arquivo com outro usuário
+        
+        Returns:
+            (str) confirmação do servidor
+        
+        """
+        return self.call('share {0} {1}'.format(name, usr),
+                         lambda session: session.share(name, usr))
+    
+    def delete(self, name):
+        """Exclui um arquivo
+        
+        Returns:
+            (str) confirmação do servidor
+        
+        """
+        return self.call('delete ' + name,
+                         lambda session: session.delete(name))
+    
+    def bulk(self, function, items):
+        """Executa uma operação para cada item, usando todas as sessões
+        
+        Args:
+            function (callable): operação, chamada com os elementos do item
+            items (list): tuplas de argumentos; o último é o nome do arquivo
+        
+        Returns:
+            (dict) resultado de cada arquivo, ou a exceção que o impediu
+        
+        """
+        results = dict()
+        with concurrent.futures.ThreadPoolExecutor(self.size) as executor:
+            futures = [(item[-1], executor.submit(function, *item))
+                       for item in items]
+            for name, future in futures:
+                try:
+                    results[name] = future.result()
+                except (ServerError, OSError, ValueError) as error:
+                    results[name] = error
+        return results
+    
+    def put_tree(self, directory, prefix = ''):
+        """Envia todos os arquivos de uma árvore de diretórios
+        
+        Args:
+            directory (str): raiz da árvore
+            prefix (str): início dos nomes no servidor; os nomes seguem com o
+                caminho relativo à raiz, separado por '/'
+        
+        Returns:
+            (dict) confirmação do servidor para cada nome, ou a exceção que
+                impediu o envio
+        
+        """
+        items = []
+        for root, dirs, names in os.walk(directory):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                items.append((path, prefix + os.path.relpath(
+                        path, directory).replace(os.sep, '/')))
+        return self.bulk(self.put, items)
+    
+    def fetch_tree(self, directory, prefix = ''):
+        """Baixa todos os arquivos cujos nomes começam com ``prefix``
+        
+        Args:
+            directory (str): diretório de destino; cada arquivo é salvo no
+                caminho dado pelo seu nome
+            prefix (str): início dos nomes
+        
+        Returns:
+            (dict) endereço local de cada nome, ou a exceção que impediu o
+                download
+        
+        """
+        names = [entry[0] for entry in self.list(prefixo = prefix)]
+        return self.bulk(lambda name: self.fetch(name, directory),
+                         [(name,) for name in names])
+    
+    def close(self):
+        """Encerra as sessões livres e a de controle
+        
+        """
+        sessions = []
+        while not self.idle.empty():
+            sessions.append(self.idle.get_nowait())
+        with self.lock:
+            if self.control is not None:
+                sessions.append(self.control)
+                self.control = None
+        for session in sessions:
+            try:
+                session.close_channels()
+                session.send('sair')
+            except OSError:
+                pass
+            session.sock.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def __repr__(self):
+        return "ClientPool({0!r}, {1!r}, size = {2})".format(
+                self.usr, self.peer, self.size)
+
 if __name__ == "__main__":
-    cliente = Client()
+    cliente = Client(ticket_file = ".sessao.txt")
     cliente.connect()
\ No newline at end of file
@@ -5,9 +5,347 @@
 """
 
 from Crypto.PublicKey import RSA
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto import Random
+import collections
+import functools
+import hashlib
+import mmap
 import socket
+import struct
+import itertools
+import time
 import os
 import base64
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Tamanhos (em bytes) usados pelo modo de sessão AES-GCM
+SESSION_KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# Maior trecho de texto cifrado em um único bloco RSA-OAEP de 1024 bits
+# (128 bytes menos os 42 do preenchimento com SHA-1)
+RSA_BLOCK = 86
+
+# Tamanho de cada bloco RSA nas mensagens do modo binário
+RSA_LENGTH = struct.Struct('!H')
+
+# Cabeçalho dos frames: tamanho do payload, tipo e flags
+FRAME_HEADER = struct.Struct('!IBB')
+MAX_FRAME = 16 * 1024 * 1024
+
+# Maior mensagem aceita em vários frames marcados com FLAG_MORE
+MAX_MESSAGE = 4 * MAX_FRAME
+
+# Tipos de frame
+FRAME_KEY = 0
+FRAME_MSG = 1
+FRAME_DATA = 2
+FRAME_CLOSE = 3     # encerramento da conexão pelo servidor, com o motivo
+
+# Flags de frame
+FLAG_MORE = 1   # o payload continua no próximo frame
+FLAG_COMPRESSED = 2     # o conteúdo está comprimido com o compressor da conexão
+FLAG_FEATURES = 4   # na chave do cliente: os recursos aceitos vêm em seguida
+FLAG_RESUME = 8     # na chave do cliente: um bilhete de retomada de sessão vem
+                    # junto; na chave de sessão: a retomada foi aceita
+FLAG_NOTICE = 16    # em uma mensagem do servidor: há avisos para o usuário
+
+# Recurso do modo binário, anunciado junto com os compressores
+FEATURE_BINARY = 'binario'
+
+# Recurso dos comandos em paralelo: requisições "#<id> <comando>", cujas
+# respostas chegam marcadas com o mesmo id, possivelmente fora de ordem
+FEATURE_PIPELINE = 'pipeline'
+
+# Quantidade de chaves públicas recebidas mantidas já decodificadas
+PEER_KEY_CACHE = 4096
+
+# Tamanho padrão dos segmentos de arquivo no modo de streaming
+CHUNK_SIZE = 256 * 1024
+
+# Tamanho dos blocos identificados pelo hash no armazenamento do servidor
+BLOCK_SIZE = 1024 * 1024
+
+
+
+def zlib_decompress(data, limit):
+    """Descomprime um trecho do zlib sem passar de ``limit`` bytes
+    
+    Args:
+        data (bytes): trecho comprimido
+        limit (int): tamanho máximo do trecho original
+    
+    Returns:
+        (bytes) trecho original
+    
+    Raises:
+        ValueError: se o trecho for inválido, incompleto ou maior que o limite
+    
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(data, limit + 1)
+    except zlib.error as error:
+        raise ValueError(str(error))
+    if len(data) > limit or not decompressor.eof:
+        raise ValueError("Trecho comprimido inválido ou grande demais")
+    return data
+
+
+def zstd_decompress(data, limit):
+    """Descomprime um trecho do zstd sem passar de ``limit`` bytes
+    
+    O tamanho gravado no cabeçalho do frame não é usado para alocar o
+    resultado, já que vem do outro lado da conexão.
+    
+    Args:
+        data (bytes): trecho comprimido
+        limit (int): tamanho máximo do trecho original
+    
+    Returns:
+        (bytes) trecho original
+    
+    Raises:
+        ValueError: se o trecho for inválido ou maior que o limite
+    
+    """
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            data = reader.read(limit + 1)
+    except zstandard.ZstdError as error:
+        raise ValueError(str(error))
+    if len(data) > limit:
+        raise ValueError("Trecho comprimido grande demais")
+    return data
+
+
+def lz4_decompress(data, limit):
+    """Descomprime um trecho do lz4 sem passar de ``limit`` bytes
+    
+    Args:
+        data (bytes): trecho comprimido
+        limit (int): tamanho máximo do trecho original
+    
+    Returns:
+        (bytes) trecho original
+    
+    Raises:
+        ValueError: se o trecho for inválido, incompleto ou maior que o limite
+    
+    """
+    decompressor = lz4.frame.LZ4FrameDecompressor()
+    try:
+        data = decompressor.decompress(data, max_length = limit + 1)
+    except RuntimeError as error:
+        raise ValueError(str(error))
+    if len(data) > limit or not decompressor.eof:
+        raise ValueError("Trecho comprimido inválido ou grande demais")
+    return data
+
+
+# Compressores disponíveis, em ordem de preferência: funções de compressão e
+# de descompressão, que recebe também o tamanho máximo do resultado. O zlib
+# está sempre disponível; o zstd e o lz4 dependem dos pacotes ``zstandard``
+# e ``lz4``.
+CODECS = collections.OrderedDict()
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(
+                              level = 3).compress(data), zstd_decompress)
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4_decompress)
+CODECS['zlib'] = (lambda data: zlib.compress(data, 1), zlib_decompress)
+
+# Mensagens menores que isso não são comprimidas
+COMPRESS_MIN = 512
+
+# Um arquivo só é comprimido se a amostra do início dele, de até
+# ``COMPRESS_SAMPLE`` bytes, ficar menor que ``COMPRESS_RATIO`` do original
+COMPRESS_SAMPLE = 256 * 1024
+COMPRESS_RATIO = 0.9
+
+
+class Progress(collections.namedtuple('Progress', 'done total elapsed wire',
+                                      defaults = (0,))):
+    """Progresso de uma transferência de arquivo
+    
+    Attributes:
+        done (int): quantidade de bytes transferidos até o momento
+        total (int): tamanho do arquivo
+        elapsed (float): segundos desde o início da transferência
+        wire (int): bytes que passaram pela rede até o momento, já
+            comprimidos e cifrados, incluindo os cabeçalhos dos frames
+    
+    """
+    __slots__ = ()
+    
+    @property
+    def rate(self):
+        """(float) taxa média alcançada em MB/s"""
+        if not self.elapsed:
+            return 0.0
+        return self.done / self.elapsed / 1e6
+
+
+class Command(collections.namedtuple('Command', 'name function pipeline')):
+    """Comando registrado em um ``CommandRegistry``
+    
+    Attributes:
+        name (str): nome do comando no protocolo
+        function (callable): método que atende o comando
+        pipeline (bool): True se o comando pode ser enviado em paralelo a
+            outros, com um id de requisição (``FEATURE_PIPELINE``)
+    
+    """
+    __slots__ = ()
+
+
+class CommandRegistry(collections.OrderedDict):
+    """Tabela explícita dos comandos aceitos por um console
+    
+    Só os métodos registrados podem ser chamados pelo outro lado da conexão.
+    
+    Example:
+        >> class Terminal(Console):
+        >>     COMMANDS = CommandRegistry()
+        >>
+        >>     @COMMANDS.command(pipeline = True)
+        >>     def show(self, *options):
+        >>         ...
+    
+    """
+    def command(self, name = None, pipeline = False):
+        """Decorador que registra um método como comando
+        
+        Args:
+            name (str): nome do comando, por padrão o nome do método
+            pipeline (bool): True se o comando responde sem trocar outras
+                mensagens com o cliente e pode, portanto, ser enviado em
+                paralelo a outros
+        
+        Returns:
+            (callable) decorador, que devolve o método sem alterações
+        
+        """
+        def register(function):
+            key = name or function.__name__
+            self[key] = Command(key, function, pipeline)
+            return function
+        return register
+
+
+@functools.lru_cache(maxsize = PEER_KEY_CACHE)
+def import_key(data):
+    """Decodifica uma chave pública recebida, reaproveitando as já vistas
+    
+    Clientes com chaves persistidas se reconectam com as mesmas chaves, e o
+    cliente recebe sempre a mesma chave do servidor.
+    
+    Args:
+        data (bytes): chave pública exportada
+    
+    Returns:
+        (_RSAobj) chave pública
+    
+    """
+    return RSA.importKey(data)
+
+
+# Chaves privadas já lidas: endereço do arquivo -> (data de modificação,
+# chave privada, chave pública exportada)
+KEY_FILES = dict()
+
+
+def valid_name(name):
+    """Verifica se um nome de arquivo no servidor é seguro
+    
+    Os nomes podem ter subdiretórios separados por '/', como os de uma árvore
+    enviada em lote, mas não podem ser absolutos nem sair do diretório do
+    usuário.
+    
+    Args:
+        name (str): nome do arquivo
+    
+    Returns:
+        (bool) True se o nome for válido
+    
+    """
+    return bool(name) and '\\' not in name and all(
+            part not in ('', '.', '..') for part in name.split('/'))
+
+
+def open_part(filename):
+    """Abre um arquivo para escrita sem truncá-lo, criando-o se necessário
+    
+    Args:
+        filename (str): endereço do arquivo
+    
+    Returns:
+        (file) arquivo aberto no modo 'r+b'
+    
+    """
+    try:
+        return open(filename, 'r+b')
+    except FileNotFoundError:
+        return open(filename, 'w+b')
+
+
+class PartWriter(object):
+    """Grava dados recebidos em sequência em uma lista de trechos de arquivos
+    
+    Attributes:
+        parts (iterator): trechos (endereço, início, tamanho) restantes
+    
+    """
+    def __init__(self, parts):
+        """Método construtor do gravador
+        
+        Args:
+            parts (list): trechos (endereço, início, tamanho) a preencher
+        
+        """
+        self.parts = iter(parts)
+        self.file = None
+        self.left = 0
+    
+    def write(self, data):
+        """Grava os dados, passando ao próximo trecho quando o atual enche
+        
+        Args:
+            data (bytes): dados recebidos
+        
+        """
+        view = memoryview(data)
+        while view:
+            if not self.left:
+                self.close()
+                filename, offset, self.left = next(self.parts)
+                self.file = open_part(filename)
+                self.file.seek(offset)
+                continue
+            n = min(len(view), self.left)
+            self.file.write(view[:n])
+            view = view[n:]
+            self.left -= n
+    
+    def close(self):
+        """Fecha o arquivo do trecho atual
+        
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 
 class Console(object):
@@ -18,6 +356,8 @@ class Console(object):
     Attributes:
         logged (bool): True caso o usuário tenha realizado o login com sucesso,
             False caso contrário
+        session_key (bytes): chave simétrica da sessão AES-GCM, ou None caso
+            a comunicação use RSA a cada mensagem
     
     """
     def __init__(self, **kwargs):
@@ -26,14 +366,46 @@ class Console(object):
         Kwargs:
             sock (socket): socket de comunicação
             key_file (str): arquivo para inicialização de par de chaves
+            chunk_size (int): tamanho dos segmentos de arquivo enviados no modo
+                de streaming, por padrão 256 KiB
+            window (int): quantidade máxima de segmentos enviados sem crédito
+                do receptor, ou 0 para desativar o controle de fluxo
+            encrypt_files (bool): False para não cifrar os arquivos no modo de
+                sessão (por exemplo, quando o TLS é feito fora do processo),
+                permitindo o envio sem cópias com ``sendfile``. Por padrão True
+            compression (str): compressores aceitos, separados por espaço, em
+                ordem de preferência, ou '' para não comprimir. Por padrão
+                todos os de ``CODECS``
+            binary (bool): False para manter as mensagens em Base85 mesmo
+                quando o outro lado aceita o modo binário. Por padrão True
+            pipeline (bool): False para não aceitar comandos em paralelo
+                (``FEATURE_PIPELINE``). Por padrão True
         
         """
-        self.sock = kwargs.get('sock',
-                               socket.socket(socket.AF_INET,
-                                             socket.SOCK_STREAM))
+        self.sock = kwargs.get('sock')
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.sock.family in (socket.AF_INET, socket.AF_INET6):
+            # Mensagens curtas em sequência não devem esperar pelo ACK
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         key_file = kwargs.get('key_file', '')
         if key_file:
             self.privatekey, self.publickey = Console.start_key(key_file)
+        self.session_key = None
+        self.chunk_size = int(kwargs.get('chunk_size', CHUNK_SIZE))
+        self.window = int(kwargs.get('window', 0))
+        self.encrypt_files = kwargs.get('encrypt_files', True)
+        self.codecs = [codec for codec in str(kwargs.get(
+                'compression', ' '.join(CODECS))).split() if codec in CODECS]
+        self.binary = bool(kwargs.get('binary', True))
+        self.pipeline = bool(kwargs.get('pipeline', True))
+        # Compressor, codificação e recursos escolhidos na troca de chaves
+        self.compressor = None
+        self.binary_wire = False
+        self.pipeline_wire = False
+        self.frame_flags = 0
+        self._header = bytearray(FRAME_HEADER.size)
+        self._buffer = bytearray(64 * 1024)
     
     def run(self):
         """Método run difere entre o Console do Host e o do Client
@@ -50,7 +422,9 @@ class Console(object):
         """Método de inicialização das chaves
         
         Esse método inicializa a chave privada e prepara, também, a chave
-        pública para envio.
+        pública para envio. Uma chave gerada é gravada em ``key_file``, de
+        modo que as próximas execuções não precisam gerá-la de novo, e as
+        chaves já lidas ficam em memória enquanto o arquivo não muda.
         
         Args:
             key_file (str): endereço do arquivo da chave privada
@@ -59,16 +433,37 @@ class Console(object):
             (tuple) uma tupla contendo um par _RSAobj (chave privada) e byte 
             (inicializador da chave pública)
         """
+        key_file = os.path.abspath(key_file)
         try:
-            keyfile = open(key_file, 'rb')
+            mtime = os.stat(key_file).st_mtime_ns
         except FileNotFoundError:
             private_key = RSA.generate(1024)
+            try:
+                fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            except FileExistsError:
+                # Outro processo gravou a chave ao mesmo tempo
+                return Console.start_key(key_file)
+            except OSError:
+                # Sem permissão de escrita a chave vale só para esta execução
+                pass
+            else:
+                with os.fdopen(fd, 'wb') as keyfile:
+                    keyfile.write(private_key.exportKey())
+                KEY_FILES[key_file] = (os.stat(key_file).st_mtime_ns,
+                                       private_key,
+                                       private_key.publickey().exportKey())
+                return KEY_FILES[key_file][1:]
         else:
-            private_key = RSA.importKey(keyfile.read())
-            keyfile.close()
-        finally:
-            public_key = private_key.publickey().exportKey()
-            return private_key, public_key
+            cached = KEY_FILES.get(key_file)
+            if cached is not None and cached[0] == mtime:
+                return cached[1:]
+            with open(key_file, 'rb') as keyfile:
+                private_key = RSA.importKey(keyfile.read())
+            KEY_FILES[key_file] = (mtime, private_key,
+                                   private_key.publickey().exportKey())
+            return KEY_FILES[key_file][1:]
+        return private_key, private_key.publickey().exportKey()
     
     def receive_key(self):
         """Troca de chaves no início da comunicação
@@ -81,46 +476,327 @@ class Console(object):
             (_RSAobj) chave pública para criptografia.
         
         """
-        k = self.sock.recv(1024)
-        key = RSA.importKey(k)
+        k = self.recv_frame(FRAME_KEY)
+        key = import_key(bytes(k))
         return key
     
-    def send(self, msg):
+    def send_key(self, key, features = False, ticket = None):
+        """Envia o inicializador de uma chave pública através do socket
+        
+        Args:
+            key (bytes): chave pública exportada
+            features (bool): True para avisar que os recursos aceitos serão
+                enviados em seguida (``offer_features``). O servidor só espera
+                por eles quando o aviso vem na chave, o que mantém
+                compatíveis os clientes anteriores à negociação
+            ticket (bytes): bilhete de retomada de sessão, enviado antes da
+                chave, precedido do tamanho (``FLAG_RESUME``)
+        
+        """
+        flags = FLAG_FEATURES if features else 0
+        if ticket is not None:
+            key = RSA_LENGTH.pack(len(ticket)) + ticket + key
+            flags |= FLAG_RESUME
+        self.send_frame(key, FRAME_KEY, flags)
+    
+    def send_frame(self, payload, kind = FRAME_MSG, flags = 0):
+        """Envia um trecho de bytes delimitado por um cabeçalho de frame
+        
+        Trechos maiores que ``MAX_FRAME`` são divididos em vários frames
+        marcados com ``FLAG_MORE``, até o total de ``MAX_MESSAGE`` bytes
+        aceito por ``recv_frame``.
+        
+        Args:
+            payload (bytes): conteúdo do frame
+            kind (int): tipo do frame (FRAME_KEY, FRAME_MSG ou FRAME_DATA)
+            flags (int): flags do frame
+        
+        """
+        view = memoryview(payload)
+        while True:
+            part, view = view[:MAX_FRAME], view[MAX_FRAME:]
+            more = FLAG_MORE if len(view) else 0
+            header = FRAME_HEADER.pack(len(part), kind, flags | more)
+            if len(part) < 65536:
+                self.sock.sendall(header + part.tobytes())
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(part)
+            if not more:
+                break
+    
+    def recv_frame(self, kind = None):
+        """Recebe um frame completo, independente de como os pacotes chegam
+        
+        O payload é lido com ``recv_into`` em um buffer reutilizável, então o
+        memoryview retornado só é válido até a próxima chamada. Frames acima
+        de ``MAX_FRAME`` bytes e mensagens acima de ``MAX_MESSAGE`` são
+        recusados antes de qualquer alocação.
+        
+        Args:
+            kind (int): tipo de frame esperado, ou None para aceitar qualquer
+                tipo
+        
+        As flags do frame ficam em ``frame_flags``.
+        
+        Returns:
+            (memoryview) payload do frame
+        
+        Raises:
+            ValueError: se o frame recebido não for do tipo esperado
+            ConnectionAbortedError: se o servidor encerrar a conexão com um
+                frame FRAME_CLOSE, tendo o motivo como mensagem
+            ConnectionError: se a conexão for encerrada no meio do frame ou
+                se o frame ou a mensagem passar do tamanho máximo
+        
+        """
+        data = None
+        while True:
+            self.recv_into(memoryview(self._header))
+            length, rkind, flags = FRAME_HEADER.unpack(self._header)
+            # O restante do frame não é lido, então a conexão não tem como
+            # continuar
+            if length > MAX_FRAME:
+                raise ConnectionError("Frame grande demais: " + str(length))
+            if data is not None and len(data) + length > MAX_MESSAGE:
+                raise ConnectionError("Mensagem grande demais")
+            if length > len(self._buffer):
+                self._buffer = bytearray(length)
+            view = memoryview(self._buffer)[:length]
+            self.recv_into(view)
+            if rkind == FRAME_CLOSE:
+                raise ConnectionAbortedError(bytes(view).decode('utf-8'))
+            if kind is not None and rkind != kind:
+                raise ValueError("Frame inesperado: " + str(rkind))
+            if data is None:
+                self.frame_flags = flags & ~FLAG_MORE
+                if not flags & FLAG_MORE:
+                    return view
+                data = bytearray()
+            data += view
+            if not flags & FLAG_MORE:
+                return memoryview(data)
+    
+    @staticmethod
+    def refuse(sock, reason):
+        """Encerra uma conexão informando o motivo ao outro lado
+        
+        O motivo segue em texto simples em um frame FRAME_CLOSE, já que a
+        conexão pode ser recusada antes mesmo da troca de chaves.
+        
+        Args:
+            sock (socket.socket): socket a ser encerrado
+            reason (str): motivo do encerramento
+        
+        """
+        reason = reason.encode('utf-8')
+        try:
+            sock.sendall(FRAME_HEADER.pack(len(reason), FRAME_CLOSE, 0) + reason)
+        except OSError:
+            pass
+        sock.close()
+    
+    def recv_into(self, view):
+        """Preenche todo o memoryview com bytes do socket
+        
+        Args:
+            view (memoryview): região a ser preenchida
+        
+        Raises:
+            ConnectionError: se a conexão for encerrada antes do fim
+        
+        """
+        rcvd = 0
+        while rcvd < len(view):
+            n = self.sock.recv_into(view[rcvd:])
+            if not n:
+                raise ConnectionError("Conexão encerrada")
+            rcvd += n
+    
+    def offer_session(self, session = True, resumed = False):
+        """Envio da chave de sessão, feito pelo servidor após a troca de chaves
+        
+        A chave simétrica é gerada aleatoriamente e enviada uma única vez
+        através do RSA. A partir daí todas as mensagens e segmentos de arquivo
+        são cifrados com AES-GCM. Caso o modo de sessão esteja desativado, o
+        servidor envia '0' e a comunicação continua usando RSA.
+        
+        Na retomada de uma sessão, a chave de sessão já é a chave do bilhete
+        e a nova chave segue cifrada com ela, sem o RSA, em uma mensagem
+        marcada com ``FLAG_RESUME``.
+        
+        Args:
+            session (bool): True para ativar o modo de sessão
+            resumed (bool): True se o bilhete de retomada foi aceito
+        
+        """
+        if session:
+            key = Random.get_random_bytes(SESSION_KEY_SIZE)
+            # A chave vai em hexadecimal, como as demais mensagens de texto
+            if resumed:
+                self.send_frame(self.encrypt(key.hex(), FLAG_RESUME),
+                                FRAME_MSG, FLAG_RESUME)
+            else:
+                self.send(key.hex())
+            self.session_key = key
+        else:
+            self.send('0')
+    
+    def accept_session(self):
+        """Recebimento da chave de sessão enviada pelo servidor
+        
+        Ver ``offer_session``. Para retomar uma sessão, a chave do bilhete
+        deve estar em ``session_key``; se o servidor recusar o bilhete, a
+        chave de sessão vem pelo RSA.
+        
+        Returns:
+            (bool) True se a sessão foi retomada
+        
+        """
+        msg = self.recv_frame(FRAME_MSG)
+        resumed = bool(self.frame_flags & FLAG_RESUME)
+        if not resumed:
+            self.session_key = None
+        msg = self.decrypt(msg, self.frame_flags).decode('utf-8')
+        if msg != '0':
+            self.session_key = bytes.fromhex(msg)
+        return resumed
+    
+    def offer_features(self):
+        """Envio dos recursos aceitos, feito pelo cliente na troca de chaves
+        
+        Os recursos são os compressores, em ordem de preferência, o modo
+        binário (``FEATURE_BINARY``) e os comandos em paralelo
+        (``FEATURE_PIPELINE``).
+        
+        """
+        features = self.codecs + ([FEATURE_BINARY] if self.binary else []) + (
+                [FEATURE_PIPELINE] if self.pipeline else [])
+        self.send(' '.join(features) or '-')
+    
+    def choose_features(self, offered):
+        """Escolha dos recursos da conexão, feita pelo servidor
+        
+        O compressor escolhido é o primeiro da lista do cliente que o servidor
+        também aceita, ou nenhum ('-'); o modo binário e os comandos em
+        paralelo são usados se os dois lados os aceitam. Deve ser chamado
+        depois de ``offer_session``. A
+        resposta ainda segue em Base85; o modo binário vale a partir da
+        mensagem seguinte.
+        
+        Args:
+            offered (str): mensagem enviada pelo cliente com ``offer_features``
+        
+        """
+        offered = offered.split(' ')
+        for codec in offered:
+            if codec in self.codecs:
+                self.compressor = codec
+                break
+        binary = self.binary and FEATURE_BINARY in offered
+        pipeline = self.pipeline and FEATURE_PIPELINE in offered
+        self.send(' '.join([self.compressor or '-'] +
+                           ([FEATURE_BINARY] if binary else []) +
+                           ([FEATURE_PIPELINE] if pipeline else [])))
+        self.binary_wire = binary
+        self.pipeline_wire = pipeline
+    
+    def accept_features(self):
+        """Recebimento dos recursos escolhidos pelo servidor
+        
+        Ver ``choose_features``.
+        
+        """
+        msg = self.receive().split(' ')
+        self.compressor = msg[0] if msg[0] in CODECS else None
+        self.binary_wire = FEATURE_BINARY in msg[1:]
+        self.pipeline_wire = FEATURE_PIPELINE in msg[1:]
+    
+    def compress(self, data):
+        """Comprime um trecho com o compressor da conexão, se valer a pena
+        
+        Args:
+            data (bytes): trecho original
+        
+        Returns:
+            (tuple) trecho a enviar e flags do frame (FLAG_COMPRESSED se o
+                trecho foi comprimido)
+        
+        """
+        if self.compressor is not None:
+            packed = CODECS[self.compressor][0](data)
+            if len(packed) < len(data):
+                return packed, FLAG_COMPRESSED
+        return data, 0
+    
+    def decompress(self, data, flags, limit = MAX_MESSAGE):
+        """Descomprime um trecho recebido com ``FLAG_COMPRESSED``
+        
+        Args:
+            data (bytes): trecho recebido
+            flags (int): flags do frame
+            limit (int): tamanho máximo do trecho original, em geral o
+                anunciado pelo emissor
+        
+        Returns:
+            (bytes) trecho original
+        
+        Raises:
+            ValueError: se o trecho comprimido for inválido, passar de
+                ``limit`` bytes ou chegar sem um compressor negociado
+        
+        """
+        if flags & FLAG_COMPRESSED:
+            if self.compressor is None:
+                raise ValueError("Trecho comprimido sem compressor negociado")
+            return CODECS[self.compressor][1](data, limit)
+        return data
+    
+    def send(self, msg, flags = 0):
         """Método send envia strings simples através do socket
         
         O Método send é o método usado apara enviar mensagens simples através
         de um socket. Dentro desse método ocorrem as criptografias RSA e base64
-        antes do envio."
+        antes do envio, e a mensagem segue em um frame do tipo FRAME_MSG. No
+        modo binário o texto cifrado segue como está, sem o Base85.
+        Mensagens a partir de ``COMPRESS_MIN`` bytes, como os lotes da
+        listagem, são comprimidas antes de cifradas.
         
         Args:
             msg (str ou bytes): mensagem a ser enviada
+            flags (int): flags adicionais do frame, como ``FLAG_NOTICE``
         
         """
-        msg = self.encrypt(msg)
-        self.sock.send(msg)
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        if len(msg) >= COMPRESS_MIN:
+            msg, compressed = self.compress(msg)
+            flags |= compressed
+        self.send_frame(self.encrypt(msg, flags), FRAME_MSG, flags)
     
-    def receive(self, b = 160):
+    def receive(self):
         """Método receive recebe mensagens simples através do socket
         
         É através desse método que o usuário recebe mensagens simples através
         do socket. As mensagens chegam criptografadas e a descriptografia
         acontece dentro do método receive.
         
-        Args:
-            b (int): quantidade de bytes a serem recebidos
-        
         Returns:
             (str) mensagem decifrada
         
         """
-        msg = self.decrypt(self.sock.recv(b))
+        msg = self.recv_frame(FRAME_MSG)
+        flags = self.frame_flags
+        msg = self.decompress(self.decrypt(msg, flags), flags)
         return msg.decode('utf-8')
     
-    def encrypt(self, msg):
+    def encrypt(self, msg, flags = 0):
         """Criptografia de uma string ou trecho de bytes
         
         Args:
             msg (str ou bytes): string ou bytes a serem criptografados.
+            flags (int): flags do frame, autenticadas junto com a mensagem no
+                modo de sessão
         
         Returns:
             (bytes) segmento de bytes criptografados
@@ -128,90 +804,434 @@ class Console(object):
         """
         if isinstance(msg, str):
             msg = msg.encode('utf-8')
-        msg = self.publickey.encrypt(msg, 3.14159265359)
-        msg = base64.a85encode(msg[0])
+        if self.session_key is None:
+            # Mensagens maiores que um bloco RSA são cifradas em partes,
+            # precedidas pelo tamanho no modo binário ou separadas por quebras
+            # de linha, que não existem no alfabeto a85. O preenchimento OAEP
+            # torna cada bloco aleatório e impede que seja alterado
+            cipher = PKCS1_OAEP.new(self.publickey)
+            blocks = (cipher.encrypt(msg[i:i + RSA_BLOCK])
+                      for i in range(0, max(len(msg), 1), RSA_BLOCK))
+            if self.binary_wire:
+                return b''.join(RSA_LENGTH.pack(len(block)) + block
+                                for block in blocks)
+            return b'\n'.join(base64.a85encode(block) for block in blocks)
+        if self.binary_wire:
+            return self.seal(msg, flags)
+        msg = base64.a85encode(self.seal(msg, flags))
         return msg
     
-    def decrypt(self, msg):
+    def decrypt(self, msg, flags = 0):
         """Método de conversão de um trecho criptografado
         
         Args:
             msg (bytes): trecho de mensagem a ser decifrado
+            flags (int): flags do frame recebido
         
         Returns:
             (bytes): trecho de bytes decifrados
+        
+        Raises:
+            ValueError: se algum bloco RSA não puder ser decifrado
         """
-        msg = base64.a85decode(msg)
-        msg = self.privatekey.decrypt(msg)
+        if self.session_key is None:
+            if self.binary_wire:
+                blocks = []
+                pos = 0
+                while pos < len(msg):
+                    if pos + RSA_LENGTH.size > len(msg):
+                        raise ValueError("Bloco RSA incompleto")
+                    n, = RSA_LENGTH.unpack_from(msg, pos)
+                    pos += RSA_LENGTH.size
+                    blocks.append(bytes(msg[pos:pos + n]))
+                    pos += n
+            else:
+                blocks = map(base64.a85decode, bytes(msg).split(b'\n'))
+            cipher = PKCS1_OAEP.new(self.privatekey)
+            return b''.join(cipher.decrypt(block) for block in blocks)
+        if self.binary_wire:
+            return self.unseal(msg, flags)
+        msg = self.unseal(base64.a85decode(msg), flags)
         return msg
+    
+    def seal(self, data, flags = 0, key = None):
+        """Cifra um trecho de bytes com a chave de sessão (AES-GCM)
         
-
-    def send_file(self, filename):
+        Args:
+            data (bytes): trecho a ser cifrado
+            flags (int): flags do frame, autenticadas como dados associados
+                para que não possam ser alteradas no caminho
+            key (bytes): chave a usar no lugar da chave de sessão
+        
+        Returns:
+            (bytes) nonce, tag de autenticação e texto cifrado, nessa ordem
+        
+        """
+        nonce = Random.get_random_bytes(NONCE_SIZE)
+        cipher = AES.new(key or self.session_key, AES.MODE_GCM, nonce = nonce)
+        if flags:
+            cipher.update(bytes([flags]))
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return nonce + tag + ciphertext
+    
+    def unseal(self, data, flags = 0, key = None):
+        """Decifra e autentica um trecho gerado por ``seal``
+        
+        Args:
+            data (bytes): nonce, tag e texto cifrado
+            flags (int): flags do frame recebido
+            key (bytes): chave a usar no lugar da chave de sessão
+        
+        Returns:
+            (bytes) trecho decifrado
+        
+        Raises:
+            ValueError: se a autenticação do trecho falhar
+        
+        """
+        nonce = data[:NONCE_SIZE]
+        tag = data[NONCE_SIZE:NONCE_SIZE + TAG_SIZE]
+        cipher = AES.new(key or self.session_key, AES.MODE_GCM, nonce = nonce)
+        if flags:
+            cipher.update(bytes([flags]))
+        return cipher.decrypt_and_verify(data[NONCE_SIZE + TAG_SIZE:], tag)
+    
+    @staticmethod
+    def manifest(filename, block = BLOCK_SIZE):
+        """Calcula o hash SHA-256 de cada bloco de um arquivo
+        
+        Args:
+            filename (str): endereço do arquivo
+            block (int): tamanho dos blocos
+        
+        Returns:
+            (tuple) tamanho do arquivo e lista com o hash hexadecimal de cada
+                bloco
+        
+        """
+        hashes = []
+        buffer = bytearray(block)
+        view = memoryview(buffer)
+        size = 0
+        with open(filename, 'rb') as file:
+            n = file.readinto(buffer)
+            while n:
+                hashes.append(hashlib.sha256(view[:n]).hexdigest())
+                size += n
+                n = file.readinto(buffer)
+        return size, hashes
+    
+    @staticmethod
+    def read_parts(parts, chunk):
+        """Lê em sequência os trechos de arquivos, em segmentos de ``chunk``
+        bytes
+        
+        Os segmentos têm sempre ``chunk`` bytes, exceto o último, mesmo
+        quando atravessam a fronteira entre dois trechos.
+        
+        Um trecho pode trazer, no lugar do endereço, o conteúdo já em memória
+        (um ``memoryview``, como os do cache de arquivos do servidor); os
+        segmentos inteiros dele são fatias, sem cópia.
+        
+        Args:
+            parts (list): trechos (endereço, início, tamanho)
+            chunk (int): tamanho dos segmentos
+        
+        Yields:
+            (bytes) segmento lido
+        
+        """
+        buffer = bytearray()
+        for filename, offset, length in parts:
+            if isinstance(filename, memoryview):
+                view = filename[offset:offset + length]
+                while view:
+                    if not buffer and len(view) >= chunk:
+                        data, view = view[:chunk], view[chunk:]
+                        yield data
+                        continue
+                    n = chunk - len(buffer)
+                    buffer += view[:n]
+                    view = view[n:]
+                    if len(buffer) == chunk:
+                        yield bytes(buffer)
+                        buffer.clear()
+                continue
+            with open(filename, 'rb') as file:
+                file.seek(offset)
+                while length:
+                    data = file.read(min(chunk - len(buffer), length))
+                    if not data:
+                        raise EOFError("Arquivo truncado: " + filename)
+                    length -= len(data)
+                    if not buffer and len(data) == chunk:
+                        yield data
+                        continue
+                    buffer += data
+                    if len(buffer) == chunk:
+                        yield bytes(buffer)
+                        buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+    
+    def send_file(self, filename, stream = True, parts = None):
         """Rotina de envio de arquivos através de sockets
         
         Esse método controla o envio sequencial de segmentos de um arquivo
-        através de um socket, gerando a cada envio um número inteiro referente
-        a quantidade de bytes enviados até o momento.
+        através de um socket, gerando a cada envio o progresso da
+        transferência.
         Método deve ser usado como um gerador. Veja exemplo abaixo.
         
+        No modo de streaming os segmentos de ``chunk_size`` bytes são enviados
+        em sequência, sem esperar um 'ack' do receptor. Se ``window`` for
+        maior que zero, o envio é limitado por créditos: o emissor pode ter no
+        máximo ``window`` segmentos sem confirmação, e o receptor devolve
+        créditos a cada ``window // 2`` segmentos consumidos. Sem streaming o
+        arquivo segue em segmentos de 1024 bytes, cada um precedido por um
+        'ack'.
+        
+        Quando os segmentos não são cifrados (fora do modo de sessão ou com
+        ``encrypt_files`` desativado), o streaming usa ``send_raw``, que
+        entrega o arquivo diretamente ao socket com ``sendfile``.
+        
+        Com um compressor escolhido na troca de chaves, o streaming comprime
+        os segmentos, a menos que a amostra do início do arquivo mostre que
+        ele não se comprime (arquivos já comprimidos, mídia). Cada segmento
+        que não diminui segue como está, sem ``FLAG_COMPRESSED``.
+        
+        Com ``parts``, o conteúdo enviado é a concatenação dos trechos, por
+        exemplo os blocos de um arquivo guardados separadamente pelo servidor.
+        
         Example:
             
-            for b in self.sendfile('alice.txt'):
-                if b == -1:
-                    print("Houve um erro na transferência")
-                else:
-                    print(str(b) + "de " str(file_size) "bytes enviados")
+            for p in self.send_file('alice.txt'):
+                print("{0} de {1} bytes enviados ({2:.2f} MB/s)".format(
+                        p.done, p.total, p.rate))
         
         Args:
             filename (str): endereço do arquivo
+            stream (bool): True para usar o modo de streaming
+            parts (list): trechos (endereço, início, tamanho) enviados em
+                sequência no lugar de ``filename``
             
         Yields:
-            (int) quantidade de bytes enviados ou -1, em caso de erro
+            (Progress) progresso da transferência
         
         """
-        size = os.path.getsize(filename)
-        self.send(str(size))
-        sent = 0
-        file = open(filename, 'rb')
+        if parts is None:
+            parts = [(filename, 0, os.path.getsize(filename))]
+        size = sum(part[2] for part in parts)
+        pieces = None
+        compress = False
+        if stream:
+            chunk = self.chunk_size
+            sealed = self.session_key is not None and self.encrypt_files
+            if self.compressor is not None and size:
+                pieces = self.read_parts(parts, chunk)
+                first = next(pieces)
+                sample = first[:COMPRESS_SAMPLE]
+                packed, flags = self.compress(sample)
+                compress = len(packed) < COMPRESS_RATIO * len(sample)
+                pieces = itertools.chain([first], pieces)
+            mode = 'sealed' if sealed else 'plain' if compress else 'raw'
+            self.send('{0} {1} {2} {3} {4}'.format(
+                    size, chunk, self.window, mode,
+                    self.compressor if compress else '-'))
+            if mode == 'raw':
+                yield from self.send_raw(parts, size, chunk)
+                return
+        else:
+            chunk = 1024
+            sealed = self.session_key is not None
+            self.send(str(size))
+        grant = max(self.window // 2, 1)
+        credits, grants = self.window, 0
+        sent = wire = 0
+        start = time.perf_counter()
+        if pieces is None:
+            pieces = self.read_parts(parts, chunk)
         while sent < size:
-            ack = self.receive()
-            nxt = file.read(1024)
-            self.sock.send(nxt)
+            if not stream:
+                ack = self.receive()
+            elif self.window:
+                if not credits:
+                    credits += int(self.receive())
+                    grants += 1
+                credits -= 1
+            nxt = next(pieces)
             sent += len(nxt)
-            yield sent
-        file.close()
-            
-            
+            flags = 0
+            if compress:
+                nxt, flags = self.compress(nxt)
+            if sealed:
+                nxt = self.seal(nxt, flags)
+            self.send_frame(nxt, FRAME_DATA, flags)
+            wire += len(nxt) + FRAME_HEADER.size
+            yield Progress(sent, size, time.perf_counter() - start, wire)
+        if stream and self.window:
+            # Descarta os créditos devolvidos depois do último pedido
+            chunks = -(-size // chunk)
+            for i in range(grants, (chunks - 1) // grant):
+                self.receive()
     
-    def receive_file(self, filename):
+    def receive_file(self, filename, parts = None):
         """Rotina de recebimento de arquivos através de sockets
         
         Esse método controla o recebeimendo de sementos de arquivos através de
-        um socket. O método gera a quantidade de bytes recebidos a cada nova
-        mensagem recebida do socket, por tanto, deve ser usado como um gerador.
+        um socket. O método gera o progresso da transferência a cada novo
+        segmento recebido do socket, por tanto, deve ser usado como um gerador.
+        O modo de transferência (com 'ack', streaming cifrado, streaming em
+        frames sem cifra ou streaming sem cópias) e a compressão são definidos
+        pelo emissor no cabeçalho enviado por ``send_file``.
+        
+        Com ``parts``, os bytes recebidos preenchem em sequência os trechos
+        indicados, sem truncar os arquivos, em vez de substituir ``filename``.
         
         Example:
             
-            for b in receive_file(filename):
-                print(str(b) + " de " str(filesize) " bytes recebidos.")
+            for p in receive_file(filename):
+                print(str(p.done) + " de " + str(p.total) + " bytes recebidos.")
         
         Args:
             filename(str): nome do arquivo
+            parts (list): trechos (endereço, início, tamanho) a preencher no
+                lugar de ``filename``
+        
+        Yields:
+            (Progress) progresso da transferência
+        
+        Raises:
+            ValueError: se o tamanho anunciado pelo emissor for diferente do
+                tamanho dos trechos
+        """
+        info = self.receive().split(' ')
+        size = int(info[0])
+        stream = len(info) > 1
+        window = int(info[2]) if stream else 0
+        if parts is None:
+            open(filename, 'wb').close()
+            parts = [(filename, 0, size)]
+        elif sum(part[2] for part in parts) != size:
+            raise ValueError("Tamanho anunciado difere do esperado")
+        if stream and info[3] == 'raw':
+            yield from self.receive_raw(parts, size, int(info[1]))
+            return
+        sealed = self.session_key is not None and (not stream or
+                                                   info[3] == 'sealed')
+        chunk = int(info[1]) if stream else 1024
+        grant = max(window // 2, 1)
+        file = PartWriter(parts)
+        rcvd = wire = chunks = 0
+        start = time.perf_counter()
+        try:
+            while rcvd < size:
+                if not stream:
+                    self.send('ack')
+                nxt = self.recv_frame(FRAME_DATA)
+                flags = self.frame_flags
+                wire += len(nxt) + FRAME_HEADER.size
+                if sealed:
+                    nxt = self.unseal(nxt, flags)
+                nxt = self.decompress(nxt, flags, min(chunk, size - rcvd))
+                rcvd += len(nxt)
+                chunks += 1
+                file.write(nxt)
+                if window and chunks % grant == 0 and rcvd < size:
+                    self.send(str(grant))
+                yield Progress(rcvd, size, time.perf_counter() - start, wire)
+        finally:
+            file.close()
+    
+    def send_raw(self, parts, size, chunk):
+        """Envio de um arquivo sem cópias para o espaço do usuário
+        
+        O corpo do arquivo segue logo após o cabeçalho, sem frames, através de
+        ``socket.sendfile`` (que usa ``os.sendfile`` quando disponível). Os
+        trechos já em memória (ver ``read_parts``) seguem com ``sendall``.
+        
+        Args:
+            parts (list): trechos (endereço, início, tamanho) enviados
+            size (int): tamanho do arquivo anunciado ao receptor
+            chunk (int): quantidade de bytes entre dois relatórios de progresso
+        
+        Yields:
+            (Progress) progresso da transferência
+        
+        """
+        sent = 0
+        start = time.perf_counter()
+        for filename, offset, length in parts:
+            if isinstance(filename, memoryview):
+                for done in range(0, length, chunk):
+                    n = min(chunk, length - done)
+                    self.sock.sendall(filename[offset + done:
+                                               offset + done + n])
+                    sent += n
+                    yield Progress(sent, size, time.perf_counter() - start,
+                                   sent)
+                continue
+            with open(filename, 'rb') as file:
+                done = 0
+                while done < length:
+                    n = self.sock.sendfile(file, offset + done,
+                                           min(chunk, length - done))
+                    if not n:
+                        raise ConnectionError("Arquivo truncado durante o " +
+                                              "envio")
+                    done += n
+                    sent += n
+                    yield Progress(sent, size, time.perf_counter() - start,
+                                   sent)
+    
+    def receive_raw(self, parts, size, chunk):
+        """Recebimento de um arquivo enviado por ``send_raw``
+        
+        Cada trecho é pré-alocado e mapeado em memória, e os bytes são lidos
+        do socket com ``recv_into`` diretamente sobre o mapeamento.
+        
+        Args:
+            parts (list): trechos (endereço, início, tamanho) a preencher
+            size (int): tamanho do arquivo
+            chunk (int): quantidade de bytes entre dois relatórios de progresso
         
         Yields:
-            (int) quantidade de bytes recebidos
+            (Progress) progresso da transferência
+        
         """
-        size = int(self.receive())
-        file = open(filename, 'wb')
         rcvd = 0
-        while rcvd < size:
-            self.send('ack')
-            nxt = self.sock.recv(1024)
-            rcvd += len(nxt)
-            file.write(nxt)
-            yield rcvd
-        file.close()
-            
+        start = time.perf_counter()
+        for filename, offset, length in parts:
+            with open_part(filename) as file:
+                if not length:
+                    continue
+                if os.fstat(file.fileno()).st_size < offset + length:
+                    file.truncate(offset + length)
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(file.fileno(), offset, length)
+                # O mapeamento precisa começar em um múltiplo da granularidade
+                skip = offset % mmap.ALLOCATIONGRANULARITY
+                buffer = mmap.mmap(file.fileno(), skip + length,
+                                   offset = offset - skip)
+                view = memoryview(buffer)[skip:]
+                try:
+                    done = 0
+                    while done < length:
+                        n = min(chunk, length - done)
+                        piece = view[done:done + n]
+                        try:
+                            self.recv_into(piece)
+                        finally:
+                            # Liberado já aqui para que um erro no meio da
+                            # leitura não impeça o fechamento do mapeamento
+                            piece.release()
+                        done += n
+                        rcvd += n
+                        yield Progress(rcvd, size,
+                                       time.perf_counter() - start, rcvd)
+                finally:
+                    view.release()
+                    buffer.close()
+    
     def __repr__(self):
         return "{0}({1}, {2}, key_file = {3})".format(self.__class__.__name__,
                 self.sock.__repr__(), self.client.__repr__(),
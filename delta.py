@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo de transferências por diferença, no estilo do rsync
+
+Quem tem a versão antiga de um arquivo envia as assinaturas dos seus blocos
+(um checksum fraco, o adler32, e um hash forte). Quem tem a versão nova
+percorre o arquivo com o checksum fraco deslizante, procurando blocos da
+versão antiga em qualquer posição, e produz uma lista de operações: copiar
+blocos da versão antiga ou inserir trechos literais da nova. Só os trechos
+literais são transferidos.
+
+As operações são codificadas como "l<n>" (n bytes literais, na ordem em que
+são enviados) e "c<i>" ou "c<i>-<j>" (copiar os blocos i a j da versão
+antiga).
+
+Example:
+    >> sigs = signatures([('antigo.log', 0, 1000000)])
+    >> ops = scan(dados_novos, 0, len(dados_novos), sigs)
+    >> literais = literal_parts('novo.log', ops)
+
+"""
+
+from console import Console, open_part
+import hashlib
+import re
+import zlib
+
+# Tamanho dos blocos das assinaturas
+DELTA_BLOCK = 64 * 1024
+
+# Módulo do adler32
+ADLER_MOD = 65521
+
+# Sem encontrar blocos por tantos bytes, a busca deixa de deslizar byte a
+# byte e passa a testar apenas posições alinhadas, o que limita o custo para
+# arquivos muito diferentes da versão antiga
+LITERAL_LIMIT = 8 * DELTA_BLOCK
+
+# Formatos aceitos nas mensagens recebidas do outro lado: números decimais,
+# o adler32 em até 8 dígitos hexadecimais, o hash forte truncado e as
+# operações "l<n>", "c<i>" e "c<i>-<j>"
+NUMBER = re.compile('[0-9]+')
+WEAK = re.compile('[0-9a-f]{1,8}')
+STRONG = re.compile('[0-9a-f]{16}')
+OP = re.compile('l([0-9]+)|c([0-9]+)(?:-([0-9]+))?')
+
+
+def strong_hash(data):
+    """Hash forte de um bloco, truncado para as assinaturas
+
+    Args:
+        data (bytes): conteúdo do bloco
+
+    Returns:
+        (str) 16 primeiros dígitos hexadecimais do SHA-256
+
+    """
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def signatures(parts, block = DELTA_BLOCK):
+    """Assinaturas dos blocos de um arquivo
+
+    Args:
+        parts (list): trechos (endereço, início, tamanho) do arquivo
+        block (int): tamanho dos blocos
+
+    Returns:
+        (tuple) tamanho dos blocos, tamanho do arquivo e lista de tuplas
+            (adler32, hash forte) de cada bloco
+
+    """
+    sigs = [(zlib.adler32(data), strong_hash(data))
+            for data in Console.read_parts(parts, block)]
+    return block, sum(part[2] for part in parts), sigs
+
+
+def encode_signatures(sigs):
+    """Codifica as assinaturas em uma mensagem
+
+    Args:
+        sigs (tuple): resultado de ``signatures``
+
+    Returns:
+        (str) "<bloco> <tamanho> <adler32>:<hash>..."
+
+    """
+    block, size, pairs = sigs
+    return ' '.join([str(block), str(size)] +
+                    ['{0:x}:{1}'.format(weak, strong)
+                     for weak, strong in pairs])
+
+
+def decode_signatures(msg):
+    """Decodifica uma mensagem de ``encode_signatures``
+
+    A mensagem vem do outro lado da conexão, então o tamanho dos blocos deve
+    ser positivo (com blocos vazios, ``scan`` não avançaria), deve haver uma
+    assinatura por bloco do arquivo e cada assinatura deve ter o formato de
+    ``encode_signatures``.
+
+    Args:
+        msg (str): mensagem recebida
+
+    Returns:
+        (tuple) tamanho dos blocos, tamanho do arquivo e lista de tuplas
+            (adler32, hash forte)
+
+    Raises:
+        ValueError: se a mensagem não for válida
+
+    """
+    info = msg.split(' ')
+    if len(info) < 2 or not all(NUMBER.fullmatch(n) for n in info[:2]):
+        raise ValueError("Assinaturas inválidas")
+    block, size = int(info[0]), int(info[1])
+    if block <= 0 or len(info) - 2 != -(-size // block):
+        raise ValueError("Assinaturas inválidas")
+    pairs = []
+    for pair in info[2:]:
+        weak, _, strong = pair.partition(':')
+        if not (WEAK.fullmatch(weak) and STRONG.fullmatch(strong)):
+            raise ValueError("Assinaturas inválidas")
+        pairs.append((int(weak, 16), strong))
+    return block, size, pairs
+
+
+def scan(data, start, end, sigs):
+    """Compara um trecho da versão nova com as assinaturas da antiga
+
+    Args:
+        data (bytes): conteúdo da versão nova (pode ser um ``mmap``)
+        start (int): início do trecho
+        end (int): fim do trecho
+        sigs (tuple): assinaturas da versão antiga
+
+    Returns:
+        (list) operações ('l', início, tamanho) para trechos literais, com a
+            posição na versão nova, e ('c', índice) para blocos copiados
+
+    """
+    block, size, pairs = sigs
+    table = dict()
+    for i, (weak, strong) in enumerate(pairs):
+        # O último bloco, se incompleto, não pode coincidir com uma janela
+        if (i + 1) * block <= size:
+            table.setdefault(weak, dict()).setdefault(strong, i)
+    ops = []
+    literal = pos = start
+    weak = None
+    while pos + block <= end:
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + block])
+            a, b = weak & 0xffff, weak >> 16
+        if weak in table:
+            i = table[weak].get(strong_hash(data[pos:pos + block]))
+            if i is not None:
+                if pos > literal:
+                    ops.append(('l', literal, pos - literal))
+                ops.append(('c', i))
+                pos += block
+                literal = pos
+                weak = None
+                continue
+        if pos - literal >= LITERAL_LIMIT:
+            pos += block
+            weak = None
+            continue
+        if pos + block == end:
+            break
+        out, new = data[pos], data[pos + block]
+        a = (a - out + new) % ADLER_MOD
+        b = (b - block * out + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        pos += 1
+    # O último bloco incompleto ainda pode coincidir com o fim do trecho
+    tail = size % block
+    if tail and end - literal >= tail:
+        window = data[end - tail:end]
+        if pairs[-1] == (zlib.adler32(window), strong_hash(window)):
+            if end - tail > literal:
+                ops.append(('l', literal, end - tail - literal))
+            ops.append(('c', len(pairs) - 1))
+            literal = end
+    if end > literal:
+        ops.append(('l', literal, end - literal))
+    return ops
+
+
+def encode_ops(ops):
+    """Codifica as operações em uma mensagem, agrupando cópias seguidas
+
+    Args:
+        ops (list): operações de ``scan``
+
+    Returns:
+        (str) operações separadas por espaço
+
+    """
+    tokens = []
+    run = None
+    for op in ops + [('l', 0, 0)]:
+        if op[0] == 'c':
+            if run is not None and op[1] == run[1] + 1:
+                run[1] = op[1]
+                continue
+            if run is not None:
+                tokens.append(run)
+            run = [op[1], op[1]]
+            continue
+        if run is not None:
+            tokens.append(run)
+            run = None
+        if op[2]:
+            tokens.append(op[2])
+    return ' '.join('l{0}'.format(token) if isinstance(token, int) else
+                    'c{0}'.format(token[0]) if token[0] == token[1] else
+                    'c{0}-{1}'.format(*token) for token in tokens)
+
+
+def decode_ops(msg, blocks = None, limit = None):
+    """Decodifica uma mensagem de ``encode_ops``
+
+    Args:
+        msg (str): mensagem recebida
+        blocks (int): quantidade de blocos da versão antiga; cópias de
+            blocos além dela são recusadas
+        limit (int): maior quantidade aceita de bytes literais
+
+    Returns:
+        (list) operações ('l', tamanho) e ('c', primeiro, último)
+
+    Raises:
+        ValueError: se alguma operação não for válida
+
+    """
+    ops = []
+    total = 0
+    for token in msg.split():
+        match = OP.fullmatch(token)
+        if match is None:
+            raise ValueError("Operação inválida: " + token)
+        if match.group(1) is not None:
+            ops.append(('l', int(match.group(1))))
+            total += ops[-1][1]
+            continue
+        first = int(match.group(2))
+        last = first if match.group(3) is None else int(match.group(3))
+        if first > last or (blocks is not None and last >= blocks):
+            raise ValueError("Cópia de blocos inexistentes: " + token)
+        ops.append(('c', first, last))
+    if limit is not None and total > limit:
+        raise ValueError("Trechos literais maiores que o arquivo")
+    return ops
+
+
+def literal_parts(filename, ops):
+    """Trechos literais das operações, para envio com ``send_file``
+
+    Args:
+        filename (str): endereço da versão nova
+        ops (list): operações de ``scan``
+
+    Returns:
+        (list) trechos (endereço, início, tamanho)
+
+    """
+    return [(filename, op[1], op[2]) for op in ops if op[0] == 'l']
+
+
+def slice_parts(parts, offset, length):
+    """Recorta um intervalo de uma lista de trechos
+
+    Args:
+        parts (list): trechos (endereço, início, tamanho)
+        offset (int): início do intervalo
+        length (int): tamanho do intervalo
+
+    Returns:
+        (list) trechos que compõem o intervalo
+
+    """
+    sliced = []
+    for filename, start, size in parts:
+        if offset >= size:
+            offset -= size
+            continue
+        n = min(size - offset, length)
+        sliced.append((filename, start + offset, n))
+        length -= n
+        offset = 0
+        if not length:
+            break
+    return sliced
+
+
+def apply(ops, old_parts, block, literals, writer, chunk = 1024 * 1024):
+    """Reconstrói a versão nova a partir da antiga e dos trechos literais
+
+    Args:
+        ops (list): operações de ``decode_ops``
+        old_parts (list): trechos (endereço, início, tamanho) da versão antiga
+        block (int): tamanho dos blocos das assinaturas
+        literals (str): endereço do arquivo com os trechos literais recebidos
+        writer (PartWriter): destino da versão nova
+        chunk (int): tamanho das leituras
+
+    Returns:
+        (int) tamanho da versão nova
+
+    """
+    old_size = sum(part[2] for part in old_parts)
+    size = 0
+    with open_part(literals) as file:
+        for op in ops:
+            if op[0] == 'l':
+                left = op[1]
+                while left:
+                    data = file.read(min(chunk, left))
+                    if not data:
+                        raise EOFError("Trechos literais incompletos")
+                    writer.write(data)
+                    left -= len(data)
+                size += op[1]
+            else:
+                start = op[1] * block
+                length = min((op[2] + 1) * block, old_size) - start
+                if length <= 0:
+                    raise ValueError("Bloco inexistente na versão antiga")
+                for data in Console.read_parts(
+                        slice_parts(old_parts, start, length), chunk):
+                    writer.write(data)
+                size += length
+    return size
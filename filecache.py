@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo do cache de conteúdo de arquivos do servidor
+
+Os arquivos mais baixados (como os compartilhados com muitos usuários) são
+mantidos em memória por um ``FileCache``, um por servidor, para que cada
+``get`` não precise ler o disco de novo. O cache guarda trechos pelo
+endereço no disco, em geral os blocos do ``BlobStore``; como os blocos são
+endereçados pelo conteúdo, um bloco nunca muda, e só sai do cache quando é
+removido ou por falta de espaço. Os arquivos guardados fora do armazenamento
+de blocos são invalidados pelo ``post`` que os substitui e pelo ``delete``.
+
+Os arquivos pequenos são copiados para a memória, até ``budget`` bytes, e
+descartados na ordem do LRU ou do ARC (que também protege os arquivos
+baixados várias vezes de uma sequência de arquivos baixados uma única vez).
+Os arquivos a partir de ``map_size`` bytes não são copiados: os seus trechos
+são servidos por mapeamentos (``mmap``), que usam o cache de páginas do
+sistema e não ocupam o orçamento.
+
+Os trechos servidos são listas (conteúdo, início, tamanho), como as de
+``Console.send_file``, em que o conteúdo é um ``memoryview`` no lugar do
+endereço do arquivo.
+
+Example:
+    >> cache = FileCache(64 * 1024 * 1024, 'arc')
+    >> parts = cache.parts([('blocos/ab/abcd...', 0, 1024)])
+    >> cache.invalidate('blocos/ab/abcd...')
+
+"""
+
+import collections
+import mmap
+import os
+import threading
+
+# Políticas de descarte aceitas
+POLICIES = ('lru', 'arc')
+
+# Orçamento padrão do cache, em bytes
+CACHE_SIZE = 64 * 1024 * 1024
+
+# Tamanho padrão a partir do qual um arquivo é servido por mapeamentos
+MAP_SIZE = 8 * 1024 * 1024
+
+# Mapeamentos mantidos abertos; os menos usados são fechados além disso
+MAX_MAPS = 4096
+
+
+class FileCache(object):
+    """Cache de conteúdo de arquivos com orçamento em bytes
+
+    Com a política 'lru', os arquivos ficam em uma única lista, do menos ao
+    mais recentemente usado. Com 'arc', ficam em duas: os usados uma vez
+    (``recent``) e os usados mais vezes (``frequent``), e as listas
+    ``ghost_recent`` e ``ghost_frequent`` lembram os tamanhos dos últimos
+    descartados de cada uma. Um acerto em uma lista fantasma aumenta o
+    espaço (``target``) da lista correspondente.
+
+    Attributes:
+        budget (int): orçamento, em bytes
+        policy (str): 'lru' ou 'arc'
+        map_size (int): tamanho a partir do qual um arquivo é mapeado
+        size (int): bytes copiados em memória
+        hits (int): trechos servidos pelo cache
+        misses (int): trechos lidos do disco para o cache
+        served (int): bytes servidos pelo cache
+
+    """
+    def __init__(self, budget = CACHE_SIZE, policy = 'lru',
+                 map_size = MAP_SIZE, max_maps = MAX_MAPS):
+        """Método construtor do cache
+
+        Args:
+            budget (int): orçamento, em bytes, dos arquivos copiados para a
+                memória; 0 desativa o cache
+            policy (str): 'lru' ou 'arc'
+            map_size (int): tamanho, em bytes, a partir do qual um arquivo é
+                servido por mapeamentos em vez de copiado
+            max_maps (int): quantidade de mapeamentos mantidos abertos
+
+        Raises:
+            ValueError: se a política for desconhecida
+
+        """
+        if policy not in POLICIES:
+            raise ValueError("Política de cache desconhecida: " + str(policy))
+        self.budget = max(0, int(budget))
+        self.policy = policy
+        self.map_size = int(map_size)
+        self.max_maps = int(max_maps)
+        self.lock = threading.Lock()
+        self.recent = collections.OrderedDict()
+        self.frequent = collections.OrderedDict()
+        self.ghost_recent = collections.OrderedDict()
+        self.ghost_frequent = collections.OrderedDict()
+        self.recent_size = self.frequent_size = 0
+        self.ghost_recent_size = self.ghost_frequent_size = 0
+        self.target = 0
+        self.maps = collections.OrderedDict()
+        # Incrementado a cada invalidação, para que uma leitura anterior a
+        # ela não volte ao cache
+        self.generation = 0
+        self.hits = self.misses = self.served = 0
+
+    @property
+    def size(self):
+        return self.recent_size + self.frequent_size
+
+    def parts(self, parts, size = None):
+        """Troca os trechos de arquivos pelo conteúdo em memória
+
+        Trechos que não puderem ser lidos continuam com o endereço, e o erro
+        aparece no envio, como antes.
+
+        Args:
+            parts (list): trechos (endereço, início, tamanho) de um arquivo
+            size (int): tamanho do arquivo inteiro, que decide entre copiar e
+                mapear, quando os trechos forem só um intervalo dele
+
+        Returns:
+            (list) trechos (memoryview, início, tamanho), ou os próprios
+                trechos se o cache estiver desativado
+
+        """
+        if not self.budget:
+            return parts
+        if size is None:
+            size = sum(part[2] for part in parts)
+        mapped = size >= self.map_size
+        cached = []
+        served = 0
+        for filename, start, length in parts:
+            try:
+                data, hit = self.mapped(filename) if mapped else \
+                    self.content(filename)
+            except (OSError, ValueError):
+                data = None
+            if data is None or start + length > len(data):
+                cached.append((filename, start, length))
+            else:
+                cached.append((data, start, length))
+                served += length if hit else 0
+        with self.lock:
+            self.served += served
+        return cached
+
+    def content(self, filename):
+        """Conteúdo de um arquivo pequeno, do cache ou do disco
+
+        Args:
+            filename (str): endereço do arquivo
+
+        Returns:
+            (tuple) conteúdo do arquivo, ou None se ele não couber no
+                orçamento, e True se ele já estava no cache
+
+        """
+        with self.lock:
+            data = self.recent.get(filename)
+            if data is not None:
+                if self.policy == 'arc':
+                    # Segundo uso: passa para a lista dos frequentes
+                    del self.recent[filename]
+                    self.recent_size -= len(data)
+                    self.frequent[filename] = data
+                    self.frequent_size += len(data)
+                else:
+                    self.recent.move_to_end(filename)
+            else:
+                data = self.frequent.get(filename)
+                if data is not None:
+                    self.frequent.move_to_end(filename)
+            if data is not None:
+                self.hits += 1
+                return data, True
+            generation = self.generation
+        if os.path.getsize(filename) > self.budget:
+            return None, False
+        with open(filename, 'rb') as file:
+            data = memoryview(file.read())
+        with self.lock:
+            self.misses += 1
+            if generation == self.generation and filename not in \
+                    self.recent and filename not in self.frequent:
+                self.insert(filename, data)
+        return data, False
+
+    def insert(self, filename, data):
+        """Coloca no cache um arquivo lido do disco, descartando outros
+
+        Chamado com a trava do cache.
+
+        Args:
+            filename (str): endereço do arquivo
+            data (memoryview): conteúdo do arquivo
+
+        """
+        size = len(data)
+        if self.policy == 'lru':
+            self.recent[filename] = data
+            self.recent_size += size
+            while self.size > self.budget:
+                self.recent_size -= len(self.recent.popitem(last = False)[1])
+            return
+        if filename in self.ghost_recent:
+            # Descartado cedo demais da lista dos recentes
+            self.target = min(self.budget, self.target + size * max(
+                    self.ghost_frequent_size // max(
+                            self.ghost_recent_size, 1), 1))
+            self.ghost_recent_size -= self.ghost_recent.pop(filename)
+            self.replace(size, False)
+            self.frequent[filename] = data
+            self.frequent_size += size
+        elif filename in self.ghost_frequent:
+            # Descartado cedo demais da lista dos frequentes
+            self.target = max(0, self.target - size * max(
+                    self.ghost_recent_size // max(
+                            self.ghost_frequent_size, 1), 1))
+            self.ghost_frequent_size -= self.ghost_frequent.pop(filename)
+            self.replace(size, True)
+            self.frequent[filename] = data
+            self.frequent_size += size
+        else:
+            self.replace(size, False)
+            self.recent[filename] = data
+            self.recent_size += size
+        while self.ghost_recent_size > self.budget:
+            self.ghost_recent_size -= self.ghost_recent.popitem(
+                    last = False)[1]
+        while self.ghost_frequent_size > self.budget:
+            self.ghost_frequent_size -= self.ghost_frequent.popitem(
+                    last = False)[1]
+
+    def replace(self, size, frequent_ghost):
+        """Descarta arquivos do ARC até que ``size`` bytes caibam no cache
+
+        Descarta da lista dos recentes enquanto ela passar do seu espaço
+        (``target``), e da dos frequentes caso contrário; o tamanho de cada
+        descartado vai para a lista fantasma correspondente.
+
+        Args:
+            size (int): bytes do arquivo que entrará no cache
+            frequent_ghost (bool): True se o arquivo veio da lista fantasma
+                dos frequentes
+
+        """
+        while self.size + size > self.budget and self.size:
+            if self.recent and (not self.frequent or
+                                self.recent_size > self.target or
+                                (frequent_ghost and
+                                 self.recent_size == self.target)):
+                filename, data = self.recent.popitem(last = False)
+                self.recent_size -= len(data)
+                self.ghost_recent[filename] = len(data)
+                self.ghost_recent_size += len(data)
+            else:
+                filename, data = self.frequent.popitem(last = False)
+                self.frequent_size -= len(data)
+                self.ghost_frequent[filename] = len(data)
+                self.ghost_frequent_size += len(data)
+
+    def mapped(self, filename):
+        """Mapeamento de um trecho de arquivo grande, do cache ou novo
+
+        Os mapeamentos são reaproveitados entre as sessões. Um mapeamento
+        descartado continua válido para as sessões que ainda o usam, e é
+        desfeito quando a última termina.
+
+        Args:
+            filename (str): endereço do arquivo
+
+        Returns:
+            (tuple) conteúdo mapeado, ou None para um arquivo vazio, e True
+                se o mapeamento já estava no cache
+
+        """
+        with self.lock:
+            data = self.maps.get(filename)
+            if data is not None:
+                self.maps.move_to_end(filename)
+                self.hits += 1
+                return data, True
+            generation = self.generation
+        with open(filename, 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:
+                return None, False
+            data = memoryview(mmap.mmap(file.fileno(), 0,
+                                        access = mmap.ACCESS_READ))
+        with self.lock:
+            self.misses += 1
+            if generation == self.generation:
+                self.maps[filename] = data
+                while len(self.maps) > self.max_maps:
+                    self.maps.popitem(last = False)
+        return data, False
+
+    def invalidate(self, filename):
+        """Remove do cache um arquivo substituído ou excluído
+
+        Args:
+            filename (str): endereço do arquivo
+
+        """
+        filename = str(filename)
+        with self.lock:
+            self.generation += 1
+            data = self.recent.pop(filename, None)
+            if data is not None:
+                self.recent_size -= len(data)
+            data = self.frequent.pop(filename, None)
+            if data is not None:
+                self.frequent_size -= len(data)
+            self.ghost_recent_size -= self.ghost_recent.pop(filename, 0)
+            self.ghost_frequent_size -= self.ghost_frequent.pop(filename, 0)
+            self.maps.pop(filename, None)
+
+    def stats(self):
+        """Contadores do cache, em números, para os relatórios do benchmark
+
+        O menu do servidor mostra os mesmos contadores já formatados, no
+        resumo das métricas.
+
+        Returns:
+            (dict) acertos, faltas, fração de acertos (de 0 a 1), bytes
+                servidos, bytes em memória e mapeamentos abertos
+
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / total if total else 0.0,
+                    'served_bytes': self.served,
+                    'cached_bytes': self.size,
+                    'maps': len(self.maps)}
+
+    def __repr__(self):
+        return "FileCache({0} de {1} bytes, {2})".format(
+                self.size, self.budget, self.policy)
@@ -14,22 +14,67 @@ Example:
     
 """
 
-from console import Console
+from console import Console, Progress, PartWriter, open_part, valid_name
+from console import CommandRegistry, import_key
+from console import CHUNK_SIZE, BLOCK_SIZE, CODECS, FLAG_FEATURES, FLAG_RESUME
+from console import RSA_LENGTH, SESSION_KEY_SIZE, FRAME_KEY, FRAME_MSG
+from console import FLAG_NOTICE, FRAME_HEADER, MAX_FRAME, MAX_MESSAGE
+from console import FLAG_COMPRESSED, FLAG_MORE
+from metadata import MetadataStore, METADATA_FILE
+from blobs import BlobStore, BLOBS_DIR, valid_digest
+from journal import UserJournal, JOURNAL_SUFFIX, RECORD_HEADER
+from journal import read_users, write_users
+from sessions import SessionRegistry
+from metrics import Metrics, MetricsServer, LABELS_IN, LABELS_OUT
+from metrics import merge, summary
+from profiler import Profiler
+from filecache import FileCache, CACHE_SIZE, MAP_SIZE
+import delta
+import asyncio
 import base64
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
 import pathlib
 import os
+import queue
+import selectors
+import socket
+import sys
 import threading
+import traceback
+import urllib.request
 import ntpath
 import datetime
+import hashlib
+import hmac
+import mmap
+import time
 
 # Dicionário que armazenará os usuários cadastrados
 USR_DICT = dict()
 
+# Cabeçalho do arquivo de configurações no formato binário
+SETTINGS_MAGIC = b'RPS\x01'
+
+# Configurações que só valem para o objeto em execução (sockets, objetos
+# compartilhados e opções dos processos do MultiHost) e não são exportadas
+RUNTIME_SETTINGS = ('listener', 'profiler', 'cache', 'maintenance')
+
 # Dicionário de ajuda do terminal
-TERMINAL_HELP = {"conexões": "mostra quantas conexões estão ativas no momento",
+TERMINAL_HELP = {"conexões": "mostra as conexões ativas e na fila, e quantas " +
+                 "foram admitidas, rejeitadas e encerradas por inatividade",
                  "finalizar": "fecha o servidor para conexões futuras e "+
                  "sai do menu",
-                 "iniciar": "abre o servidor para novas conexões"}
+                 "iniciar": "abre o servidor para novas conexões",
+                 "métricas": "mostra a quantidade e a duração dos comandos, " +
+                 "os bytes transferidos e o tempo gasto com criptografia",
+                 "perfil <modo> [<s>] [<arquivo>] [<ms>]": "liga por <s> " +
+                 "segundos (30 por padrão, 0 até 'perfil parar') um perfil " +
+                 "das sessões no modo 'cprofile', 'amostras' ou 'lentos' e " +
+                 "grava o relatório em <arquivo>; com <ms>, registra os " +
+                 "comandos que demoram <ms> ou mais com o tempo de cada " +
+                 "etapa. 'perfil' sozinho mostra o perfil em andamento"}
 
 # Dicionário de ajuda pré-login
 HELP_DICT = {"sair" : "efetuar logoff e encerrar a execução do programa",
@@ -39,14 +84,52 @@ HELP_DICT = {"sair" : "efetuar logoff e encerrar a execução do programa",
              " usando <psw> como senha"}
 
 # Dicionário de comandos principais
-MENU_DICT = {'post <file>': 'faz o upload de um arquivo para o servidor',
-             'get <file>': 'faz o download de um arquivo do servidor',
+MENU_DICT = {'post <file> [<nome>]': 'faz o upload de um arquivo para o ' +
+             'servidor, opcionalmente com outro nome, que pode ter ' +
+             'subdiretórios separados por "/"',
+             'get <file> [<início> [<tamanho>]]': 'faz o download de um ' +
+             'arquivo do servidor, ou de um intervalo de bytes dele',
              'share <file> <usr>': 'compartilha um arquivo com um usuário',
-             'show': 'lista todos os arquivos disponíveis',
-             'delete <file>':'exlui um arquivo do banco de dados do usuário'}
+             'show [prefixo=<p>] [ordem=nome|dono|data] [pagina=<n>] ' +
+             '[limite=<n>]': 'lista os arquivos disponíveis, opcionalmente ' +
+             'filtrados pelo início do nome, ordenados e paginados',
+             'delete <file>':'exlui um arquivo do banco de dados do usuário',
+             'avisos': 'mostra os avisos recebidos, como os de arquivos ' +
+             'compartilhados com você'}
+
+# Quantidade de arquivos enviados em cada mensagem da listagem
+LIST_BATCH = 512
+
+# Maior bloco aceito no manifesto de um upload. O cliente usa ``BLOCK_SIZE``;
+# cada bloco recebido é gravado e conferido por inteiro antes de ser aceito
+MAX_BLOCK = 4 * BLOCK_SIZE
+
+# Segundos de validade do bilhete de um canal de dados
+CHANNEL_TTL = 600
+
+# Segundos de validade de um bilhete de retomada de sessão
+RESUME_TTL = 24 * 3600
+
+# Comandos aceitos nos canais de dados abertos com um bilhete
+CHANNEL_COMMANDS = ('get', 'trecho')
+
+# Comandos aceitos nas sessões de um conjunto de conexões do cliente, abertas
+# com um bilhete no modo 'sessao'
+POOL_COMMANDS = ('post', 'get', 'show', 'share', 'delete', 'ajuda', 'canal',
+                 'trecho')
 
-CLIENT_COUNTER = 0
-CLIENT_DICT = dict()
+# Comandos em paralelo executados ao mesmo tempo em uma conexão, e quantos
+# podem aguardar execução antes que o servidor deixe de ler novos comandos
+PIPELINE_WORKERS = 4
+PIPELINE_DEPTH = 64
+
+# Sessões abertas e conexões atendidas por este processo. No MultiHost a
+# presença dos usuários é compartilhada entre os processos (ver ``sessions``).
+SESSIONS = SessionRegistry()
+
+# Cadastros em andamento, que ainda aguardam a gravação no diário
+SIGNUPS = set()
+SIGNUP_LOCK = threading.Lock()
 
 # Funções Auxlilares
 
@@ -105,18 +188,93 @@ class Host(Console, threading.Thread):
             key_file (str): endereço do arquivo contendo a chave privada do
                 servidor. Por padrão ".pvtkey.txt"
             file_usr (str): endeço do arquivo de texto contendo os usuários já
-                cadastrados no servidor. Por padrão ".usr.txt"
+                cadastrados no servidor. Por padrão ".usr.txt". Os novos
+                cadastros são gravados no diário ".usr.txt.journal", que é
+                compactado periodicamente neste arquivo
+            journal_delay (float): segundos de espera antes de cada ``fsync``
+                do diário, para agrupar cadastros simultâneos
+            journal_size (int): tamanho do diário, em bytes, a partir do qual
+                ele é compactado no arquivo de usuários
+            session (bool): True para cifrar a comunicação com uma chave de
+                sessão AES-GCM após a troca de chaves, False para usar RSA em
+                todas as mensagens. Por padrão True
+            chunk_size (int): tamanho dos segmentos enviados nos downloads
+            window (int): janela de créditos dos downloads, 0 para desativar
+            encrypt_files (bool): False para enviar arquivos sem cifrar, o que
+                permite downloads sem cópias com ``sendfile``. Por padrão True
+            compression (str): compressores aceitos, separados por espaço, em
+                ordem de preferência, ou '' para não comprimir. Por padrão
+                todos os disponíveis (zstd, lz4 e zlib)
+            binary (bool): False para manter a codificação Base85 nas
+                mensagens e nos arquivos de usuários e de configurações. Por
+                padrão True; clientes que não negociam o modo binário
+                continuam usando o Base85
+            pipeline (bool): False para não aceitar comandos em paralelo, com
+                id de requisição. Por padrão True
+            backlog (int): tamanho da fila de conexões não-aceitas, por padrão
+                ``socket.SOMAXCONN``
+            max_sessions (int): quantidade máxima de sessões atendidas ao
+                mesmo tempo, ou seja, o tamanho do conjunto de threads
+                trabalhadoras. Por padrão 256
+            max_pending (int): quantidade máxima de conexões aceitas
+                aguardando uma thread livre; além disso, novos clientes são
+                recusados. Por padrão 1024
+            idle_timeout (float): segundos sem atividade do cliente até a
+                sessão ser encerrada, ou 0 para nunca encerrar. Por padrão 600
+            reuse_port (bool): True para ativar o SO_REUSEPORT, permitindo
+                que vários processos escutem na mesma porta
+            listener (socket.socket): socket de escuta já vinculado, herdado
+                de outro processo, usado no lugar de um novo socket
+            metadata_file (str): endereço do banco de dados de arquivos. Por
+                padrão ".metadata.db" dentro do diretório raiz
+            metrics_port (int): porta local em que as métricas são expostas
+                no formato do Prometheus (``/metrics``), 0 para uma porta
+                livre ou None para não expô-las. Por padrão None; as métricas
+                continuam disponíveis no comando 'métricas' do menu
+            cache_size (int): bytes de arquivos pequenos mantidos em memória
+                para os downloads, ou 0 para desativar o cache. Por padrão
+                64 MiB
+            cache_policy (str): 'lru' ou 'arc', a ordem de descarte do cache.
+                Por padrão 'lru'
+            cache_map_size (int): tamanho, em bytes, a partir do qual os
+                arquivos são servidos por mapeamentos (``mmap``) em vez de
+                copiados para o cache. Por padrão 8 MiB
+            maintenance (bool): False para não importar os arquivos .bd nem
+                apagar os blocos sem referências ao iniciar. Os processos do
+                MultiHost usam False, pois o processo principal já o fez
         
         """
         Console.__init__(self, key_file = kwargs.get('key_file',
-                                                     '.pvtkey.txt'))
+                                                     '.pvtkey.txt'),
+                         sock = kwargs.get('listener'),
+                         chunk_size = kwargs.get('chunk_size', CHUNK_SIZE),
+                         window = kwargs.get('window', 0),
+                         encrypt_files = kwargs.get('encrypt_files', True),
+                         compression = kwargs.get('compression',
+                                                  ' '.join(CODECS)),
+                         binary = kwargs.get('binary', True),
+                         pipeline = kwargs.get('pipeline', True))
         threading.Thread.__init__(self)
         self.host_name = (host_ip, port)
-        self.sock.bind(self.host_name)
+        if kwargs.get('reuse_port'):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if kwargs.get('listener') is None:
+            self.sock.bind(self.host_name)
         
         self.root = pathlib.Path(root)
         if not os.path.exists(root):
             self.root.mkdir()
+        self.store = MetadataStore(kwargs.get(
+                'metadata_file', self.root.joinpath(METADATA_FILE)))
+        self.blobs = BlobStore(self.root.joinpath(BLOBS_DIR))
+        if kwargs.get('maintenance', True):
+            migrated = self.store.migrate(self.root)
+            if migrated:
+                print(migrated, "entradas importadas dos arquivos .bd")
+            self.store.collect(self.blobs.remove)
+        # Segredo dos bilhetes dos canais de dados; derivado da chave privada
+        # para ser o mesmo em todos os processos do MultiHost
+        self.secret = hashlib.sha256(self.privatekey.exportKey()).digest()
         
         try:
             usr_dict = Host.load_users(kwargs.get('file_usr',
@@ -126,39 +284,195 @@ class Host(Console, threading.Thread):
         
         finally:
             USR_DICT.update(usr_dict)
+        self.journal = UserJournal(
+                kwargs.get('file_usr', '.usr.txt'),
+                delay = kwargs.get('journal_delay', 0.002),
+                compact_size = kwargs.get('journal_size', 4 * 1024 * 1024),
+                binary = self.binary)
         
+        self.session = kwargs.get('session', True)
+        self.backlog = int(kwargs.get('backlog', socket.SOMAXCONN))
+        self.max_sessions = int(kwargs.get('max_sessions', 256))
+        self.max_pending = max(1, int(kwargs.get('max_pending', 1024)))
+        self.idle_timeout = float(kwargs.get('idle_timeout', 600))
+        self.pending = queue.Queue(self.max_pending)
+        self.stats_lock = threading.Lock()
+        self.admitted = self.rejected = self.expired = 0
+        self.metrics = Metrics()
+        self.metrics.gauge('tcpy_connections', lambda: SESSIONS.connections)
+        self.metrics.gauge('tcpy_users_online', lambda: SESSIONS.count())
+        self.metrics.gauge('tcpy_pending_connections', self.pending.qsize)
+        port = kwargs.get('metrics_port')
+        self.metrics_port = None if port is None else int(port)
+        self.metrics_server = None
+        self.cache = FileCache(kwargs.get('cache_size', CACHE_SIZE),
+                               kwargs.get('cache_policy', 'lru'),
+                               kwargs.get('cache_map_size', MAP_SIZE))
+        for name, attribute in (('tcpy_cache_hits_total', 'hits'),
+                                ('tcpy_cache_misses_total', 'misses'),
+                                ('tcpy_cache_served_bytes_total', 'served'),
+                                ('tcpy_cache_bytes', 'size')):
+            self.metrics.gauge(name, lambda attribute = attribute: getattr(
+                    self.cache, attribute))
+        self.profiler = Profiler()
         self.__kwargs = kwargs
         self.__run = False
+        self.__wakeup = None
 
-    def run(self, backlog = 0, timeout = 0.5):
+    def run(self, backlog = None):
         """Método de execução principal do servidor.
         
-        Esse método coloca o servidor no modo de escuta, aceitando conexões de
-        acordo com o backlog e timeout fornecidos como parâmetro.
+        Esse método coloca o servidor no modo de escuta. O laço principal
+        aguarda eventos do socket através de um seletor (epoll, kqueue...) e, a
+        cada evento, aceita todas as conexões pendentes de uma vez. O ``stop``
+        acorda o laço imediatamente através de um par de sockets interno.
+        
+        As sessões são atendidas por ``max_sessions`` threads trabalhadoras,
+        que retiram as conexões aceitas de uma fila limitada.
         
         Args:
-            backlog (int): tamanho da fila de conexões não-aceitas.
-            timeout (float): intervaloda busca por novas conexões do socket do
-                servidor
+            backlog (int): tamanho da fila de conexões não-aceitas, por padrão
+                o valor configurado no construtor
         
         """
-        global CLIENT_COUNTER
-        self.sock.settimeout(timeout)
-        self.sock.listen(backlog)
+        self.serve_metrics()
+        # O par de despertar e a flag existem antes do listen: um ``stop``
+        # chamado logo que a porta aceita conexões já encontra o laço armado
         self.__run = True
+        self.__wakeup = socket.socketpair()
+        selector = selectors.DefaultSelector()
+        selector.register(self.__wakeup[0], selectors.EVENT_READ)
+        for i in range(self.max_sessions):
+            threading.Thread(target = self.worker, daemon = True).start()
+        self.sock.listen(backlog or self.backlog)
+        self.sock.setblocking(False)
+        selector.register(self.sock, selectors.EVENT_READ)
         print("Aguardando conexões...")
-        while self.__run:
+        try:
+            while self.__run:
+                for key, events in selector.select():
+                    if key.fileobj is self.sock:
+                        self.accept_pending()
+        finally:
+            selector.close()
+            for sock in self.__wakeup:
+                sock.close()
+            while not self.pending.empty():
+                sock, client = self.pending.get_nowait()
+                Console.refuse(sock, "Servidor finalizado.")
+            for i in range(self.max_sessions):
+                try:
+                    self.pending.put_nowait(None)
+                except queue.Full:
+                    break
+    
+    def accept_pending(self):
+        """Aceita todas as conexões que estão na fila do socket
+        
+        As conexões aceitas entram na fila das threads trabalhadoras. Com a
+        fila cheia o cliente é recusado imediatamente.
+        
+        """
+        while True:
             try:
                 sock, client = self.sock.accept()
-            except:
-                pass
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # Falta de descritores ou conexão abortada antes do accept
+                return
+            sock.setblocking(True)
+            try:
+                self.pending.put_nowait((sock, client))
+            except queue.Full:
+                self.rejected += 1
+                Console.refuse(sock, "Servidor ocupado, tente novamente " +
+                               "mais tarde.")
             else:
+                self.admitted += 1
                 print("Conexão estabelecida com: " + ', '.join(
                         str(x) for x in client))
-                CLIENT_COUNTER += 1
-                tmp = ClientHandler(sock, client, self.publickey, self.privatekey,
-                                    self.root)
-                tmp.start()
+    
+    def worker(self):
+        """Thread trabalhadora que atende uma sessão por vez
+        
+        A troca de chaves acontece aqui, fora do laço de aceitação, de modo
+        que um cliente lento não atrasa as próximas conexões. Nenhum erro de
+        uma sessão encerra a thread: o erro é exibido e a vaga da sessão é
+        liberada.
+        
+        """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            sock, client = item
+            handler = None
+            SESSIONS.connect()
+            try:
+                handler = self.new_handler(sock, client)
+            except (OSError, ValueError):
+                pass
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if handler is None:
+                    sock.close()
+                    SESSIONS.disconnect()
+            if handler is None:
+                continue
+            try:
+                handler.run()
+            except Exception:
+                traceback.print_exc()
+            if handler.expired:
+                with self.stats_lock:
+                    self.expired += 1
+    
+    def new_handler(self, sock, client, timeout = None, inbox = None):
+        """Cria o ClientHandler de uma conexão, realizando a troca de chaves
+        
+        Args:
+            sock (socket.socket): socket do cliente
+            client (tuple): endereço do cliente
+            timeout (float): segundos de espera por cada leitura do cliente,
+                por padrão ``idle_timeout``
+            inbox (bytes): resposta do cliente à chave pública do servidor,
+                quando ela já foi enviada (ver ``AsyncHost.receive_key``)
+        
+        Returns:
+            (ClientHandler) ajudante da conexão
+        
+        """
+        if timeout is None:
+            timeout = self.idle_timeout
+        return ClientHandler(sock, client, self.publickey, self.privatekey,
+                             self.root, self.session,
+                             chunk_size = self.chunk_size,
+                             window = self.window,
+                             encrypt_files = self.encrypt_files,
+                             compression = ' '.join(self.codecs),
+                             binary = self.binary,
+                             pipeline = self.pipeline,
+                             idle_timeout = timeout,
+                             store = self.store, journal = self.journal,
+                             blobs = self.blobs, secret = self.secret,
+                             metrics = self.metrics,
+                             profiler = self.profiler, cache = self.cache,
+                             inbox = inbox)
+    
+    def connection_stats(self):
+        """Contadores de conexões do servidor
+        
+        Returns:
+            (dict) sessões ativas, conexões na fila e quantidade de conexões
+                admitidas, rejeitadas e encerradas por inatividade
+        
+        """
+        return {'ativas': SESSIONS.connections,
+                'na fila': self.pending.qsize(),
+                'admitidas': self.admitted, 'rejeitadas': self.rejected,
+                'expiradas': self.expired}
     
     @staticmethod
     def Menu(host):
@@ -167,7 +481,6 @@ class Host(Console, threading.Thread):
         Funciona como um console para o servidor, onde o usuário digita os
         comandos e o servidor executa.
         """
-        global CLIENT_COUNTER
         running = False
         
         print("\nDigite 'help' ou 'ajuda' se precisar de ajuda.\n")
@@ -180,15 +493,25 @@ class Host(Console, threading.Thread):
                 else:
                     host.start()
             elif comando == "conexões":
-                print(CLIENT_COUNTER)
+                for key, value in host.connection_stats().items():
+                    print(key + ': ' + str(value))
             elif comando == "finalizar":
                 print("Finalizando servidor.")
                 host.stop()
                 running = False
                 break
             elif comando == "clientes":
-                for h in CLIENT_DICT:
-                    print(h.usr)
+                for usr in SESSIONS.users():
+                    print(usr)
+            elif comando == "métricas":
+                for line in host.metrics_summary():
+                    print(line)
+            elif comando.split(' ')[0] == "perfil":
+                try:
+                    print(host.profile(*comando.split()[1:]))
+                except (TypeError, ValueError) as error:
+                    print(error if isinstance(error, ValueError) else
+                          "Parâmetros incorretos!")
             elif comando == "ajuda" or comando == "help":
                 for cmd in TERMINAL_HELP:
                     print(cmd.__repr__() + ': ' + TERMINAL_HELP[cmd])
@@ -199,18 +522,106 @@ class Host(Console, threading.Thread):
         Finaliza o socket principal e inicia o processo de finalização dos
         terminais abertos.
         
+        Os usuários já estão salvos no diário de cadastros, que é apenas
+        sincronizado e fechado.
+        
         Kwargs:
-            file_usr (str): endereço do arquivo de texto onde os usuários serão
-                salvos, 'usr.config' por padrão.
+            file_usr (str): endereço de um arquivo de texto para onde os
+                usuários serão exportados, se diferente do arquivo de usuários
+                do servidor.
             file_config (str): endereço onde as configurações do host serão
                 salvas, 'host.config' por padrão.
+        """
+        self.shutdown()
+        
+        self.export_settings(kwargs.get('file_config', '.host.txt'))
+        self.journal.close()
+        file_usr = kwargs.get('file_usr', self.journal.filename)
+        if os.path.abspath(file_usr) != os.path.abspath(self.journal.filename):
+            Host.save_users(USR_DICT, file_usr, self.binary)
+        self.save_key()
+    
+    def shutdown(self):
+        """Interrompe o laço de aceitação e fecha o socket principal
+        
+        Diferente do ``stop``, não salva usuários nem configurações.
+        
         """
         self.__run = False
+        if self.__wakeup is not None:
+            try:
+                self.__wakeup[1].send(b'\0')
+            except OSError:
+                pass
+            if self.is_alive() and threading.current_thread() is not self:
+                self.join()
         self.sock.close()
+        self.stop_metrics()
+        self.profiler.stop()
+    
+    def serve_metrics(self):
+        """Inicia o servidor HTTP das métricas, se ``metrics_port`` for dado
         
-        self.export_settings(kwargs.get('file_config', '.host.txt'))
-        Host.save_users(USR_DICT, kwargs.get('file_usr', '.usr.txt'))
+        """
+        if self.metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics,
+                                                self.metrics_port)
+            print("Métricas em http://127.0.0.1:{0}/metrics".format(
+                    self.metrics_server.port))
+    
+    def stop_metrics(self):
+        """Finaliza o servidor HTTP das métricas, se estiver em execução
+        
+        """
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+    
+    def metrics_summary(self):
+        """Resumo das métricas do servidor, exibido pelo menu
+        
+        Returns:
+            (list) linhas do resumo
+        
+        """
+        return self.metrics.summary()
+    
+    def profile(self, mode = None, duration = 30, filename = 'perfil.txt',
+                slow = None):
+        """Liga ou desliga o perfil das sessões (ver ``Profiler``)
+        
+        Args:
+            mode (str): 'cprofile', 'amostras' ou 'lentos' para ligar o
+                perfil, 'parar' para desligá-lo e gravar o relatório, ou None
+                para consultar o perfil em andamento
+            duration (float): segundos até o perfil ser desligado, ou 0 para
+                esperar por 'parar'
+            filename (str): arquivo do relatório
+            slow (float): duração mínima, em milissegundos, dos comandos
+                lentos registrados, ou None para não registrá-los
+        
+        Returns:
+            (str) mensagem para o menu
         
+        Raises:
+            ValueError: se os parâmetros forem inválidos ou se já houver um
+                perfil em andamento
+        
+        """
+        if mode is None:
+            return self.profiler.status()
+        if mode == 'parar':
+            if self.profiler.stop() is None:
+                return "Nenhum perfil em andamento."
+            return "Perfil desligado."
+        self.profiler.start(mode, float(duration), filename,
+                            None if slow is None else float(slow) / 1000)
+        return "Perfil '{0}' ligado; relatório em {1}".format(mode, filename)
+    
+    def save_key(self):
+        """Salva a chave privada do servidor no arquivo configurado
+        
+        """
         key_file = open(self.__kwargs.get('key_file', '.pvtkey.txt'), 'wb')
         key_file.write(self.privatekey.exportKey())
         key_file.close()
@@ -219,23 +630,34 @@ class Host(Console, threading.Thread):
         """Função para exportar as configurações do servidor para um arquivo
         
         As configurações são criptografadas com Base64 para evitar que usuários
-        inexperientes percam seus dados.
+        inexperientes percam seus dados. No modo binário, o arquivo começa com
+        ``SETTINGS_MAGIC`` e cada configuração é um registro com os tamanhos
+        do nome e do valor (``RECORD_HEADER``) seguidos dos dois textos.
+        
+        Configurações com o valor None, que equivalem a omiti-las, e as de
+        ``RUNTIME_SETTINGS`` não são exportadas.
         
         Args:
             filename (str): endereço do arquivo onde as configurações serão
                 salvas
         
         """
-        host_ip = "host_ip@{}".format(self.host_name[0])
-        port = "port@{}".format(self.host_name[1])
-        root = "root@{}".format(self.root)
+        settings = [('host_ip', self.host_name[0]),
+                    ('port', self.host_name[1]), ('root', self.root)]
+        settings += [(key, value) for key, value in self.__kwargs.items()
+                     if value is not None and key not in RUNTIME_SETTINGS]
         
+        if self.binary:
+            with open(filename, 'wb') as file:
+                file.write(SETTINGS_MAGIC)
+                for key, value in settings:
+                    key, value = key.encode(), str(value).encode()
+                    file.write(RECORD_HEADER.pack(len(key), len(value)) +
+                               key + value)
+            return
         with open(filename, 'w') as file:
-            file.write(base64.a85encode(host_ip.encode()).decode()+'\n')
-            file.write(base64.a85encode(port.encode()).decode()+'\n')
-            file.write(base64.a85encode(root.encode()).decode()+'\n')
-            for key in self.__kwargs:
-                line = key + '@' + str(self.__kwargs[key])
+            for key, value in settings:
+                line = key + '@' + str(value)
                 file.write(base64.a85encode(line.encode()).decode()+'\n')
 
     @staticmethod
@@ -253,41 +675,58 @@ class Host(Console, threading.Thread):
         
         """
         configurations = dict()
-        with open(filename, 'r') as file:
-            code = file.readline()
-            while code:
-                line = base64.a85decode(code.encode()).decode()
+        with open(filename, 'rb') as file:
+            data = file.read()
+        if data.startswith(SETTINGS_MAGIC):
+            pos = len(SETTINGS_MAGIC)
+            while pos < len(data):
+                nkey, nvalue = RECORD_HEADER.unpack_from(data, pos)
+                pos += RECORD_HEADER.size
+                key = data[pos:pos + nkey].decode()
+                configurations[key] = data[pos + nkey:pos + nkey +
+                                           nvalue].decode()
+                pos += nkey + nvalue
+        else:
+            for code in data.splitlines():
+                line = base64.a85decode(code).decode()
                 settings = line.split('@')
                 configurations[settings[0]] = settings[1]
-                code = file.readline()
         configurations['port'] = int(configurations['port'])
+        if 'metrics_port' in configurations:
+            configurations['metrics_port'] = int(
+                    configurations['metrics_port'])
+        for key in ('session', 'encrypt_files', 'reuse_port', 'binary',
+                    'pipeline'):
+            if key in configurations:
+                configurations[key] = configurations[key] == 'True'
         return Host(**configurations)
 
     @staticmethod
-    def save_users(dict_, filename):
+    def save_users(dict_, filename, binary = True):
         """Função para exportar os usuários de um servidor para um arquivo
         
         A função varre o dicionário de usuários que tem o seguinte formato:
             chaves: números inteiros que representam o hash das senhas de seus
                 respectivos usuários
             valores: strings contendo os nomes de usuário
-        Por fim, a função criptografa as strings usando Base64.
+        Por fim, a função grava os registros no formato binário ou, com
+        ``binary`` desativado, criptografa as strings usando Base64.
         
         Args:
             filename (str): endereço do arquivo onde os usuários serão salvos
+            binary (bool): False para o formato antigo, em Base85
         
         """
-        with open(filename, 'w') as file:
-            for h in dict_:
-                str_ = h+'@'+dict_[h]
-                code = base64.a85encode(str_.encode())
-                file.write(code.decode()+'\n')
+        write_users(filename, dict_.items(), binary)
     
     @staticmethod
     def load_users(fileusers):
         """Retorna um dicionário contendo como chaves o hash das senhas dos
         usuários e como valores os logins de cada um dos usuários.
         
+        Os cadastros do diário (``fileusers + '.journal'``) ainda não
+        compactados são aplicados sobre os do arquivo de usuários.
+        
         Args:
             fileusers (str): endereço do arquivo de usuários
         
@@ -296,11 +735,10 @@ class Host(Console, threading.Thread):
                 nomes de usuário
         """
         dict_usr = dict()
-        with open(fileusers, 'r') as file:
-            for line in file:
-                info = base64.a85decode(line.encode())
-                info = info.decode().split('@')
-                dict_usr[info[0]] = info[1]
+        if os.path.exists(fileusers):
+            read_users(fileusers, dict_usr)
+        if os.path.exists(fileusers + JOURNAL_SUFFIX):
+            read_users(fileusers + JOURNAL_SUFFIX, dict_usr, journal = True)
         return dict_usr
     
     def __repr__(self):
@@ -310,83 +748,1034 @@ class Host(Console, threading.Thread):
                         (x,
                          self.__kwargs[x].__repr__()) for x in self.__kwargs)])
 
+# Servidor assíncrono
+
+class AsyncHost(Host):
+    """Servidor baseado em asyncio
+    
+    Alternativa ao Host que não mantém uma Thread por conexão. As sessões
+    ociosas ficam aguardando no laço de eventos, que também lê cada comando
+    por inteiro; só então a execução do ``ClientHandler`` (criptografia,
+    acesso a disco e trocas de mensagens do comando) é feita em um conjunto
+    limitado de threads. Assim, milhares de clientes conectados ocupam
+    apenas algumas threads. Nessas threads, a troca de chaves e cada espera
+    pelo cliente no meio de um comando duram no máximo ``client_timeout``
+    segundos, de modo que clientes lentos não ocupam as threads por muito
+    tempo.
+    
+    O protocolo e os comandos são os mesmos do Host.
+    
+    Example:
+        >> servidor = AsyncHost(workers = 16)
+        >> servidor.start()
+    
+    """
+    def __init__(self, host_ip = Host.HOST, port = Host.PORT, root = "./root",
+                 **kwargs):
+        """Método construtor do AsyncHost
+        
+        Recebe os mesmos parâmetros do Host.
+        
+        Kwargs:
+            workers (int): quantidade de threads que executam os comandos dos
+                clientes, por padrão 32
+            max_sessions (int): quantidade máxima de sessões conectadas, por
+                padrão 10000. Não há fila de espera: acima do limite os
+                clientes são recusados
+            client_timeout (float): segundos de espera pelo cliente durante
+                a troca de chaves, pelo restante de uma mensagem já iniciada
+                e por cada mensagem no meio de um comando, por padrão 30
+        
+        """
+        kwargs.setdefault('max_sessions', 10000)
+        Host.__init__(self, host_ip, port, root, **kwargs)
+        self.workers = int(kwargs.get('workers', 32))
+        self.client_timeout = float(kwargs.get('client_timeout', 30))
+        self.loop = None
+        self.serving = None
+        self.executor = None
+        self.sessions = set()
+    
+    def run(self, backlog = None):
+        """Executa o laço de eventos do servidor até a chamada de ``stop``
+        
+        Args:
+            backlog (int): tamanho da fila de conexões não-aceitas, por padrão
+                o valor configurado no construtor
+        
+        """
+        self.serve_metrics()
+        # O laço baseado em selectors é necessário para o add_reader
+        self.loop = asyncio.SelectorEventLoop()
+        try:
+            self.serving = self.loop.create_task(
+                    self.serve(backlog or self.backlog))
+            self.loop.run_until_complete(self.serving)
+        finally:
+            self.loop.close()
+    
+    async def serve(self, backlog):
+        """Aceita conexões e cria uma tarefa de sessão para cada cliente
+        
+        Args:
+            backlog (int): tamanho da fila de conexões não-aceitas.
+        
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.sock.listen(backlog)
+        self.sock.setblocking(False)
+        print("Aguardando conexões...")
+        try:
+            while True:
+                sock, client = await self.loop.sock_accept(self.sock)
+                if len(self.sessions) >= self.max_sessions:
+                    self.rejected += 1
+                    Console.refuse(sock, "Servidor ocupado, tente novamente " +
+                                   "mais tarde.")
+                    continue
+                self.admitted += 1
+                print("Conexão estabelecida com: " + ', '.join(
+                        str(x) for x in client))
+                SESSIONS.connect()
+                task = self.loop.create_task(self.handle(sock, client))
+                self.sessions.add(task)
+                task.add_done_callback(self.sessions.discard)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in list(self.sessions):
+                task.cancel()
+            await asyncio.gather(*self.sessions, return_exceptions = True)
+            self.executor.shutdown(wait = False)
+    
+    async def handle(self, sock, client):
+        """Sessão de um cliente
+        
+        A troca de chaves e cada comando são executados no executor; entre os
+        comandos a sessão aguarda no laço de eventos, por no máximo
+        ``idle_timeout`` segundos, e o comando seguinte é lido por inteiro
+        antes de ser entregue ao executor (ver ``read_message``).
+        
+        Args:
+            sock (socket.socket): socket do cliente
+            client (tuple): endereço do cliente
+        
+        """
+        handler = None
+        try:
+            inbox = await self.receive_key(sock)
+            sock.setblocking(True)
+            handler = await self.offload(self.new_handler, sock, client,
+                                         self.client_timeout, inbox)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if handler is None:
+                sock.close()
+                SESSIONS.disconnect()
+        if handler is None:
+            return
+        try:
+            await self.offload(handler.welcome)
+            while True:
+                try:
+                    handler.inbox = memoryview(await self.read_message(sock))
+                except asyncio.TimeoutError:
+                    await self.offload(handler.expire)
+                    self.expired += 1
+                    break
+                if not await self.offload(handler.step):
+                    break
+        except OSError:
+            pass
+        finally:
+            await self.offload(handler.close)
+    
+    async def receive_key(self, sock):
+        """Envia a chave pública do servidor e lê a resposta do cliente
+        
+        Primeira parte da troca de chaves, feita no laço de eventos para que
+        um cliente que não responde não ocupe uma thread do executor. O
+        restante acontece no ``ClientHandler``, sem esperas pelo cliente.
+        
+        Args:
+            sock (socket.socket): socket do cliente, não-bloqueante
+        
+        Returns:
+            (bytearray) frames da chave do cliente e, se anunciados, dos
+                recursos aceitos
+        
+        Raises:
+            asyncio.TimeoutError: se o cliente não responder em
+                ``client_timeout`` segundos
+            ConnectionError: se a conexão for encerrada
+        
+        """
+        frame = FRAME_HEADER.pack(len(self.publickey), FRAME_KEY, 0) + \
+            self.publickey
+        await self.loop.sock_sendall(sock, frame)
+        self.metrics.add('tcpy_bytes_total', len(frame), LABELS_OUT)
+        data = await self.read_message(sock, self.client_timeout)
+        if FRAME_HEADER.unpack_from(data)[2] & FLAG_FEATURES:
+            data += await self.read_message(sock, self.client_timeout)
+        return data
+    
+    async def read_message(self, sock, timeout = None):
+        """Lê no laço de eventos os frames de uma mensagem do cliente
+        
+        O primeiro byte é aguardado por até ``timeout`` segundos, e o
+        restante da mensagem por até ``client_timeout`` segundos a cada
+        leitura.
+        
+        Args:
+            sock (socket.socket): socket do cliente
+            timeout (float): segundos de espera pela mensagem, por padrão
+                ``idle_timeout``
+        
+        Returns:
+            (bytearray) frames da mensagem, com os cabeçalhos
+        
+        Raises:
+            asyncio.TimeoutError: se o cliente não enviar a mensagem a tempo
+            ConnectionError: se a conexão for encerrada ou se a mensagem
+                passar do tamanho máximo
+        
+        """
+        data = bytearray()
+        if timeout is None:
+            timeout = self.idle_timeout
+        timeout = timeout or None
+        more = True
+        while more:
+            start = len(data)
+            await self.read_exactly(sock, data, FRAME_HEADER.size, timeout)
+            timeout = self.client_timeout or None
+            length, kind, flags = FRAME_HEADER.unpack_from(data, start)
+            if length > MAX_FRAME or len(data) + length > MAX_MESSAGE:
+                raise ConnectionError("Mensagem grande demais")
+            await self.read_exactly(sock, data, length, timeout)
+            more = flags & FLAG_MORE
+        return data
+    
+    async def read_exactly(self, sock, data, size, timeout):
+        """Acrescenta ``size`` bytes do socket a ``data``
+        
+        Args:
+            sock (socket.socket): socket do cliente
+            data (bytearray): bytes já lidos
+            size (int): quantidade de bytes a ler
+            timeout (float): segundos de espera por cada leitura
+        
+        Raises:
+            asyncio.TimeoutError: se os bytes não chegarem a tempo
+            ConnectionError: se a conexão for encerrada antes do fim
+        
+        """
+        end = len(data) + size
+        while len(data) < end:
+            await asyncio.wait_for(self.readable(sock), timeout)
+            chunk = sock.recv(end - len(data))
+            if not chunk:
+                raise ConnectionError("Conexão encerrada")
+            data += chunk
+    
+    def offload(self, func, *args, **kwargs):
+        """Executa uma função bloqueante no executor do servidor
+        
+        Returns:
+            (asyncio.Future) resultado da função
+        
+        """
+        return self.loop.run_in_executor(
+                self.executor, lambda: func(*args, **kwargs))
+    
+    async def readable(self, sock):
+        """Aguarda, sem consumir dados, até que o socket fique legível
+        
+        Args:
+            sock (socket.socket): socket observado
+        
+        """
+        future = self.loop.create_future()
+        def ready():
+            if not future.done():
+                future.set_result(None)
+        self.loop.add_reader(sock, ready)
+        try:
+            await future
+        finally:
+            self.loop.remove_reader(sock)
+    
+    def shutdown(self):
+        """Finaliza o laço de eventos e fecha o socket principal
+        
+        """
+        if self.serving is not None:
+            self.loop.call_soon_threadsafe(self.serving.cancel)
+            self.join()
+        self.sock.close()
+        self.stop_metrics()
+        self.profiler.stop()
+
+# Servidor com vários processos
+
+def serve_process(engine, host_ip, port, root, options, shared, stopping):
+    """Processo trabalhador do MultiHost
+    
+    Substitui os dicionários de estado do módulo pelos compartilhados e
+    executa um Host (ou AsyncHost) até que chegue o sinal de ``stopping``.
+    
+    Args:
+        engine (str): 'Host' ou 'AsyncHost'
+        host_ip (str): IP do servidor
+        port (int): porta do servidor
+        root (str): diretório raiz dos arquivos
+        options (dict): demais configurações do servidor
+        shared (tuple): USR_DICT e a presença dos usuários, compartilhada
+            pelos registros de sessões de todos os processos
+        stopping (multiprocessing.connection.Connection): ponta de leitura
+            do sinal de finalização, exclusiva deste processo
+    
+    """
+    global USR_DICT, SESSIONS
+    USR_DICT, online = shared
+    SESSIONS = SessionRegistry(shared = online)
+    server = globals()[engine](host_ip, port, str(root), **options)
+    server.start()
+    try:
+        stopping.recv()
+    except EOFError:
+        pass
+    server.shutdown()
+
+
+class MultiHost(Host):
+    """Servidor que distribui as conexões entre vários processos
+    
+    Cada processo executa um Host (ou AsyncHost) completo, de modo que a
+    criptografia dos clientes usa todos os núcleos em vez de disputar o GIL.
+    No Linux cada processo abre seu próprio socket na mesma porta com
+    SO_REUSEPORT e o kernel distribui as conexões; nos demais sistemas com
+    ``fork`` os processos herdam o socket de escuta deste objeto.
+    
+    Os usuários cadastrados e os usuários conectados ficam em um
+    ``multiprocessing.Manager``, e os arquivos e compartilhamentos no banco
+    de dados, que todos os processos acessam ao mesmo tempo. Assim, o
+    ``share`` para um usuário conectado em outro processo continua
+    funcionando, embora o aviso do compartilhamento só chegue a usuários
+    conectados ao mesmo processo. Quando um processo termina, os usuários
+    conectados a ele deixam de constar como conectados.
+    
+    Example:
+        >> servidor = MultiHost(processes = 4)
+        >> servidor.start()
+    
+    """
+    def __init__(self, host_ip = Host.HOST, port = Host.PORT, root = "./root",
+                 **kwargs):
+        """Método construtor do MultiHost
+        
+        Recebe os mesmos parâmetros do Host; as demais configurações são
+        repassadas aos servidores de cada processo.
+        
+        Kwargs:
+            processes (int): quantidade de processos, por padrão a quantidade
+                de núcleos
+            engine (str): 'Host' ou 'AsyncHost', o servidor executado em cada
+                processo. Por padrão 'Host'
+        
+        """
+        global USR_DICT, SESSIONS
+        self.processes = int(kwargs.pop('processes', os.cpu_count() or 1))
+        self.engine = kwargs.pop('engine', 'Host')
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT') and \
+            sys.platform.startswith('linux')
+        if not self.reuse_port and \
+                'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError("MultiHost requer SO_REUSEPORT ou fork")
+        self.manager = multiprocessing.Manager()
+        USR_DICT = self.manager.dict(USR_DICT)
+        SESSIONS = SessionRegistry(shared = self.manager.dict())
+        self.options = dict(kwargs)
+        Host.__init__(self, host_ip, port, root,
+                      reuse_port = self.reuse_port, **kwargs)
+        self.stopping = None
+        self.workers_list = []
+    
+    def run(self, backlog = None):
+        """Inicia os processos trabalhadores e aguarda a finalização deles
+        
+        Args:
+            backlog (int): tamanho da fila de conexões não-aceitas de cada
+                processo
+        
+        """
+        # Todos os processos devem usar a mesma chave privada
+        self.save_key()
+        options = dict(self.options)
+        options['backlog'] = backlog or self.backlog
+        # A importação dos .bd e a coleta de blocos já foram feitas pelo
+        # construtor deste processo; repetidas em cada processo, disputariam
+        # os mesmos blocos
+        options['maintenance'] = False
+        port = self.sock.getsockname()[1]
+        if self.reuse_port:
+            context = multiprocessing.get_context()
+            options['reuse_port'] = True
+        else:
+            context = multiprocessing.get_context('fork')
+        # Um canal por processo: um ``multiprocessing.Event`` travaria a
+        # finalização se um processo morresse aguardando por ele. Os canais
+        # existem antes do listen, para que um ``stop`` imediato os encontre
+        signals = [context.Pipe(duplex = False)
+                   for i in range(self.processes)]
+        self.stopping = [writer for reader, writer in signals]
+        if not self.reuse_port:
+            self.sock.listen(options['backlog'])
+            options['listener'] = self.sock
+        shared = (USR_DICT, SESSIONS.shared)
+        self.workers_list = [context.Process(
+                target = serve_process, args = (
+                        self.engine, self.host_name[0], port, self.root,
+                        self.process_options(options, i), shared, reader))
+                for i, (reader, writer) in enumerate(signals)]
+        for process, (reader, writer) in zip(self.workers_list, signals):
+            process.start()
+            reader.close()
+        print("Aguardando conexões em {0} processos...".format(
+                self.processes))
+        running = {process.sentinel: process for process in self.workers_list}
+        while running:
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                process = running.pop(sentinel)
+                process.join()
+                # Um processo que falhou não encerrou as próprias sessões
+                released = SESSIONS.release(process.pid)
+                if process.exitcode:
+                    print("Processo {0} encerrado com o código {1}; {2} "
+                          "usuários liberados".format(
+                                  process.pid, process.exitcode,
+                                  len(released)))
+    
+    def shutdown(self):
+        """Sinaliza a finalização aos processos e aguarda o término deles
+        
+        """
+        if self.stopping is not None:
+            for writer in self.stopping:
+                try:
+                    writer.send(None)
+                except OSError:
+                    # O processo já terminou
+                    pass
+            self.join()
+        self.sock.close()
+    
+    def stop(self, **kwargs):
+        """Finaliza os processos, salva o estado e encerra o Manager
+        
+        Kwargs:
+            ver ``Host.stop``
+        
+        """
+        global USR_DICT, SESSIONS
+        Host.stop(self, **kwargs)
+        USR_DICT = dict(USR_DICT.items())
+        SESSIONS = SessionRegistry()
+        self.manager.shutdown()
+    
+    def process_options(self, options, index):
+        """Configurações do servidor de um processo trabalhador
+        
+        Cada processo expõe as próprias métricas, na porta ``metrics_port``
+        somada à posição do processo.
+        
+        Args:
+            options (dict): configurações comuns a todos os processos
+            index (int): posição do processo, a partir de 0
+        
+        Returns:
+            (dict) configurações do processo
+        
+        """
+        if not self.metrics_port:
+            return options
+        return dict(options, metrics_port = self.metrics_port + index)
+    
+    def metrics_summary(self):
+        """Resumo das métricas somadas de todos os processos
+        
+        As métricas de cada processo são lidas do seu servidor HTTP, por isso
+        o resumo requer um ``metrics_port`` diferente de 0.
+        
+        Returns:
+            (list) linhas do resumo
+        
+        """
+        if not self.metrics_port:
+            return ["Defina metrics_port para ver as métricas dos processos."]
+        texts = []
+        for i in range(self.processes):
+            url = "http://127.0.0.1:{0}/metrics".format(self.metrics_port + i)
+            try:
+                with urllib.request.urlopen(url, timeout = 5) as response:
+                    texts.append(response.read().decode('utf-8'))
+            except OSError:
+                continue
+        return ["{0} de {1} processos".format(len(texts), self.processes)
+                ] + summary(merge(texts))
+    
+    def profile(self, *args):
+        """Perfis não são ligados pelo menu do MultiHost
+        
+        Os perfis são de cada processo, e o menu só alcança o processo
+        principal, que não atende clientes.
+        
+        Returns:
+            (str) mensagem para o menu
+        
+        """
+        return "Perfis não disponíveis no MultiHost; use um Host."
+    
+    def connection_stats(self):
+        """Contadores do servidor com vários processos
+        
+        Returns:
+            (dict) processos ativos e usuários conectados
+        
+        """
+        return {'processos': sum(p.is_alive() for p in self.workers_list),
+                'usuários conectados': len(SESSIONS)}
+
 # Classe auxiliar do Servidor
 
 class ClientHandler(Console, threading.Thread):
-    def __init__(self, socket, client, publickey, privatekey, root):
+    # Comandos que o cliente pode chamar, registrados com ``COMMANDS.command``
+    COMMANDS = CommandRegistry()
+    
+    def __init__(self, socket, client, publickey, privatekey, root,
+                 session = True, **kwargs):
         """Método construtor do ajudante
         
-        Esse método realiza a troca de chaves com o cliente.
+        Esse método realiza a troca de chaves com o cliente e, no modo de
+        sessão, envia a chave simétrica que cifrará o restante da conexão.
         
         Args:
             socket (socke.socket): socket pelo qual a comunicação acontecerá
             publickey (bytes): inicializador da chave pública (fornecido pelo
                 Host)
             root (pathlib.Path):
+            session (bool): True para ativar o modo de sessão AES-GCM
+        
+        Kwargs:
+            chunk_size (int): tamanho dos segmentos enviados nos downloads
+            window (int): janela de créditos dos downloads
+            encrypt_files (bool): False para enviar arquivos sem cifrar
+            compression (str): compressores aceitos pelo servidor
+            binary (bool): False para não aceitar o modo binário
+            pipeline (bool): False para não aceitar comandos em paralelo
+            idle_timeout (float): segundos de espera por uma mensagem do
+                cliente antes de encerrar a sessão, ou 0 para esperar sempre
+            store (MetadataStore): banco de dados de arquivos do servidor. Por
+                padrão o banco ".metadata.db" dentro de ``root``
+            journal (UserJournal): diário onde os cadastros são gravados
+            blobs (BlobStore): armazenamento de blocos do servidor. Por
+                padrão o diretório ".blobs" dentro de ``root``
+            secret (bytes): segredo usado para assinar os bilhetes dos canais
+                de dados. Por padrão derivado de ``privatekey``
+            metrics (Metrics): métricas do servidor, atualizadas pela sessão
+            profiler (Profiler): perfis de execução do servidor, que medem a
+                troca de chaves e os comandos enquanto estiverem ligados
+            cache (FileCache): cache de arquivos do servidor, usado nos
+                downloads. Por padrão, nenhum
+            inbox (bytes): frames da chave e dos recursos do cliente já
+                lidos; nesse caso a chave pública do servidor já foi enviada
         """
-        Console.__init__(self, sock = socket)
+        Console.__init__(self, sock = socket, **kwargs)
         threading.Thread.__init__(self)
+        self.metrics = kwargs.get('metrics') or Metrics()
+        self.profiler = kwargs.get('profiler') or Profiler()
+        self.cache = kwargs.get('cache') or FileCache(0)
+        self.sock.settimeout(kwargs.get('idle_timeout') or None)
         self.client = client
+        self.expired = False
+        # Comandos em paralelo: requisição em execução em cada thread, as
+        # threads que os executam (criadas no primeiro comando em paralelo) e
+        # as requisições ainda sem resposta
+        self.local = threading.local()
+        self.send_lock = threading.Lock()
+        self.executor = None
+        self.inflight = set()
+        self.slots = threading.BoundedSemaphore(PIPELINE_DEPTH)
         self.privatekey = privatekey
-        self.sock.send(publickey)
-        self.publickey = self.receive_key()
+        self.secret = kwargs.get('secret') or hashlib.sha256(
+                privatekey.exportKey()).digest()
+        # Chave dos bilhetes de retomada de sessão
+        self.ticket_key = hashlib.sha256(b'retomada' + self.secret).digest()
         self.root = self.directory = root
-        self.usr_bd = dict()
         self.running = True
         self.usr = 'guest'
+        self.channel = False
+        # Comandos aceitos em um canal, ou None para todos
+        self.commands = None
+        # Usuário de um bilhete de retomada aceito na troca de chaves
+        self.resumed = None
+        # Bytes do cliente já lidos pelo AsyncHost, consumidos antes do socket
+        self.inbox = kwargs.get('inbox')
+        if self.inbox is not None:
+            self.inbox = memoryview(self.inbox)
+        if self.profiler.active:
+            self.profiler.call(self, 'handshake', self.handshake, publickey,
+                               session)
+        else:
+            self.handshake(publickey, session)
+        self.store = kwargs.get('store') or MetadataStore(
+                root.joinpath(METADATA_FILE))
+        self.journal = kwargs.get('journal')
+        self.blobs = kwargs.get('blobs') or BlobStore(
+                root.joinpath(BLOBS_DIR))
 
     def run(self):
         """Processo principal da Thread do Handler
         
         """
-        global CLIENT_COUNTER
+        try:
+            self.welcome()
+            while self.step():
+                pass
+        except OSError:
+            # Conexão perdida, ou cliente sem resposta, no meio de um comando
+            pass
+        finally:
+            self.close()
+    
+    def handshake(self, publickey, session):
+        """Troca de chaves com o cliente logo após a conexão
         
-        self.send("TCPy Server\nFaça login ou cadastre-se para continuar.")
-        while True:
+        Envia a chave pública do servidor, recebe a do cliente e os recursos
+        aceitos, e envia a chave de sessão e os recursos escolhidos. Se a
+        chave do cliente vier com um bilhete válido (ver ``retomada``), os
+        recursos chegam cifrados com a chave do bilhete, a nova chave de
+        sessão segue cifrada com ela, sem o RSA, e o usuário do bilhete entra
+        sem login em ``welcome``. Os recursos de um bilhete que não pode ser
+        aberto são descartados, e a conexão segue sem eles.
+        
+        Args:
+            publickey (bytes): inicializador da chave pública do servidor
+            session (bool): True para ativar o modo de sessão
+        
+        Raises:
+            ValueError: se a chave do cliente ou o bilhete estiverem
+                malformados; no caso do bilhete, a conexão é recusada
+        
+        """
+        if self.inbox is None:
+            self.send_key(publickey)
+        key = self.recv_frame(FRAME_KEY)
+        flags = self.frame_flags
+        ticket = None
+        if flags & FLAG_RESUME:
+            start = RSA_LENGTH.size
+            size = RSA_LENGTH.unpack_from(key)[0] if len(key) >= start else -1
+            if size < 0 or start + size > len(key):
+                # Sem o tamanho do bilhete não há como achar a chave pública
+                # que vem depois dele
+                self.refuse(self.sock, "Bilhete de retomada malformado.")
+                raise ValueError("Bilhete de retomada malformado")
+            ticket = self.open_ticket(bytes(key[start:start + size]))
+            key = key[start + size:]
+            if ticket is not None:
+                self.session_key = ticket[2]
+        self.publickey = import_key(bytes(key))
+        # Clientes anteriores à negociação não enviam os recursos
+        offered = None
+        if flags & FLAG_FEATURES:
+            if flags & FLAG_RESUME and ticket is None:
+                self.recv_frame(FRAME_MSG)
+                offered = ''
+            else:
+                offered = self.receive()
+        resumed = bool(session and ticket and ticket[1] >= time.time() and
+                       ticket[0] in USR_DICT)
+        if resumed:
+            self.resumed = ticket[0]
+        else:
+            self.session_key = None
+        self.offer_session(session, resumed)
+        if offered is not None:
+            self.choose_features(offered)
+    
+    def open_ticket(self, ticket):
+        """Abre um bilhete de retomada de sessão
+        
+        Args:
+            ticket (bytes): bilhete apresentado pelo cliente
+        
+        Returns:
+            (tuple) usuário, validade e chave do bilhete, ou None se o
+                bilhete não foi emitido por este servidor
+        
+        """
+        try:
+            usr, expiry, key = self.unseal(
+                    ticket, key = self.ticket_key).decode().split(' ')
+            return usr, int(expiry), bytes.fromhex(key)
+        except ValueError:
+            return None
+    
+    def welcome(self):
+        """Envia a mensagem de boas-vindas ao cliente
+        
+        Se a sessão foi retomada, o usuário do bilhete entra sem login, a
+        menos que já tenha outra sessão aberta.
+        
+        """
+        if self.resumed is not None and self.enter(self.resumed):
+            self.send("TCPy Server\nSessão retomada: " + self.usr)
+        else:
+            self.send("TCPy Server\nFaça login ou cadastre-se para continuar.")
+    
+    def step(self):
+        """Recebe e executa um único comando do cliente
+        
+        Um comando com id de requisição ("#<id> <comando>") é entregue às
+        threads de comandos em paralelo e o método retorna sem aguardar a
+        resposta. Antes de um comando comum, que pode trocar várias mensagens
+        com o cliente, os comandos em paralelo pendentes são concluídos.
+        
+        Returns:
+            (bool) False quando o cliente encerra a sessão, True caso
+                contrário
+        
+        """
+        try:
             msg = self.receive()
-            cmd = msg.split(' ')
-            if cmd[0] == "sair":
-                break
-            try:
-                self.__getattribute__(cmd[0])(*cmd[1:])
-            except KeyError as k:
-                raise k
-            except TypeError:
-                self.send("Parâmetros incorretos!\nUse o comando 'ajuda'" +
-                          " para mais informações!")
-            except AttributeError:
+        except socket.timeout:
+            self.expire()
+            return False
+        except ConnectionError:
+            return False
+        if self.pipeline_wire and msg.startswith('#'):
+            tag, _, msg = msg.partition(' ')
+            self.submit(tag[1:], msg.split(' '))
+            return True
+        cmd = msg.split(' ')
+        if cmd[0] == "sair":
+            return False
+        self.drain()
+        self.execute(cmd)
+        return True
+    
+    def execute(self, cmd):
+        """Executa um comando registrado em ``COMMANDS``
+        
+        Args:
+            cmd (list): nome do comando seguido dos argumentos
+        
+        """
+        entry = self.COMMANDS.get(cmd[0])
+        if entry is None or (self.commands is not None and
+                             cmd[0] not in self.commands):
+            self.send("Comando inválido!")
+            return
+        labels = (('command', entry.name),)
+        start = time.perf_counter()
+        try:
+            if self.profiler.active:
+                self.profiler.call(self, entry.name, entry.function, self,
+                                   *cmd[1:])
+            else:
+                entry.function(self, *cmd[1:])
+        except TypeError:
+            self.send("Parâmetros incorretos!\nUse o comando 'ajuda'" +
+                      " para mais informações!")
+        except Exception:
+            self.metrics.add('tcpy_command_errors_total', 1, labels)
+            raise
+        finally:
+            self.metrics.add('tcpy_commands_total', 1, labels)
+            self.metrics.observe('tcpy_command_seconds',
+                                 time.perf_counter() - start, labels)
+    
+    def submit(self, tag, cmd):
+        """Agenda um comando em paralelo
+        
+        Com ``PIPELINE_DEPTH`` comandos pendentes, aguarda até que um deles
+        termine, deixando de ler o socket enquanto isso.
+        
+        Args:
+            tag (str): id da requisição, escolhido pelo cliente
+            cmd (list): nome do comando seguido dos argumentos
+        
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                    PIPELINE_WORKERS)
+        self.slots.acquire()
+        future = self.executor.submit(self.serve_request, tag, cmd)
+        self.inflight.add(future)
+        future.add_done_callback(self.inflight.discard)
+    
+    def serve_request(self, tag, cmd):
+        """Executa um comando em paralelo, marcando as respostas com o id
+        
+        Cada mensagem do comando segue como "+<id> <mensagem>", e a última
+        como "#<id> <mensagem>", o que indica ao cliente o fim da resposta.
+        Comandos que trocam outras mensagens com o cliente são recusados. Um
+        erro no comando termina a resposta com uma mensagem de erro, para
+        que o cliente não fique aguardando.
+        
+        Args:
+            tag (str): id da requisição
+            cmd (list): nome do comando seguido dos argumentos
+        
+        """
+        request = self.local.request = [tag, None]
+        try:
+            entry = self.COMMANDS.get(cmd[0])
+            if entry is None or not entry.pipeline:
                 self.send("Comando inválido!")
+            else:
+                self.execute(cmd)
+        except OSError:
+            # Conexão perdida: não há a quem responder
+            return
+        except Exception:
+            traceback.print_exc()
+            self.send("Erro ao executar o comando!")
+        finally:
+            self.local.request = None
+            self.slots.release()
+        with self.send_lock:
+            Console.send(self, '#{0} {1}'.format(tag, '' if request[1] is None
+                                                 else request[1]),
+                         self.notice_flags())
+    
+    def drain(self):
+        """Aguarda o fim dos comandos em paralelo pendentes
+        
+        """
+        if self.inflight:
+            concurrent.futures.wait(list(self.inflight))
+    
+    def send(self, msg):
+        """Envia uma mensagem ao cliente
+        
+        Durante um comando em paralelo, a mensagem é marcada com o id da
+        requisição; as threads dos comandos em paralelo compartilham o socket,
+        por isso cada envio é feito de uma vez. Se houver avisos para o
+        usuário, a mensagem segue com ``FLAG_NOTICE``, e o cliente pode
+        buscá-los com o comando 'avisos'.
+        
+        Args:
+            msg (str ou bytes): mensagem a ser enviada
+        
+        """
+        request = getattr(self.local, 'request', None)
+        if request is None:
+            with self.send_lock:
+                Console.send(self, msg, self.notice_flags())
+            return
+        if request[1] is not None:
+            with self.send_lock:
+                Console.send(self, '+{0} {1}'.format(*request),
+                             self.notice_flags())
+        request[1] = msg
+    
+    def notice_flags(self):
+        """Flags que indicam ao cliente se há avisos pendentes
+        
+        Returns:
+            (int) ``FLAG_NOTICE`` se houver avisos para a sessão, 0 caso
+                contrário
+        
+        """
+        if self.usr != 'guest' and SESSIONS.pending(self.usr) and \
+                SESSIONS.session(self.usr) is self:
+            return FLAG_NOTICE
+        return 0
+    
+    def decompress(self, data, flags, limit = MAX_MESSAGE):
+        """Descomprime um trecho do cliente (ver ``Console.decompress``)
+        
+        Trechos comprimidos só são aceitos depois do login, para que um
+        cliente não autenticado não obrigue o servidor a descomprimi-los.
+        
+        Raises:
+            ConnectionError: se o trecho vier comprimido antes do login
+        
+        """
+        if flags & FLAG_COMPRESSED and self.usr == 'guest':
+            raise ConnectionError("Trecho comprimido antes do login")
+        return Console.decompress(self, data, flags, limit)
+    
+    def send_frame(self, payload, kind = FRAME_MSG, flags = 0):
+        """Envia um frame (ver ``Console.send_frame``), contando os bytes
+        
+        """
+        if not self.profiler.active:
+            Console.send_frame(self, payload, kind, flags)
+        else:
+            start = time.perf_counter()
+            Console.send_frame(self, payload, kind, flags)
+            self.profiler.stage('rede', time.perf_counter() - start)
+        frames = max(1, -(-len(payload) // MAX_FRAME))
+        self.metrics.add('tcpy_bytes_total',
+                         len(payload) + frames * FRAME_HEADER.size, LABELS_OUT)
+    
+    def recv_into(self, view):
+        """Recebe bytes do socket (ver ``Console.recv_into``), contando-os
+        
+        Os bytes já lidos pelo AsyncHost (``inbox``) são consumidos antes.
+        
+        """
+        size = len(view)
+        if self.inbox:
+            n = min(size, len(self.inbox))
+            view[:n], self.inbox = self.inbox[:n], self.inbox[n:]
+            view = view[n:]
+        if view and not self.profiler.active:
+            Console.recv_into(self, view)
+        elif view:
+            start = time.perf_counter()
+            Console.recv_into(self, view)
+            self.profiler.stage('rede', time.perf_counter() - start)
+        self.metrics.add('tcpy_bytes_total', size, LABELS_IN)
+    
+    def send_raw(self, parts, size, chunk):
+        """Envio sem cópias (ver ``Console.send_raw``), contando os bytes
+        
+        """
+        sent = 0
+        start = time.perf_counter()
+        for p in Console.send_raw(self, parts, size, chunk):
+            if self.profiler.active:
+                self.profiler.stage('rede', time.perf_counter() - start)
+            self.metrics.add('tcpy_bytes_total', p.done - sent, LABELS_OUT)
+            sent = p.done
+            yield p
+            start = time.perf_counter()
+    
+    def encrypt(self, msg, flags = 0):
+        """Cifra uma mensagem (ver ``Console.encrypt``)
+        
+        No modo de sessão o tempo é medido em ``seal``; aqui, apenas o do RSA.
+        
+        """
+        if self.session_key is not None:
+            return Console.encrypt(self, msg, flags)
+        start = time.perf_counter()
+        try:
+            return Console.encrypt(self, msg, flags)
+        finally:
+            self.crypto_time('rsa', 'encrypt', start)
+    
+    def decrypt(self, msg, flags = 0):
+        """Decifra uma mensagem (ver ``Console.decrypt``)
+        
+        No modo de sessão o tempo é medido em ``unseal``; aqui, apenas o do
+        RSA.
+        
+        """
+        if self.session_key is not None:
+            return Console.decrypt(self, msg, flags)
+        start = time.perf_counter()
+        try:
+            return Console.decrypt(self, msg, flags)
+        finally:
+            self.crypto_time('rsa', 'decrypt', start)
+    
+    def seal(self, data, flags = 0, key = None):
+        """Cifra com AES-GCM (ver ``Console.seal``), medindo o tempo
+        
+        """
+        start = time.perf_counter()
+        try:
+            return Console.seal(self, data, flags, key)
+        finally:
+            self.crypto_time('aes', 'encrypt', start)
+    
+    def unseal(self, data, flags = 0, key = None):
+        """Decifra com AES-GCM (ver ``Console.unseal``), medindo o tempo
+        
+        """
+        start = time.perf_counter()
+        try:
+            return Console.unseal(self, data, flags, key)
+        finally:
+            self.crypto_time('aes', 'decrypt', start)
+    
+    def crypto_time(self, stage, op, start):
+        """Registra a duração de uma cifra ou decifra nas métricas e no perfil
+        
+        Args:
+            stage (str): 'rsa' ou 'aes', a etapa no perfil
+            op (str): 'encrypt' ou 'decrypt'
+            start (float): início da operação, em ``time.perf_counter``
+        
+        """
+        elapsed = time.perf_counter() - start
+        self.metrics.crypto(op, elapsed)
+        if self.profiler.active:
+            self.profiler.stage(stage, elapsed)
+    
+    def expire(self):
+        """Encerra uma sessão ociosa, avisando o cliente do motivo
+        
+        """
+        self.expired = True
+        self.refuse(self.sock, "Sessão encerrada por inatividade.")
+    
+    def close(self):
+        """Encerra a sessão do usuário
+        
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
         self.sock.close()
-        CLIENT_COUNTER -= 1
-        if self.usr != 'guest':
-            del CLIENT_DICT[self.usr]
+        SESSIONS.disconnect()
+        if self.usr != 'guest' and not self.channel:
+            SESSIONS.logout(self.usr, self)
         self.running = False
         print("Conexão com", self.client, "encerrada")
-        self.generate_bdfile(str(self.directory.joinpath(self.usr+'.bd')),
-                             self.usr_bd)
     
+    @COMMANDS.command(pipeline = True)
     def share (self, filename, usr):
         """Método de compartilhamento de arquivos com outros usuários
         
+        Se o usuário estiver conectado, recebe um aviso do compartilhamento
+        (ver ``avisos``).
+        
         Args:
             filename (str): nome do arquivo
             usr (str): nome do usuário
             
         """
-        if not filename in self.usr_bd:
-            self.send("Arquivo inexistente")
-        elif not usr in USR_DICT:
+        if not usr in USR_DICT:
             self.send("Usuário não encontrado")
+        elif not self.store.share(self.usr, filename, usr):
+            self.send("Arquivo inexistente")
         else:
-            if usr in CLIENT_DICT:
-                CLIENT_DICT[usr].usr_bd[filename] = self.usr_bd[filename]
-            else:
-                file = self.root.joinpath(usr).joinpath(usr+'.bd').open('a')
-                text_line = filename+' '+' '.join(self.usr_bd[filename])+'\n'
-                file.write(text_line)
-                file.close()
+            SESSIONS.notify(usr, "{0} compartilhou {1} com você".format(
+                    self.usr, filename))
             self.send(filename+" compartilhado com "+usr)
+    
+    @COMMANDS.command(pipeline = True)
+    def avisos(self):
+        """Envia e descarta os avisos pendentes do usuário
+        
+        Os avisos seguem em uma única mensagem, um por linha, ou vazia se não
+        houver nenhum.
+        
+        """
+        if self.usr == 'guest' or self.channel:
+            self.send("Comando inválido!")
+        else:
+            self.send('\n'.join(SESSIONS.notices(self.usr, self)))
 
+    @COMMANDS.command()
     def ajuda(self):
         """Método de envio de ajuda do servidor.
         
@@ -404,18 +1793,50 @@ class ClientHandler(Console, threading.Thread):
                 ack = self.receive()
             self.send('0')
     
-    def show(self):
+    @COMMANDS.command(pipeline = True)
+    def show(self, *options):
         """Método de exibição dos arquivos disponíveis
         
+        Os arquivos são enviados em lotes de ``LIST_BATCH`` linhas no formato
+        "nome\tproprietário\tdata", sem confirmação do cliente. A listagem
+        termina com "EOF <exibidos> <total>", ou "EOF <erro>" se as opções
+        forem inválidas.
+        
+        Args:
+            *options (str): opções no formato chave=valor: prefixo, ordem
+                ('nome', 'dono' ou 'data'), pagina (a partir de 1) e limite
+                (arquivos por página, 0 para todos)
+        
         """
-        info = "{0}\nProprietário: {1}, Última atualização: {2}\n"
-        for file in self.usr_bd:
-            print(file, self.usr_bd[file])
-            self.send(info.format(file, self.usr_bd[file][0],
-                                  self.usr_bd[file][1]))
-            ack = self.receive()
-        self.send('EOF')
+        try:
+            options = dict(option.split('=', 1) for option in options)
+            prefix = options.pop('prefixo', '')
+            order = options.pop('ordem', 'nome')
+            page = int(options.pop('pagina', 1))
+            limit = int(options.pop('limite', 0))
+            files = self.store.files(self.usr, prefix, order,
+                                     (page - 1) * limit, limit or None)
+            if options or page < 1 or limit < 0:
+                raise ValueError
+        except (KeyError, ValueError):
+            self.send("EOF Opções inválidas! Use o comando 'ajuda' para " +
+                      "mais informações!")
+            return
+        shown = 0
+        batch = []
+        for entry in files:
+            batch.append('\t'.join(entry))
+            if len(batch) == LIST_BATCH:
+                self.send('\n'.join(batch))
+                shown += len(batch)
+                batch = []
+        if batch:
+            self.send('\n'.join(batch))
+            shown += len(batch)
+        self.send('EOF {0} {1}'.format(shown,
+                                       self.store.count(self.usr, prefix)))
             
+    @COMMANDS.command()
     def login(self, usr, psw):
         """Método de Login
         
@@ -426,19 +1847,15 @@ class ClientHandler(Console, threading.Thread):
             psw (str): senha do usuário
         
         """
-        if usr in CLIENT_DICT:
+        if SESSIONS.online(usr):
             self.send("Sessão em andamento!")
-        if self.usr == 'guest':
+        elif self.usr == 'guest':
             if usr in USR_DICT:
                 if USR_DICT[usr] == psw:
-                    self.usr = usr
+                    if not self.enter(usr):
+                        self.send("Sessão em andamento!")
+                        return
                     self.send('1')
-                    self.directory = self.root.joinpath(usr)
-                    self.usr_bd.update(
-                            self.recover_bdfile(
-                                    str(self.directory.joinpath(usr+'.bd'))))
-                    print(self.usr + ' efetuou login de ' + str(self.client))
-                    CLIENT_DICT[self.usr] = self
                 else:
                     self.send("Senha incorreta!")
             else:
@@ -446,12 +1863,53 @@ class ClientHandler(Console, threading.Thread):
         else:
             self.send("Comando inválido!")
     
+    def enter(self, usr):
+        """Abre a sessão de um usuário autenticado nesta conexão
+        
+        Args:
+            usr (str): nome de usuário
+        
+        Returns:
+            (bool) False se o usuário já tiver uma sessão aberta
+        
+        """
+        if not SESSIONS.login(usr, self):
+            return False
+        self.usr = usr
+        self.directory = self.root.joinpath(usr)
+        print(self.usr + ' efetuou login de ' + str(self.client))
+        return True
+    
+    @COMMANDS.command(pipeline = True)
+    def retomada(self):
+        """Emite um bilhete de retomada de sessão
+        
+        O bilhete guarda, cifrados com uma chave conhecida só pelo servidor, o
+        usuário, a validade e uma chave nova, enviada ao cliente junto com o
+        bilhete. Ao se reconectar, o cliente apresenta o bilhete na troca de
+        chaves e usa essa chave no lugar do RSA, entrando sem login (ver
+        ``handshake``). Nenhum estado fica no servidor, de modo que o bilhete
+        vale em todos os processos do MultiHost e após um reinício, por
+        ``RESUME_TTL`` segundos. Responde "<bilhete> <chave> <validade>", com
+        o bilhete e a chave em hexadecimal.
+        
+        """
+        if self.usr == 'guest' or self.channel or self.session_key is None:
+            self.send("Comando inválido!")
+            return
+        key = os.urandom(SESSION_KEY_SIZE)
+        expiry = int(time.time()) + RESUME_TTL
+        ticket = self.seal('{0} {1} {2}'.format(self.usr, expiry,
+                                                key.hex()).encode(),
+                           key = self.ticket_key)
+        self.send('{0} {1} {2}'.format(ticket.hex(), key.hex(), expiry))
+    
+    @COMMANDS.command()
     def signup(self, usr, psw):
         """Método de Cadastro
         
         Método que controla a rotina de cadastro no servidor, criando uma nova
-        pasta para o usuário dentro da pasta root do servidor, assim como um
-        relatório de banco de dados "files.bd" no interior da pasta.
+        pasta para o usuário dentro da pasta root do servidor.
         
         Args:
             usr (str): nome de usuário a ser cadastrado deve ser único
@@ -459,117 +1917,506 @@ class ClientHandler(Console, threading.Thread):
             
         """
         if self.usr == 'guest':
-            if usr in USR_DICT:
+            with SIGNUP_LOCK:
+                taken = usr in USR_DICT or usr in SIGNUPS
+                if not taken:
+                    SIGNUPS.add(usr)
+            if taken:
                 self.send("Usuário já cadastrado")
             else:
+                # O cadastro só é confirmado depois de chegar ao disco; o nome
+                # fica reservado enquanto isso, sem travar outros cadastros
+                try:
+                    if self.journal is not None:
+                        self.journal.append(usr, psw)
+                    USR_DICT[usr] = psw
+                finally:
+                    with SIGNUP_LOCK:
+                        SIGNUPS.discard(usr)
                 self.send("1")
-                USR_DICT[usr] = psw
                 _dir = self.directory.joinpath(usr)
                 try:
                     _dir.mkdir()
                 except FileExistsError:
                     pass
-                finally:
-                    bd = open(str(_dir.joinpath(usr+'.bd')), 'w')
-                    bd.close()
                 ack = self.receive()
                 self.login(usr, psw)
         else:
             self.send("Comando inválido!")
     
-    def post(self, file_address):
+    @COMMANDS.command()
+    def canal(self, usr = None, ticket = None, mode = 'dados'):
+        """Método dos canais de dados
+        
+        Em uma sessão autenticada, sem argumentos, envia um bilhete válido por
+        ``CHANNEL_TTL`` segundos. Em uma nova conexão, "canal <usr>
+        <bilhete>" a transforma em um canal de dados do usuário, que aceita
+        apenas os comandos de ``CHANNEL_COMMANDS`` e não conta como uma
+        sessão aberta. Os canais permitem que o cliente transfira partes de
+        um mesmo arquivo por várias conexões ao mesmo tempo.
+        
+        No modo 'sessao' ("canal <usr> <bilhete> sessao"), a conexão aceita os
+        comandos de ``POOL_COMMANDS``: é uma sessão adicional do usuário,
+        usada pelo conjunto de conexões do cliente (``ClientPool``) para
+        atender vários comandos ao mesmo tempo.
+        
+        Args:
+            usr (str): nome do usuário
+            ticket (str): bilhete recebido na sessão do usuário
+            mode (str): 'dados' ou 'sessao'
+        
+        """
+        modes = {'dados': CHANNEL_COMMANDS, 'sessao': POOL_COMMANDS}
+        if usr is None:
+            if self.usr == 'guest':
+                self.send("Comando inválido!")
+            else:
+                self.send(self.ticket())
+        elif self.usr != 'guest' or usr not in USR_DICT or mode not in modes:
+            self.send("Comando inválido!")
+        else:
+            expiry, _, mac = str(ticket).partition('-')
+            if (not expiry.isdigit() or int(expiry) < time.time() or
+                    not hmac.compare_digest(mac, self.sign(usr, expiry))):
+                self.send("Bilhete inválido!")
+            else:
+                self.usr = usr
+                self.channel = True
+                self.commands = modes[mode]
+                self.directory = self.root.joinpath(usr)
+                self.send('1')
+    
+    def ticket(self):
+        """Bilhete para abrir canais de dados do usuário da sessão
+        
+        Returns:
+            (str) "<expiração>-<assinatura>"
+        
+        """
+        expiry = str(int(time.time()) + CHANNEL_TTL)
+        return expiry + '-' + self.sign(self.usr, expiry)
+    
+    def sign(self, usr, expiry):
+        """Assinatura do bilhete de um canal de dados
+        
+        Args:
+            usr (str): nome do usuário
+            expiry (str): instante de expiração do bilhete
+        
+        Returns:
+            (str) HMAC-SHA256 hexadecimal
+        
+        """
+        return hmac.new(self.secret, (usr + ' ' + expiry).encode(),
+                        hashlib.sha256).hexdigest()
+    
+    @COMMANDS.command()
+    def trecho(self, file, start, length):
+        """Recebe, por um canal de dados, um trecho de um envio em paralelo
+        
+        O trecho é gravado na posição ``start`` do arquivo de trechos
+        literais do envio, que a sessão do usuário já reservou com o tamanho
+        final. Responde "ok" antes e depois do recebimento.
+        
+        Args:
+            file (str): nome do arquivo sendo enviado
+            start (str): posição do trecho nos trechos literais
+            length (str): tamanho do trecho
+        
+        """
+        state = self.store.upload(self.usr, file)
+        if not (start.isdigit() and length.isdigit()) or state is None:
+            self.send("Envio inexistente")
+            return
+        path = state[1]
+        start, length = int(start), int(length)
+        if not os.path.exists(path) or (start + length >
+                                        os.path.getsize(path)):
+            self.send("Trecho inválido!")
+            return
+        self.send('ok')
+        for b in self.receive_file(None, [(path, start, length)]):
+            pass
+        self.send('ok')
+    
+    @COMMANDS.command()
+    def post(self, file_address, name = None):
         """Método que controla o upload de um arquivo
         
         Esse método controla o upload de um arquivo para o diretório do usuário
         sem se preocupar com qual a versão do arquivo.
         
+        O cliente envia "<tamanho> <bloco> <hash> <hash>..." com o hash de
+        cada bloco, e o servidor responde "<n> <índice>..." com os blocos que
+        ainda não tem. Um arquivo cujo conteúdo o servidor já tem é
+        registrado sem envio de dados. Manifestos com hashes que não são
+        SHA-256 em hexadecimal ou com blocos maiores que ``MAX_BLOCK`` são
+        recusados.
+        
+        Se faltar algum bloco e o usuário já tiver uma versão do arquivo, o
+        servidor reserva os blocos dela até registrar a nova versão e envia
+        as assinaturas dela (veja o módulo ``delta``), ou "-" caso
+        contrário. O cliente responde com as operações que reconstroem
+        os blocos que faltam a partir da versão antiga e envia apenas os
+        trechos literais. Cada bloco reconstruído é conferido com o hash do
+        manifesto, e o arquivo só é substituído depois que todos foram
+        verificados. Operações malformadas, que copiam blocos inexistentes
+        ou cujos literais excedem os blocos que faltam são recusadas com
+        "Operações inválidas!".
+        
+        Antes dos trechos literais, o servidor informa quantos bytes deles já
+        tem, de um envio anterior do mesmo conteúdo que foi interrompido, e o
+        cliente continua a partir desse ponto. O cliente responde "-" para
+        enviá-los por esta conexão ou "canais" para enviá-los em paralelo
+        pelos canais de dados (veja ``receive_channels``).
+        
         Args:
             file_address (str): endereço do arquivo na máquina do cliente
+            name (str): nome do arquivo no servidor, por padrão o nome do
+                arquivo em ``file_address``
             
         """
+        filename = name or ntpath.basename(file_address)
+        if not valid_name(filename):
+            self.send("Nome inválido!")
+            return
         self.send("ack")
-        filename = ntpath.basename(file_address)
-        for b in self.receive_file(str(self.directory.joinpath(filename))):
-            pass
-        print(str(b) + ' bytes recebidos de '+ str(self.client))
-        self.usr_bd[filename] = (self.usr, str(datetime.datetime.now()))
+        info = self.receive().split()
+        try:
+            size, block, hashes = int(info[0]), int(info[1]), info[2:]
+        except (IndexError, ValueError):
+            self.send("Manifesto inválido!")
+            return
+        if size < 0 or not 0 < block <= MAX_BLOCK or \
+                len(hashes) != -(-size // block) or \
+                not all(valid_digest(digest) for digest in hashes):
+            self.send("Manifesto inválido!")
+            return
+        sizes = [min(block, size - i * block) for i in range(len(hashes))]
+        missing = self.store.pin(hashes, sizes)
+        wanted = []
+        for i, digest in enumerate(hashes):
+            if digest in missing:
+                wanted.append(i)
+                missing.discard(digest)
+        self.send(' '.join(str(n) for n in [len(wanted)] + wanted))
+        temps = [self.blobs.temp(hashes[i]) for i in wanted]
+        literals = None
+        # Blocos reservados da versão anterior, base das operações do delta
+        base = []
+        b = Progress(0, 0, 0)
+        try:
+            if wanted:
+                old_parts, block_sigs, blocks = [], delta.DELTA_BLOCK, 0
+                try:
+                    old_parts = self.content_parts(filename, base)[1]
+                except KeyError:
+                    self.send('-')
+                else:
+                    sigs = delta.signatures(old_parts)
+                    block_sigs, blocks = sigs[0], len(sigs[2])
+                    self.send(delta.encode_signatures(sigs))
+                msg = self.receive()
+                try:
+                    # Os literais só reconstroem os blocos que faltam
+                    ops = delta.decode_ops(msg, blocks, sum(
+                            sizes[i] for i in wanted))
+                except ValueError:
+                    self.store.release(hashes + base)
+                    self.send("Operações inválidas!")
+                    return
+                total = sum(op[1] for op in ops if op[0] == 'l')
+                key = hashlib.sha256('\n'.join(
+                        [self.usr, filename, ' '.join(info), msg]).encode()
+                                     ).hexdigest()
+                literals, offset = self.resume_upload(filename, key, total)
+                self.send(str(offset))
+                try:
+                    if self.receive() == 'canais':
+                        b = self.receive_channels(filename, key, literals,
+                                                  offset, total)
+                        if b is None:
+                            # Os trechos já gravados não são conhecidos, então
+                            # a retomada parte do ponto anterior
+                            self.store.release(hashes + base)
+                            literals = None
+                            self.send("Erro: falha no envio de " + filename +
+                                      " pelos canais de dados")
+                            return
+                    else:
+                        for b in self.receive_file(
+                                None, [(literals, offset, total - offset)]):
+                            pass
+                except Exception:
+                    # Os dados recebidos ficam guardados para a retomada
+                    self.store.save_upload(self.usr, filename, key, literals,
+                                           offset + b.done)
+                    literals = None
+                    raise
+                self.store.end_upload(self.usr, filename)
+            valid = []
+            writer = PartWriter([(tmp, 0, sizes[i]) for
+                                 tmp, i in zip(temps, wanted)])
+            try:
+                if wanted and delta.apply(ops, old_parts, block_sigs,
+                                          literals, writer) == sum(
+                                                  sizes[i] for i in wanted):
+                    writer.close()
+                    valid = [hashes[i] for tmp, i in zip(temps, wanted)
+                             if self.blobs.commit(tmp, hashes[i])]
+            except (ValueError, EOFError, StopIteration):
+                pass
+            finally:
+                writer.close()
+        except Exception:
+            self.store.release(hashes + base)
+            raise
+        finally:
+            for tmp in temps:
+                self.blobs.discard(tmp)
+            if literals is not None:
+                self.blobs.discard(literals)
+        self.store.stored(valid)
+        if len(valid) < len(wanted):
+            self.store.release(hashes + base)
+            self.send("Erro: bloco corrompido durante o envio de " + filename)
+            return
+        print('{0} bytes recebidos de {1} ({2:.2f} MB/s), {3} de {4} blocos'
+              .format(b.done, self.client, b.rate, len(wanted), len(hashes)))
+        self.metrics.transfer('in', b.done, b.elapsed)
+        self.store.add(self.usr, filename, str(datetime.datetime.now()),
+                       size, block, hashes)
+        self.store.release(base)
+        # Versão anterior guardada fora do armazenamento de blocos
+        legacy = self.directory.joinpath(filename)
+        if legacy.exists():
+            os.remove(str(legacy))
+            self.cache.invalidate(legacy)
+        self.store.collect(self.remove_blob)
+        self.send("{0} salvo ({1} de {2} blocos novos, {3} bytes enviados)"
+                  .format(filename, len(wanted), len(hashes), b.done))
     
-    def get(self, file):
-        """Método usado para baixar o arquivo do servidor
+    def receive_channels(self, filename, key, literals, offset, total):
+        """Aguarda os trechos literais de um envio feito pelos canais de dados
+        
+        O arquivo dos trechos é reservado com o tamanho final e o envio é
+        registrado, para que os canais (com ``trecho``) encontrem onde gravar,
+        e o servidor responde "ok <bilhete>" (veja ``canal``). O cliente avisa com "fim" quando todos os canais terminaram, ou com
+        "falha"; os blocos são conferidos depois, com os hashes do manifesto.
         
         Args:
-            file (str): nome do arquivo no banco de dados do usuário
+            filename (str): nome do arquivo
+            key (str): identificação do envio
+            literals (str): endereço do arquivo dos trechos literais
+            offset (int): bytes já recebidos de um envio interrompido
+            total (int): quantidade de bytes literais do envio
+        
+        Returns:
+            (Progress) bytes recebidos pelos canais e taxa alcançada, ou None
+                se o cliente avisar uma falha
         
         """
-        filename = str(self.root.joinpath(self.usr_bd[file][0]).joinpath(file))
-        for b in self.send_file(filename):
-            pass
-        print(str(b) + ' bytes enviados para '+ str(self.client))
+        with open_part(literals) as file:
+            file.truncate(total)
+            if hasattr(os, 'posix_fallocate') and total:
+                os.posix_fallocate(file.fileno(), 0, total)
+        self.store.save_upload(self.usr, filename, key, literals, offset)
+        start = time.perf_counter()
+        self.send('ok ' + self.ticket())
+        if self.receive() != 'fim':
+            return None
+        return Progress(total - offset, total - offset,
+                        time.perf_counter() - start)
     
-    def delete(self, file):
+    def resume_upload(self, filename, key, total):
+        """Procura um envio interrompido do mesmo conteúdo
+        
+        Args:
+            filename (str): nome do arquivo
+            key (str): identificação do envio, calculada a partir do usuário,
+                do nome, do manifesto e das operações
+            total (int): quantidade de bytes literais do envio
+        
+        Returns:
+            (tuple) endereço onde os trechos literais são gravados e
+                quantidade de bytes que já foram recebidos
+        
         """
+        state = self.store.upload(self.usr, filename)
+        if state is not None:
+            digest, path, received = state
+            if (digest == key and received <= total and
+                    os.path.exists(path)):
+                return path, received
+            # Conteúdo diferente: o envio anterior não pode ser retomado
+            self.blobs.discard(path)
+            self.store.end_upload(self.usr, filename)
+        return self.blobs.scratch('upload.' + key), 0
+    
+    def content_parts(self, file, pinned = None):
+        """Trechos que compõem o conteúdo de um arquivo do usuário
         
         Args:
-            file (str): nome do arquivo a ser excluido
+            file (str): nome do arquivo no banco de dados do usuário
+            pinned (list): se dada, os blocos do conteúdo são reservados (veja
+                ``MetadataStore.content``) e seus hashes acrescentados à
+                lista, para que sejam devolvidos com ``release``
+        
+        Returns:
+            (tuple) tamanho do arquivo e lista de trechos (endereço, início,
+                tamanho), os blocos do arquivo ou o arquivo inteiro, se ele
+                ainda estiver guardado fora do armazenamento de blocos
+        
+        Raises:
+            KeyError: se o usuário não tiver acesso ao arquivo
+        
         """
-        if file in self.usr_bd:
-            del self.usr_bd[file]
-            filepath = self.directory.joinpath(file)
-            os.remove(str(filepath))
-            self.send(file +" excluído")
-        else:
-            self.send("Arquivo não encontrado")
+        owner, size, block, hashes = self.store.content(
+                self.usr, file, pin = pinned is not None)
+        if hashes is None:
+            filename = str(self.root.joinpath(owner).joinpath(file))
+            return size, [(filename, 0, size)]
+        if pinned is not None:
+            pinned.extend(hashes)
+        return size, [(self.blobs.path(digest), 0,
+                       min(block, size - i * block))
+                      for i, digest in enumerate(hashes)]
     
-    @staticmethod
-    def update_bdfile(bdfilename, file):
-        _bd = ClientHandler.recover_bdfile(bdfilename)
-        try:
-            del _bd[file]
-        except KeyError:
-            pass
-        ClientHandler.generate_bdfile(bdfilename, _bd)
+    @COMMANDS.command()
+    def get(self, file, start = None, length = None):
+        """Método usado para baixar o arquivo do servidor
         
-            
-    @staticmethod
-    def recover_bdfile(bdfilename):
-        """Método para recuperar o dicionário de arquivos de um usuário
+        O servidor responde "<tamanho> <versão>", onde a versão identifica o
+        conteúdo atual do arquivo. Com ``start``, apenas o intervalo pedido é
+        enviado, terminando no fim do arquivo se ``length`` o ultrapassar.
         
-        Os dicionários de arquivos possuem como chave o nome do arquivo e como
-        valor uma tupla contendo o auto e a data da última atualização do
-        arquivo.
+        Sem intervalo, o cliente envia "-" para receber o arquivo inteiro,
+        "retomar <n>" para continuar um download interrompido a partir do
+        byte n, "canais" para receber "<bilhete> <bloco> <hash>..." e baixar
+        intervalos do arquivo em paralelo pelos canais de dados, ou as
+        assinaturas da cópia que já tem (veja o módulo ``delta``). Nesse
+        último caso, o servidor responde "<sha256> <operações>" e envia apenas
+        os trechos literais; o hash permite ao cliente conferir a versão
+        reconstruída. Assinaturas malformadas são recusadas com "Assinaturas
+        inválidas!".
         
         Args:
-            bdfilename (str): nome do arquivo .bd do usuário
-            
-        Returns:
-            (dict) dicionário no formato:
-                dict[(nome do arquivo)] = (proprietário, última modificação)
-            
+            file (str): nome do arquivo no banco de dados do usuário
+            start (str): primeiro byte do intervalo
+            length (str): tamanho do intervalo
+        
         """
-        bd_dict = dict()
-        file = open(bdfilename, 'r')
-        for line in file:
-            info = line.split(' ')
-            bd_dict[info[0]] = tuple(info[1:])
-        file.close()
-        return bd_dict
+        try:
+            size, parts = self.content_parts(file)
+            version = self.store.lookup(self.usr, file)[1].replace(' ', 'T')
+        except KeyError:
+            self.send("Arquivo não encontrado")
+            return
+        if start is not None:
+            if not (start.isdigit() and int(start) <= size and
+                    (length is None or length.isdigit())):
+                self.send("Intervalo inválido!")
+                return
+            start = int(start)
+            length = size - start if length is None else int(length)
+            self.send('{0} {1}'.format(size, version))
+            msg = 'retomar {0} {1}'.format(start, min(length, size - start))
+        else:
+            self.send('{0} {1}'.format(size, version))
+            msg = self.receive()
+        if msg == 'canais':
+            # O cliente baixa intervalos pelos canais de dados e confere o
+            # resultado com o hash de cada bloco
+            block, hashes = self.store.content(self.usr, file)[2:]
+            if hashes is None:
+                block = BLOCK_SIZE
+                hashes = Console.manifest(parts[0][0], block)[1]
+            self.send(' '.join([self.ticket(), str(block)] + hashes))
+            return
+        b = Progress(0, size, 0)
+        if msg == '-' or msg.startswith('retomar '):
+            if msg != '-':
+                info = msg.split(' ')
+                if len(info) > 3 or not all(n.isdigit() for n in info[1:]):
+                    self.send("Intervalo inválido!")
+                    return
+                start = min(int(info[1]), size)
+                length = min(int(info[2]), size - start) if len(info) > 2 \
+                    else size - start
+                parts = delta.slice_parts(parts, start, length)
+            for b in self.send_file(None, parts = self.cache.parts(parts,
+                                                                   size)):
+                pass
+            print('{0} bytes enviados para {1} ({2:.2f} MB/s)'.format(
+                    b.done, self.client, b.rate))
+            self.metrics.transfer('out', b.done, b.elapsed)
+            return
+        try:
+            sigs = delta.decode_signatures(msg)
+        except ValueError:
+            self.send("Assinaturas inválidas!")
+            return
+        # A busca precisa do conteúdo contíguo, então os blocos são copiados
+        # para um arquivo temporário
+        scratch = self.blobs.scratch()
+        digest = hashlib.sha256()
+        try:
+            with open(scratch, 'wb') as tmp:
+                for data in Console.read_parts(self.cache.parts(parts, size),
+                                               BLOCK_SIZE):
+                    digest.update(data)
+                    tmp.write(data)
+            ops = []
+            if size:
+                with open(scratch, 'rb') as tmp:
+                    with mmap.mmap(tmp.fileno(), 0,
+                                   access = mmap.ACCESS_READ) as data:
+                        ops = delta.scan(data, 0, size, sigs)
+            self.send('{0} {1}'.format(digest.hexdigest(),
+                                       delta.encode_ops(ops)))
+            for b in self.send_file(None, parts = delta.literal_parts(
+                    scratch, ops)):
+                pass
+        finally:
+            self.blobs.discard(scratch)
+        print('{0} de {1} bytes enviados para {2} ({3:.2f} MB/s)'.format(
+                b.done, size, self.client, b.rate))
+        self.metrics.transfer('out', b.done, b.elapsed)
     
-    @staticmethod
-    def generate_bdfile(bdfilename, bd_dict):
-        """Método que cria um arquivo .bd a partir de um dicionário de arquivos
+    def remove_blob(self, digest):
+        """Remove um bloco sem referências do disco e do cache
         
         Args:
-            bdfilename (str): nome do arquivo .bd para o qual o dicionário será
-                salvo.
-            bd_dict (dict): dicionário a ser salvo.
+            digest (str): hash hexadecimal do bloco
         
         """
-        file = open(bdfilename, 'w')
-        text_line = '{0} {1}'
-        for key in bd_dict:
-            value = ' '.join(bd_dict[key])
-            file.write(text_line.format(key, value))
-        file.close()
+        self.cache.invalidate(self.blobs.path(digest))
+        self.blobs.remove(digest)
+    
+    @COMMANDS.command(pipeline = True)
+    def delete(self, file):
+        """Método de exclusão de arquivos
+        
+        O proprietário exclui o arquivo para todos com quem ele foi
+        compartilhado; os demais usuários apenas o removem da própria lista.
+        
+        Args:
+            file (str): nome do arquivo a ser excluido
+        """
+        owner = self.store.remove(self.usr, file)
+        if owner is None:
+            self.send("Arquivo não encontrado")
+        else:
+            if owner == self.usr:
+                partial = self.store.end_upload(self.usr, file)
+                if partial is not None:
+                    self.blobs.discard(partial)
+                legacy = self.directory.joinpath(file)
+                if legacy.exists():
+                    os.remove(str(legacy))
+                    self.cache.invalidate(legacy)
+                self.store.collect(self.remove_blob)
+            self.send(file +" excluído")
     
     def __repr__(self):
         """Método repr usado apenas para observação.
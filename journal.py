@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo do diário de cadastros do servidor
+
+Cada cadastro é acrescentado a um diário (``<arquivo de usuários>.journal``)
+antes de ser confirmado ao cliente, de modo que uma queda do servidor não
+perde os usuários cadastrados desde a inicialização. As gravações de várias
+sessões são agrupadas em um único ``fsync``, e o diário é compactado
+periodicamente no arquivo de usuários, que funciona como um retrato do
+estado. Na inicialização, ``Host.load_users`` lê o retrato e depois o
+diário.
+
+Os dois arquivos usam, por padrão, um formato binário: o cabeçalho
+``USERS_MAGIC`` seguido de registros com os tamanhos do nome e da senha
+(``RECORD_HEADER``) e os dois textos em UTF-8. Arquivos no formato antigo, uma
+linha em Base85 por usuário, continuam sendo lidos e são convertidos na
+primeira compactação.
+
+Example:
+    >> journal = UserJournal('.usr.txt')
+    >> journal.append('ana', 'senha')
+    >> journal.close()
+
+"""
+
+import base64
+import os
+import shutil
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Sufixo do diário em relação ao arquivo de usuários
+JOURNAL_SUFFIX = ".journal"
+
+# Cabeçalho dos arquivos de usuários e diários no formato binário
+USERS_MAGIC = b'RPU\x01'
+
+# Tamanhos, em bytes, do nome e da senha de cada registro binário
+RECORD_HEADER = struct.Struct('!HH')
+
+
+def encode_user(usr, psw, binary = True):
+    """Codifica um usuário como registro do arquivo de usuários
+
+    Args:
+        usr (str): nome de usuário
+        psw (str): senha do usuário
+        binary (bool): False para o formato antigo, em Base85
+
+    Returns:
+        (bytes) registro binário, ou linha codificada em Base85 terminada em
+            quebra de linha
+
+    """
+    if binary:
+        usr, psw = usr.encode(), psw.encode()
+        return RECORD_HEADER.pack(len(usr), len(psw)) + usr + psw
+    return base64.a85encode((usr + '@' + psw).encode()) + b'\n'
+
+
+def decode_users(data, journal = True):
+    """Decodifica os registros de um arquivo de usuários ou diário
+
+    Args:
+        data (bytes): conteúdo do arquivo, em qualquer um dos formatos
+        journal (bool): True para ignorar um registro incompleto no fim,
+            deixado por uma queda durante a gravação do diário. No formato
+            antigo, é a linha sem quebra de linha; no binário, um registro
+            incompleto é sempre ignorado
+
+    Returns:
+        (tuple) lista de pares (usuário, senha) e quantidade de bytes
+            ocupados pelos registros completos
+
+    """
+    users = []
+    if data.startswith(USERS_MAGIC):
+        pos = end = len(USERS_MAGIC)
+        while pos + RECORD_HEADER.size <= len(data):
+            nusr, npsw = RECORD_HEADER.unpack_from(data, pos)
+            pos += RECORD_HEADER.size
+            if pos + nusr + npsw > len(data):
+                break
+            users.append((data[pos:pos + nusr].decode(),
+                          data[pos + nusr:pos + nusr + npsw].decode()))
+            pos = end = pos + nusr + npsw
+        return users, end
+    end = data.rfind(b'\n') + 1 if journal else len(data)
+    for line in data[:end].splitlines():
+        try:
+            usr, psw = base64.a85decode(line.strip()).decode().split('@', 1)
+        except ValueError:
+            continue
+        users.append((usr, psw))
+    return users, end
+
+
+def read_users(filename, dict_, journal = False):
+    """Acrescenta a ``dict_`` os usuários de um arquivo de usuários ou diário
+
+    Args:
+        filename (str): endereço do arquivo
+        dict_ (dict): dicionário de usuários a ser atualizado
+        journal (bool): True para ignorar um registro incompleto no fim do
+            arquivo (ver ``decode_users``)
+
+    Returns:
+        (int) quantidade de registros lidos
+
+    """
+    with open(filename, 'rb') as file:
+        users = decode_users(file.read(), journal)[0]
+    dict_.update(users)
+    return len(users)
+
+
+def write_users(filename, users, binary = True):
+    """Grava um arquivo de usuários completo
+
+    Args:
+        filename (str): endereço do arquivo
+        users (iterable): pares (usuário, senha)
+        binary (bool): False para o formato antigo, em Base85
+
+    """
+    with open(filename, 'wb') as file:
+        if binary:
+            file.write(USERS_MAGIC)
+        file.writelines(encode_user(usr, psw, binary) for usr, psw in users)
+
+
+def is_binary(filename):
+    """Verifica se um arquivo de usuários está no formato binário
+
+    Args:
+        filename (str): endereço do arquivo
+
+    Returns:
+        (bool) True para o formato binário, False para o antigo e None se o
+            arquivo não existir ou estiver vazio
+
+    """
+    try:
+        with open(filename, 'rb') as file:
+            head = file.read(len(USERS_MAGIC))
+    except FileNotFoundError:
+        return None
+    return head == USERS_MAGIC if head else None
+
+
+class UserJournal(object):
+    """Diário de cadastros com ``fsync`` em grupo e compactação
+
+    ``append`` grava o registro e aguarda até que ele esteja no disco; uma
+    thread de sincronização faz um único ``fsync`` para todos os registros
+    gravados até então. Vários processos podem usar o mesmo diário: as
+    gravações e a compactação são coordenadas por ``flock``, quando
+    disponível.
+
+    Attributes:
+        filename (str): arquivo de usuários (o retrato)
+        journal_file (str): arquivo do diário
+
+    """
+    def __init__(self, filename, **kwargs):
+        """Método construtor do diário
+
+        Args:
+            filename (str): endereço do arquivo de usuários
+
+        Kwargs:
+            delay (float): segundos de espera antes de cada ``fsync``, para
+                agrupar cadastros simultâneos. Por padrão 0.002
+            compact_size (int): tamanho do diário, em bytes, a partir do qual
+                ele é compactado no arquivo de usuários. Por padrão 4 MiB
+            binary (bool): False para gravar os arquivos no formato antigo,
+                em Base85. Por padrão True. Um diário já existente mantém o
+                seu formato até a próxima compactação
+
+        """
+        self.filename = str(filename)
+        self.journal_file = self.filename + JOURNAL_SUFFIX
+        self.delay = float(kwargs.get('delay', 0.002))
+        self.compact_size = int(kwargs.get('compact_size', 4 * 1024 * 1024))
+        self.binary = bool(kwargs.get('binary', True))
+        self.fd = os.open(self.journal_file,
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.cond = threading.Condition()
+        self.written = self.synced = 0
+        self.running = True
+        self.syncer = threading.Thread(target = self.sync_loop, daemon = True)
+        self.syncer.start()
+
+    def lock(self, operation):
+        """Trava ou destrava o diário entre processos
+
+        Args:
+            operation (int): operação do ``fcntl.flock``
+
+        """
+        if fcntl is not None:
+            fcntl.flock(self.fd, operation)
+
+    def append(self, usr, psw):
+        """Grava um cadastro no diário e aguarda até que ele esteja no disco
+
+        O registro segue o formato do diário: o cabeçalho binário é gravado
+        pelo primeiro cadastro de um diário vazio. Os cadastros compartilham
+        a trava entre processos, exceto o que encontra o diário vazio, que a
+        troca pela exclusiva e confere o diário de novo, para que só um
+        processo grave o cabeçalho.
+
+        Args:
+            usr (str): nome de usuário
+            psw (str): senha do usuário
+
+        """
+        with self.cond:
+            self.lock(getattr(fcntl, 'LOCK_SH', 0))
+            try:
+                binary = is_binary(self.journal_file)
+                if binary is None:
+                    # A troca não é atômica: outro processo pode ter gravado
+                    # o cabeçalho enquanto a trava estava livre
+                    self.lock(getattr(fcntl, 'LOCK_EX', 0))
+                    binary = is_binary(self.journal_file)
+                if binary is None:
+                    binary = self.binary
+                    record = encode_user(usr, psw, binary)
+                    if binary:
+                        record = USERS_MAGIC + record
+                else:
+                    record = encode_user(usr, psw, binary)
+                os.write(self.fd, record)
+            finally:
+                self.lock(getattr(fcntl, 'LOCK_UN', 0))
+            self.written += 1
+            seq = self.written
+            self.cond.notify_all()
+            while self.synced < seq:
+                self.cond.wait()
+
+    def sync_loop(self):
+        """Laço da thread de sincronização
+
+        Aguarda novos registros, espera ``delay`` segundos para que outras
+        sessões gravem os seus e faz um único ``fsync`` para todos.
+
+        """
+        while True:
+            with self.cond:
+                while self.running and self.synced == self.written:
+                    self.cond.wait()
+                if self.synced == self.written:
+                    return
+            if self.delay:
+                time.sleep(self.delay)
+            with self.cond:
+                target = self.written
+            os.fsync(self.fd)
+            with self.cond:
+                self.synced = target
+                self.cond.notify_all()
+            if os.fstat(self.fd).st_size >= self.compact_size:
+                self.compact()
+
+    def compact(self):
+        """Compacta o diário no arquivo de usuários
+
+        Quando o retrato e o diário estão no formato configurado, basta
+        copiar o arquivo de usuários e acrescentar os registros completos do
+        diário, sem decodificá-los. Caso contrário (arquivos no formato
+        antigo), o retrato é reescrito no formato configurado. A cópia é
+        renomeada sobre o antigo arquivo; só então o diário é esvaziado. Uma
+        queda em qualquer ponto deixa, no pior caso, registros repetidos, que
+        a leitura aplica de novo sem efeito. Novos cadastros deste processo
+        aguardam o fim da compactação; os de outros processos, pelo
+        ``flock``.
+
+        Returns:
+            (int) quantidade de bytes do diário incorporados
+
+        """
+        with self.cond:
+            self.lock(getattr(fcntl, 'LOCK_EX', 0))
+            try:
+                with open(self.journal_file, 'rb') as file:
+                    data = file.read()
+                # Descarta um registro incompleto deixado por uma queda
+                users, end = decode_users(data)
+                tmp = self.filename + '.tmp'
+                formats = {is_binary(self.filename), is_binary(
+                        self.journal_file)} - {None}
+                if formats <= {self.binary}:
+                    records = data[len(USERS_MAGIC) if self.binary else 0:end]
+                    if os.path.exists(self.filename):
+                        shutil.copyfile(self.filename, tmp)
+                    with open(tmp, 'ab+') as file:
+                        if self.binary and not file.tell():
+                            records = USERS_MAGIC + records
+                        elif file.tell() and not self.binary and (
+                                file.seek(-1, os.SEEK_END) or
+                                file.read(1) != b'\n'):
+                            records = b'\n' + records
+                        file.write(records)
+                        file.flush()
+                        os.fsync(file.fileno())
+                else:
+                    snapshot = dict()
+                    if os.path.exists(self.filename):
+                        read_users(self.filename, snapshot)
+                    snapshot.update(users)
+                    write_users(tmp, snapshot.items(), self.binary)
+                    with open(tmp, 'rb') as file:
+                        os.fsync(file.fileno())
+                os.replace(tmp, self.filename)
+                self.sync_directory()
+                os.ftruncate(self.fd, 0)
+                os.fsync(self.fd)
+            finally:
+                self.lock(getattr(fcntl, 'LOCK_UN', 0))
+        return end
+
+    def sync_directory(self):
+        """Garante que a troca do arquivo de usuários chegou ao disco
+
+        Sem efeito nos sistemas que não permitem abrir diretórios.
+
+        """
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(os.path.abspath(self.filename)),
+                         os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """Sincroniza os registros pendentes e fecha o diário
+
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.syncer.join()
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+    def __repr__(self):
+        return "UserJournal({0!r})".format(self.filename)
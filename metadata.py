@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo do banco de dados de arquivos do servidor
+
+Os metadados dos arquivos (proprietário, data da última atualização e
+compartilhamentos) ficam em um banco SQLite com índices, no lugar dos antigos
+arquivos ``<usuário>.bd`` de cada usuário. Cada escrita é uma transação
+pequena, de modo que várias sessões (e vários processos do MultiHost) podem
+alterar o banco ao mesmo tempo.
+
+O banco também guarda a lista de blocos (o manifesto) de cada arquivo e a
+contagem de referências de cada bloco do ``BlobStore``.
+
+Example:
+    >> store = MetadataStore('root/.metadata.db')
+    >> store.add('ana', 'notas.txt', '2018-05-01 12:00:00')
+    >> store.share('ana', 'notas.txt', 'bruno')
+    >> store.lookup('bruno', 'notas.txt')
+    ('ana', '2018-05-01 12:00:00')
+
+"""
+
+import pathlib
+import os
+import re
+import sqlite3
+import threading
+
+# Nome padrão do banco de dados dentro do diretório raiz do servidor
+METADATA_FILE = ".metadata.db"
+
+# Os arquivos são identificados pelo proprietário e pelo nome. A tabela
+# ``grants`` é a lista de arquivos visível a cada usuário: o upload cria uma
+# entrada para o próprio dono e o compartilhamento, uma para o destinatário.
+# O manifesto é a lista de hashes dos blocos separados por espaço; arquivos
+# anteriores ao armazenamento de blocos não têm manifesto e continuam em
+# ``<raiz>/<proprietário>/<nome>``. Um bloco só é usado depois de gravado
+# (``stored``), e é apagado quando deixa de ter referências. A tabela
+# ``uploads`` guarda o progresso de envios interrompidos, no máximo um por
+# usuário e nome de arquivo, para que possam ser retomados.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    size INTEGER,
+    block INTEGER,
+    manifest TEXT,
+    UNIQUE (owner, name)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL,
+    stored INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS blobs_unused ON blobs (hash) WHERE refs <= 0;
+CREATE TABLE IF NOT EXISTS grants (
+    usr TEXT NOT NULL,
+    name TEXT NOT NULL,
+    file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    PRIMARY KEY (usr, name)
+);
+CREATE INDEX IF NOT EXISTS grants_file ON grants (file_id);
+CREATE TABLE IF NOT EXISTS uploads (
+    usr TEXT NOT NULL,
+    name TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    path TEXT NOT NULL,
+    received INTEGER NOT NULL,
+    PRIMARY KEY (usr, name)
+);
+"""
+
+# Ordenações aceitas pela listagem de arquivos
+ORDER_BY = {'nome': 'g.name', 'dono': 'f.owner, g.name',
+            'data': 'f.updated DESC, g.name'}
+
+# Maior caractere Unicode, usado como limite da busca por prefixo
+MAX_CHAR = '\U0010ffff'
+
+# Linha dos arquivos .bd: nome, proprietário e data. Versões antigas do
+# servidor gravavam as entradas sem quebra de linha, por isso as entradas são
+# reconhecidas pelo formato da data e não pelas linhas.
+BD_ENTRY = re.compile(r'(\S+?) (\S+) (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d'
+                      r'(?:\.\d{6})?)\s*')
+
+
+class MetadataStore(object):
+    """Banco de dados de arquivos e compartilhamentos dos usuários
+
+    O SQLite não permite compartilhar uma conexão entre threads, então cada
+    thread abre a sua na primeira consulta. O banco usa o modo WAL, em que
+    leituras não bloqueiam a escrita.
+
+    Attributes:
+        filename (str): endereço do arquivo do banco de dados
+
+    """
+    def __init__(self, filename):
+        """Método construtor do banco de dados
+
+        Args:
+            filename (str): endereço do arquivo do banco, criado caso não
+                exista
+
+        """
+        self.filename = str(filename)
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode = WAL')
+        with conn:
+            conn.executescript(SCHEMA)
+            # Bancos criados antes do armazenamento de blocos
+            columns = [row[1] for row in conn.execute(
+                    'PRAGMA table_info (files)')]
+            for column in ('size', 'block', 'manifest'):
+                if column not in columns:
+                    conn.execute('ALTER TABLE files ADD COLUMN {0} {1}'.format(
+                            column, 'TEXT' if column == 'manifest'
+                            else 'INTEGER'))
+
+    def connection(self):
+        """Conexão da thread atual com o banco
+
+        Returns:
+            (sqlite3.Connection) conexão aberta na primeira chamada da thread
+
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Espera outras sessões terminarem suas escritas em vez de falhar
+            conn = sqlite3.connect(self.filename, timeout = 30)
+            conn.execute('PRAGMA foreign_keys = ON')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        """Fecha a conexão da thread atual
+
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def add(self, usr, name, updated, size = None, block = None,
+            hashes = None):
+        """Registra o upload de um arquivo do usuário
+
+        Um arquivo já existente tem a data e o conteúdo substituídos de uma
+        só vez, e as referências do conteúdo antigo são liberadas; os
+        compartilhamentos feitos anteriormente continuam valendo.
+
+        Args:
+            usr (str): proprietário do arquivo
+            name (str): nome do arquivo
+            updated (str): data da última atualização
+            size (int): tamanho do arquivo
+            block (int): tamanho dos blocos
+            hashes (list): hashes dos blocos, já reservados com ``pin``, ou
+                None para um arquivo guardado fora do armazenamento de blocos
+
+        """
+        manifest = None if hashes is None else ' '.join(hashes)
+        conn = self.connection()
+        with conn:
+            old = conn.execute('SELECT manifest FROM files WHERE owner = ? '
+                               'AND name = ?', (usr, name)).fetchone()
+            if old is not None and old[0]:
+                self._release(conn, old[0].split(' '))
+            conn.execute('INSERT INTO files (owner, name, updated, size, '
+                         'block, manifest) VALUES (?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT (owner, name) DO UPDATE SET '
+                         'updated = excluded.updated, size = excluded.size, '
+                         'block = excluded.block, '
+                         'manifest = excluded.manifest',
+                         (usr, name, updated, size, block, manifest))
+            conn.execute('INSERT OR REPLACE INTO grants (usr, name, file_id) '
+                         'SELECT ?, ?, id FROM files WHERE owner = ? AND '
+                         'name = ?', (usr, name, usr, name))
+
+    def lookup(self, usr, name):
+        """Busca um arquivo na lista do usuário
+
+        Args:
+            usr (str): nome do usuário
+            name (str): nome do arquivo
+
+        Returns:
+            (tuple) proprietário e data da última atualização
+
+        Raises:
+            KeyError: se o arquivo não estiver na lista do usuário
+
+        """
+        row = self.connection().execute(
+                'SELECT f.owner, f.updated FROM grants g JOIN files f ON '
+                'f.id = g.file_id WHERE g.usr = ? AND g.name = ?',
+                (usr, name)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row
+
+    def content(self, usr, name, pin = False):
+        """Conteúdo de um arquivo da lista do usuário
+
+        Com ``pin``, a leitura do manifesto e a reserva dos blocos acontecem
+        na mesma transação, que trava o banco como a coleta de lixo: nem a
+        exclusão do arquivo nem a coleta apagam os blocos enquanto eles são
+        lidos. As referências devem ser devolvidas com ``release``.
+
+        Args:
+            usr (str): nome do usuário
+            name (str): nome do arquivo
+            pin (bool): True para reservar os blocos do conteúdo
+
+        Returns:
+            (tuple) proprietário, tamanho, tamanho dos blocos e lista de
+                hashes; a lista é None para arquivos guardados fora do
+                armazenamento de blocos
+
+        Raises:
+            KeyError: se o arquivo não estiver na lista do usuário
+
+        """
+        conn = self.connection()
+        with conn:
+            if pin:
+                conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                    'SELECT f.owner, f.size, f.block, f.manifest FROM grants '
+                    'g JOIN files f ON f.id = g.file_id WHERE g.usr = ? AND '
+                    'g.name = ?', (usr, name)).fetchone()
+            if row is None:
+                raise KeyError(name)
+            owner, size, block, manifest = row
+            if manifest is None:
+                return owner, size, block, None
+            hashes = manifest.split(' ') if manifest else []
+            if pin:
+                conn.executemany('UPDATE blobs SET refs = refs + 1 WHERE '
+                                 'hash = ?', [(digest,) for digest in hashes])
+        return owner, size, block, hashes
+
+    def files(self, usr, prefix = '', order = 'nome', offset = 0,
+              limit = None):
+        """Arquivos visíveis ao usuário
+
+        Args:
+            usr (str): nome do usuário
+            prefix (str): apenas os arquivos cujo nome começa com ``prefix``
+            order (str): 'nome', 'dono' ou 'data' (mais recentes primeiro)
+            offset (int): quantidade de arquivos ignorados no início
+            limit (int): quantidade máxima de arquivos, ou None para todos
+
+        Returns:
+            (sqlite3.Cursor) iterável de tuplas com nome, proprietário e data
+                da última atualização
+
+        Raises:
+            KeyError: se a ordenação não for conhecida
+
+        """
+        return self.connection().execute(
+                'SELECT g.name, f.owner, f.updated FROM grants g JOIN files f '
+                'ON f.id = g.file_id WHERE g.usr = ? AND g.name >= ? AND '
+                'g.name < ? ORDER BY ' + ORDER_BY[order] + ' LIMIT ? OFFSET ?',
+                (usr, prefix, prefix + MAX_CHAR,
+                 -1 if limit is None else limit, offset))
+
+    def count(self, usr, prefix = ''):
+        """Quantidade de arquivos visíveis ao usuário
+
+        Args:
+            usr (str): nome do usuário
+            prefix (str): apenas os arquivos cujo nome começa com ``prefix``
+
+        Returns:
+            (int) quantidade de arquivos na lista do usuário
+
+        """
+        return self.connection().execute(
+                'SELECT count(*) FROM grants WHERE usr = ? AND name >= ? AND '
+                'name < ?', (usr, prefix, prefix + MAX_CHAR)).fetchone()[0]
+
+    def share(self, usr, name, recipient):
+        """Compartilha um arquivo da lista de ``usr`` com ``recipient``
+
+        Args:
+            usr (str): usuário que compartilha
+            name (str): nome do arquivo na lista de ``usr``
+            recipient (str): usuário que receberá o arquivo
+
+        Returns:
+            (bool) False se o arquivo não estiver na lista de ``usr``
+
+        """
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute(
+                    'INSERT OR REPLACE INTO grants (usr, name, file_id) '
+                    'SELECT ?, name, file_id FROM grants WHERE usr = ? AND '
+                    'name = ?', (recipient, usr, name))
+        return cursor.rowcount > 0
+
+    def remove(self, usr, name):
+        """Remove um arquivo da lista do usuário
+
+        Se o usuário for o proprietário, o arquivo deixa de existir para todos
+        com quem foi compartilhado; caso contrário, apenas o compartilhamento
+        é desfeito.
+
+        Args:
+            usr (str): nome do usuário
+            name (str): nome do arquivo
+
+        Returns:
+            (str) proprietário do arquivo removido, ou None se o arquivo não
+                estiver na lista do usuário
+
+        """
+        conn = self.connection()
+        with conn:
+            row = conn.execute(
+                    'SELECT f.id, f.owner FROM grants g JOIN files f ON '
+                    'f.id = g.file_id WHERE g.usr = ? AND g.name = ?',
+                    (usr, name)).fetchone()
+            if row is None:
+                return None
+            if row[1] == usr:
+                manifest = conn.execute('SELECT manifest FROM files WHERE '
+                                        'id = ?', (row[0],)).fetchone()[0]
+                if manifest:
+                    self._release(conn, manifest.split(' '))
+                conn.execute('DELETE FROM files WHERE id = ?', (row[0],))
+            else:
+                conn.execute('DELETE FROM grants WHERE usr = ? AND name = ?',
+                             (usr, name))
+        return row[1]
+
+    def upload(self, usr, name):
+        """Envio interrompido de um arquivo do usuário
+
+        Args:
+            usr (str): nome do usuário
+            name (str): nome do arquivo
+
+        Returns:
+            (tuple) identificação do envio, endereço dos dados recebidos e
+                quantidade de bytes recebidos, ou None se não houver envio
+                interrompido
+
+        """
+        return self.connection().execute(
+                'SELECT digest, path, received FROM uploads WHERE usr = ? '
+                'AND name = ?', (usr, name)).fetchone()
+
+    def save_upload(self, usr, name, digest, path, received):
+        """Registra o progresso de um envio interrompido
+
+        Args:
+            usr (str): nome do usuário
+            name (str): nome do arquivo
+            digest (str): identificação do envio, que deve ser a mesma para
+                que ele seja retomado
+            path (str): endereço dos dados recebidos
+            received (int): quantidade de bytes recebidos
+
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO uploads (usr, name, digest, '
+                         'path, received) VALUES (?, ?, ?, ?, ?)',
+                         (usr, name, digest, path, received))
+
+    def end_upload(self, usr, name):
+        """Esquece um envio interrompido
+
+        Args:
+            usr (str): nome do usuário
+            name (str): nome do arquivo
+
+        Returns:
+            (str) endereço dos dados recebidos, ou None se não houver envio
+                interrompido
+
+        """
+        conn = self.connection()
+        with conn:
+            row = conn.execute('SELECT path FROM uploads WHERE usr = ? AND '
+                               'name = ?', (usr, name)).fetchone()
+            conn.execute('DELETE FROM uploads WHERE usr = ? AND name = ?',
+                         (usr, name))
+        return None if row is None else row[0]
+
+    def pin(self, hashes, sizes):
+        """Reserva os blocos de um upload, incrementando suas referências
+        
+        A reserva impede que a coleta de lixo apague um bloco entre a
+        verificação de que ele já existe e o registro do arquivo. Se o
+        upload falhar, as referências devem ser devolvidas com ``release``.
+
+        Args:
+            hashes (list): hashes dos blocos do arquivo
+            sizes (list): tamanho de cada bloco
+
+        Returns:
+            (set) hashes dos blocos que ainda não estão gravados
+
+        """
+        conn = self.connection()
+        with conn:
+            conn.executemany('INSERT INTO blobs (hash, size, refs) VALUES '
+                             '(?, ?, 1) ON CONFLICT (hash) DO UPDATE SET '
+                             'refs = refs + 1', zip(hashes, sizes))
+            missing = set()
+            for digest in set(hashes):
+                if not conn.execute('SELECT stored FROM blobs WHERE '
+                                    'hash = ?', (digest,)).fetchone()[0]:
+                    missing.add(digest)
+        return missing
+
+    def stored(self, hashes):
+        """Marca os blocos como gravados no disco
+
+        Args:
+            hashes (iterable): hashes dos blocos gravados
+
+        """
+        conn = self.connection()
+        with conn:
+            conn.executemany('UPDATE blobs SET stored = 1 WHERE hash = ?',
+                             [(digest,) for digest in hashes])
+
+    def release(self, hashes):
+        """Devolve as referências reservadas por ``pin``
+
+        Args:
+            hashes (list): hashes dos blocos
+
+        """
+        conn = self.connection()
+        with conn:
+            self._release(conn, hashes)
+
+    @staticmethod
+    def _release(conn, hashes):
+        conn.executemany('UPDATE blobs SET refs = refs - 1 WHERE hash = ?',
+                         [(digest,) for digest in hashes])
+
+    def collect(self, remove):
+        """Apaga os blocos que não têm mais referências
+
+        A transação trava o banco para escrita durante a coleta, de modo que
+        nenhum upload reserva um bloco que está sendo apagado.
+
+        Args:
+            remove (callable): função que apaga o arquivo de um bloco a
+                partir do hash
+
+        Returns:
+            (int) quantidade de blocos apagados
+
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            unused = [row[0] for row in conn.execute(
+                    'SELECT hash FROM blobs WHERE refs <= 0')]
+            for digest in unused:
+                remove(digest)
+            conn.execute('DELETE FROM blobs WHERE refs <= 0')
+        return len(unused)
+
+    def migrate(self, root):
+        """Importa os arquivos ``<usuário>.bd`` do diretório raiz
+
+        A importação acontece uma única vez: cada arquivo importado é
+        renomeado para ``<usuário>.bd.migrado``. Os arquivos enviados pelo
+        próprio usuário são importados antes dos compartilhamentos, para que
+        a data registrada seja a do proprietário.
+
+        Args:
+            root (str): diretório raiz do servidor
+
+        Returns:
+            (int) quantidade de entradas importadas
+
+        """
+        bdfiles = [path for path in pathlib.Path(root).glob('*/*.bd')
+                   if path.stem == path.parent.name]
+        if not bdfiles:
+            return 0
+        entries = []
+        for path in bdfiles:
+            usr = path.stem
+            with path.open('r') as file:
+                entries.extend((usr,) + match.groups()
+                               for match in BD_ENTRY.finditer(file.read()))
+        entries.sort(key = lambda entry: entry[0] != entry[2])
+        conn = self.connection()
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO files (owner, name, '
+                             'updated) VALUES (?, ?, ?)',
+                             [(owner, name, updated)
+                              for usr, name, owner, updated in entries])
+            conn.executemany('INSERT OR REPLACE INTO grants (usr, name, '
+                             'file_id) SELECT ?, ?, id FROM files WHERE '
+                             'owner = ? AND name = ?',
+                             [(usr, name, owner, name)
+                              for usr, name, owner, updated in entries])
+        for path in bdfiles:
+            os.replace(str(path), str(path) + '.migrado')
+        return len(entries)
+
+    def __repr__(self):
+        return "MetadataStore({0!r})".format(self.filename)
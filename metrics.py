@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo das métricas do servidor
+
+As métricas são contadores, histogramas e medidores (calculados no momento
+da leitura) guardados em memória por um objeto ``Metrics``, um por servidor.
+Os ``ClientHandler`` registram a duração de cada comando, os bytes que
+passam pelo socket, o tempo gasto com criptografia e a vazão de cada
+transferência. O texto no formato de exposição do Prometheus pode ser lido
+em ``/metrics`` por um ``MetricsServer`` em uma porta local, e o comando
+'métricas' do menu do servidor exibe um resumo.
+
+Example:
+    >> metrics = Metrics()
+    >> with metrics.timer('tcpy_command_seconds', (('command', 'show'),)):
+    >>     pass
+    >> print(metrics.render())
+
+"""
+
+import bisect
+import collections
+import contextlib
+import http.server
+import math
+import threading
+import time
+
+# Limites, em segundos, dos histogramas de duração
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Limites, em MB/s, do histograma de vazão das transferências
+RATE_BUCKETS = (0.1, 0.5, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Rótulos dos bytes e transferências recebidos e enviados pelo servidor
+LABELS_IN = (('direction', 'in'),)
+LABELS_OUT = (('direction', 'out'),)
+
+# Tipo e descrição de cada métrica, exibidos no texto do Prometheus
+METRICS_HELP = collections.OrderedDict([
+    ('tcpy_commands_total', ('counter', "Comandos executados")),
+    ('tcpy_command_errors_total', ('counter',
+                                   "Comandos interrompidos por um erro")),
+    ('tcpy_command_seconds', ('histogram', "Duração dos comandos")),
+    ('tcpy_bytes_total', ('counter', "Bytes recebidos e enviados pelos " +
+                          "sockets dos clientes")),
+    ('tcpy_crypto_seconds_total', ('counter', "Tempo gasto cifrando e " +
+                                   "decifrando mensagens e arquivos")),
+    ('tcpy_crypto_operations_total', ('counter', "Operações de cifra e " +
+                                      "decifra")),
+    ('tcpy_transfer_bytes_total', ('counter', "Bytes de arquivos " +
+                                   "transferidos")),
+    ('tcpy_transfer_seconds_total', ('counter', "Duração das " +
+                                     "transferências de arquivos")),
+    ('tcpy_transfer_rate_mbps', ('histogram', "Vazão de cada " +
+                                 "transferência de arquivo, em MB/s")),
+    ('tcpy_connections', ('gauge', "Conexões abertas")),
+    ('tcpy_users_online', ('gauge', "Usuários com sessão aberta " +
+                           "no processo")),
+    ('tcpy_pending_connections', ('gauge', "Conexões aguardando uma " +
+                                  "thread livre")),
+    ('tcpy_uptime_seconds', ('gauge', "Segundos desde o início do " +
+                             "servidor")),
+    ('tcpy_cache_hits_total', ('counter', "Trechos de arquivos servidos " +
+                               "pelo cache")),
+    ('tcpy_cache_misses_total', ('counter', "Trechos de arquivos lidos do " +
+                                 "disco para o cache")),
+    ('tcpy_cache_served_bytes_total', ('counter', "Bytes de downloads " +
+                                       "servidos pelo cache")),
+    ('tcpy_cache_bytes', ('gauge', "Bytes de arquivos copiados para o " +
+                          "cache")),
+])
+
+
+def format_labels(labels):
+    """Formata os rótulos de uma amostra
+
+    Args:
+        labels (tuple): pares (nome, valor)
+
+    Returns:
+        (str) rótulos no formato '{nome="valor",...}', ou '' sem rótulos
+
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace(
+            '\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+
+def format_value(value):
+    """Formata o valor de uma amostra
+
+    Args:
+        value (float): valor
+
+    Returns:
+        (str) inteiros sem casas decimais e infinito como '+Inf'
+
+    """
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def parse(text):
+    """Lê as amostras de um texto no formato do Prometheus
+
+    Args:
+        text (str): texto gerado por ``Metrics.render``
+
+    Returns:
+        (OrderedDict) valor de cada amostra, pela chave 'nome{rótulos}'
+
+    """
+    samples = collections.OrderedDict()
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            key, _, value = line.rpartition(' ')
+            samples[key] = float(value)
+    return samples
+
+
+def merge(texts):
+    """Soma as amostras de vários textos, como os dos processos do MultiHost
+
+    Os contadores, os histogramas e os medidores de conexões e usuários são
+    somados; o tempo de execução fica com o maior valor.
+
+    Args:
+        texts (iterable): textos no formato do Prometheus
+
+    Returns:
+        (OrderedDict) amostras somadas, como em ``parse``
+
+    """
+    total = collections.OrderedDict()
+    for text in texts:
+        for key, value in parse(text).items():
+            if key.startswith('tcpy_uptime_seconds'):
+                total[key] = max(total.get(key, 0), value)
+            else:
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def sample_labels(key):
+    """Separa o nome e os rótulos da chave de uma amostra
+
+    Args:
+        key (str): chave 'nome{rótulos}'
+
+    Returns:
+        (tuple) nome e dicionário de rótulos
+
+    """
+    name, _, rest = key.partition('{')
+    labels = dict()
+    for pair in rest.rstrip('}').split('",'):
+        if '=' in pair:
+            label, _, value = pair.partition('=')
+            labels[label] = value.strip('"')
+    return name, labels
+
+
+def quantile(buckets, q):
+    """Estima um quantil pelos limites acumulados de um histograma
+
+    Args:
+        buckets (list): pares (limite, contagem acumulada), em ordem
+        q (float): quantil, entre 0 e 1
+
+    Returns:
+        (float) limite do primeiro balde que alcança o quantil, ou None se o
+            histograma estiver vazio
+
+    """
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = q * buckets[-1][1]
+    for bound, count in buckets:
+        if count >= rank:
+            return bound
+    return buckets[-1][0]
+
+
+def summary(samples):
+    """Resumo legível das métricas, para o menu do servidor
+
+    Args:
+        samples (dict): amostras, como as de ``parse`` ou ``merge``
+
+    Returns:
+        (list) linhas do resumo
+
+    """
+    commands = collections.OrderedDict()
+    values = collections.defaultdict(float)
+    for key, value in samples.items():
+        name, labels = sample_labels(key)
+        if name == 'tcpy_command_seconds_bucket':
+            entry = commands.setdefault(labels['command'], {'buckets': []})
+            bound = labels['le']
+            entry['buckets'].append((math.inf if bound == '+Inf'
+                                     else float(bound), value))
+        elif name.startswith('tcpy_command_seconds_'):
+            entry = commands.setdefault(labels['command'], {'buckets': []})
+            entry[name.rpartition('_')[2]] = value
+        elif name == 'tcpy_command_errors_total':
+            entry = commands.setdefault(labels['command'], {'buckets': []})
+            entry['errors'] = value
+        else:
+            values[(name,) + tuple(sorted(labels.items()))] += value
+    lines = ["{0:<10} {1:>8} {2:>6} {3:>10} {4:>10} {5:>10}".format(
+            'comando', 'total', 'erros', 'média ms', 'p50 ms', 'p99 ms')]
+    for command, entry in commands.items():
+        count = entry.get('count', 0)
+        p50, p99 = (quantile(entry['buckets'], q) for q in (0.5, 0.99))
+        lines.append("{0:<10} {1:>8} {2:>6} {3:>10} {4:>10} {5:>10}".format(
+                command, int(count), int(entry.get('errors', 0)),
+                '{0:.2f}'.format(entry.get('sum', 0) / count * 1000)
+                if count else '-',
+                *('<= {0:g}'.format(p * 1000) if p not in (None, math.inf)
+                  else '-' for p in (p50, p99))))
+
+    def value(name, **labels):
+        return values.get((name,) + tuple(sorted(labels.items())), 0)
+
+    for direction, label in (('in', 'recebidos'), ('out', 'enviados')):
+        lines.append("bytes {0}: {1}".format(label, int(value(
+                'tcpy_bytes_total', direction = direction))))
+    for op, label in (('encrypt', 'cifra'), ('decrypt', 'decifra')):
+        lines.append("{0}: {1:.3f} s em {2} operações".format(
+                label, value('tcpy_crypto_seconds_total', op = op),
+                int(value('tcpy_crypto_operations_total', op = op))))
+    for direction, label in (('in', 'uploads'), ('out', 'downloads')):
+        size = value('tcpy_transfer_bytes_total', direction = direction)
+        elapsed = value('tcpy_transfer_seconds_total', direction = direction)
+        lines.append("{0}: {1} bytes, {2:.2f} MB/s em média".format(
+                label, int(size), size / elapsed / 1e6 if elapsed else 0.0))
+    if any(key[0] == 'tcpy_cache_hits_total' for key in values):
+        hits = value('tcpy_cache_hits_total')
+        total = hits + value('tcpy_cache_misses_total')
+        lines.append("cache: {0:.1f}% de acertos em {1} trechos, {2} bytes "
+                     "servidos, {3} bytes em memória".format(
+                             hits * 100 / total if total else 0.0,
+                             int(total),
+                             int(value('tcpy_cache_served_bytes_total')),
+                             int(value('tcpy_cache_bytes'))))
+    for name, label in (('tcpy_connections', 'conexões abertas'),
+                        ('tcpy_users_online', 'usuários conectados'),
+                        ('tcpy_pending_connections', 'conexões na fila')):
+        if any(key[0] == name for key in values):
+            lines.append("{0}: {1}".format(label, int(value(name))))
+    return lines
+
+
+class Histogram(object):
+    """Histograma cumulativo com limites fixos
+
+    Attributes:
+        bounds (tuple): limites superiores dos baldes, em ordem
+        counts (list): quantidade de observações de cada balde, sem acumular;
+            a última posição é a do balde sem limite
+        sum (float): soma das observações
+
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Registra uma observação
+
+        Args:
+            value (float): valor observado
+
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """Métricas de um servidor
+
+    Todas as operações são protegidas por uma única trava, mantida apenas o
+    tempo de atualizar um número.
+
+    Attributes:
+        started (float): instante de criação, em ``time.time``
+
+    """
+    def __init__(self):
+        """Método construtor das métricas
+
+        """
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.started = time.time()
+        self.gauge('tcpy_uptime_seconds', lambda: time.time() - self.started)
+
+    def add(self, name, amount = 1, labels = ()):
+        """Soma um valor a um contador
+
+        Args:
+            name (str): nome da métrica
+            amount (float): valor a somar
+            labels (tuple): pares (nome, valor) dos rótulos
+
+        """
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels = (), buckets = LATENCY_BUCKETS):
+        """Registra uma observação em um histograma
+
+        Args:
+            name (str): nome da métrica
+            value (float): valor observado
+            labels (tuple): pares (nome, valor) dos rótulos
+            buckets (tuple): limites dos baldes, usados na primeira observação
+
+        """
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, function, labels = ()):
+        """Registra um medidor, calculado a cada leitura das métricas
+
+        Args:
+            name (str): nome da métrica
+            function (function): função sem argumentos que retorna o valor
+            labels (tuple): pares (nome, valor) dos rótulos
+
+        """
+        with self.lock:
+            self.gauges[(name, labels)] = function
+
+    @contextlib.contextmanager
+    def timer(self, name, labels = ()):
+        """Mede a duração de um bloco em um histograma
+
+        Args:
+            name (str): nome da métrica
+            labels (tuple): pares (nome, valor) dos rótulos
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def crypto(self, op, elapsed):
+        """Registra uma operação de cifra ou decifra
+
+        Args:
+            op (str): 'encrypt' ou 'decrypt'
+            elapsed (float): duração da operação, em segundos
+
+        """
+        labels = (('op', op),)
+        with self.lock:
+            for name, amount in (('tcpy_crypto_seconds_total', elapsed),
+                                 ('tcpy_crypto_operations_total', 1)):
+                key = (name, labels)
+                self.counters[key] = self.counters.get(key, 0) + amount
+
+    def transfer(self, direction, size, elapsed):
+        """Registra uma transferência de arquivo concluída
+
+        Args:
+            direction (str): 'in' para uploads, 'out' para downloads
+            size (int): bytes transferidos
+            elapsed (float): duração da transferência, em segundos
+
+        """
+        labels = LABELS_IN if direction == 'in' else LABELS_OUT
+        self.add('tcpy_transfer_bytes_total', size, labels)
+        self.add('tcpy_transfer_seconds_total', elapsed, labels)
+        if elapsed > 0:
+            self.observe('tcpy_transfer_rate_mbps', size / elapsed / 1e6,
+                         labels, RATE_BUCKETS)
+
+    def render(self):
+        """Texto das métricas no formato de exposição do Prometheus
+
+        Returns:
+            (str) texto com uma amostra por linha, precedidas do tipo e da
+                descrição de cada métrica
+
+        """
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, histogram.bounds, list(histogram.counts),
+                           histogram.sum)
+                          for key, histogram in self.histograms.items()]
+            gauges = list(self.gauges.items())
+        families = collections.OrderedDict((name, []) for name in
+                                           METRICS_HELP)
+        for (name, labels), value in counters:
+            families.setdefault(name, []).append(
+                    name + format_labels(labels) + ' ' + format_value(value))
+        for (name, labels), function in gauges:
+            families.setdefault(name, []).append(
+                    name + format_labels(labels) + ' ' +
+                    format_value(function()))
+        for (name, labels), bounds, counts, total in histograms:
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(bounds + (math.inf,), counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                        name, format_labels(labels + (
+                                ('le', format_value(bound)),)), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels),
+                                                 format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(
+                    name, format_labels(labels), cumulative))
+        text = []
+        for name, lines in families.items():
+            if not lines:
+                continue
+            kind, description = METRICS_HELP.get(name, ('untyped', name))
+            text.append('# HELP {0} {1}'.format(name, description))
+            text.append('# TYPE {0} {1}'.format(name, kind))
+            text.extend(lines)
+        return '\n'.join(text) + '\n'
+
+    def summary(self):
+        """Resumo legível das métricas (ver ``summary``)
+
+        Returns:
+            (list) linhas do resumo
+
+        """
+        return summary(parse(self.render()))
+
+    def __repr__(self):
+        return "Metrics({0} contadores, {1} histogramas)".format(
+                len(self.counters), len(self.histograms))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Responde às leituras de ``/metrics`` de um ``MetricsServer``
+
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; ' +
+                         'charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Servidor HTTP das métricas, executado em uma thread própria
+
+    Attributes:
+        metrics (Metrics): métricas expostas
+        port (int): porta em que o servidor escuta
+
+    """
+    daemon_threads = True
+
+    def __init__(self, metrics, port = 0, host = '127.0.0.1'):
+        """Método construtor do servidor de métricas
+
+        Args:
+            metrics (Metrics): métricas expostas
+            port (int): porta local, ou 0 para uma porta livre
+            host (str): endereço em que o servidor escuta; por padrão apenas
+                conexões locais
+
+        """
+        http.server.ThreadingHTTPServer.__init__(self, (host, port),
+                                                 MetricsHandler)
+        self.metrics = metrics
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target = self.serve_forever,
+                                       daemon = True)
+        self.thread.start()
+
+    def close(self):
+        """Finaliza o servidor e aguarda a sua thread
+
+        """
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __repr__(self):
+        return "MetricsServer(porta {0})".format(self.port)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo dos perfis de execução do servidor
+
+Um ``Profiler`` por servidor é ligado pelo comando 'perfil' do menu durante
+alguns segundos e, ao final, grava um relatório em um arquivo de texto. Os
+``ClientHandler`` passam por ele a troca de chaves e cada comando, em
+qualquer thread que os execute, mas apenas enquanto ``active`` for True:
+desligado, o custo é a leitura desse atributo.
+
+Há três modos:
+
+    * 'cprofile': cada troca de chaves e comando é medido pelo ``cProfile``
+      e os resultados de todas as threads são somados. O relatório traz as
+      funções de maior tempo acumulado, e os dados brutos seguem em um
+      arquivo ``.prof``, que o ``pstats`` e outras ferramentas leem.
+    * 'amostras': uma thread lê a pilha das threads que estão atendendo um
+      cliente a cada ``interval`` segundos; o relatório traz as funções em
+      que as amostras caíram. Custa bem menos que o ``cProfile``.
+    * 'lentos': apenas o registro dos comandos lentos.
+
+Em todos os modos, os comandos que demoram ``slow`` segundos ou mais são
+registrados com o usuário e o tempo gasto em cada etapa: RSA, AES, rede
+(envio e espera pelo socket) e o restante (disco e processamento).
+
+Example:
+    >> profiler = Profiler()
+    >> profiler.start('amostras', 30, 'perfil.txt', slow = 0.5)
+    >> # ... 30 segundos depois o relatório é gravado em perfil.txt
+
+"""
+
+import cProfile
+import collections
+import datetime
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+# Modos de perfil aceitos por ``Profiler.start``
+MODES = ('cprofile', 'amostras', 'lentos')
+
+# Etapas dos comandos lentos, na ordem do relatório
+STAGES = ('rsa', 'aes', 'rede')
+
+# Intervalo padrão entre amostras, em segundos
+SAMPLE_INTERVAL = 0.005
+
+# Comandos lentos guardados por perfil; os mais antigos são descartados
+TRACE_LIMIT = 1000
+
+# Linhas de funções exibidas em cada tabela do relatório
+REPORT_LINES = 40
+
+
+def function_name(code):
+    """Nome de uma função para o relatório das amostras
+
+    Args:
+        code (tuple): arquivo, linha e nome da função
+
+    Returns:
+        (str) 'nome (arquivo:linha)'
+
+    """
+    filename, line, name = code
+    return "{0} ({1}:{2})".format(name, os.path.basename(filename), line)
+
+
+class Trace(object):
+    """Medição de um comando em andamento
+
+    Attributes:
+        name (str): nome do comando
+        usr (str): usuário da sessão
+        stages (dict): segundos gastos em cada etapa
+
+    """
+    __slots__ = ('name', 'usr', 'stages')
+
+    def __init__(self, name, usr):
+        self.name = name
+        self.usr = usr
+        self.stages = dict.fromkeys(STAGES, 0.0)
+
+
+class ProfileRun(object):
+    """Um perfil ligado: modo, duração e resultados acumulados
+
+    Attributes:
+        mode (str): modo do perfil (ver ``MODES``)
+        filename (str): arquivo do relatório
+        slow (float): duração mínima dos comandos registrados, em segundos,
+            ou None para não registrá-los
+        started (float): instante de início, em ``time.time``
+        stats (pstats.Stats): resultados do ``cProfile`` somados
+        samples (int): quantidade de pilhas lidas no modo 'amostras'
+        own (collections.Counter): amostras em que cada função estava no
+            topo da pilha
+        inclusive (collections.Counter): amostras em que cada função estava
+            em qualquer ponto da pilha
+        calls (int): trocas de chaves e comandos medidos
+        traces (collections.deque): comandos lentos
+
+    """
+    def __init__(self, mode, filename, slow):
+        self.mode = mode
+        self.filename = filename
+        self.slow = slow
+        self.started = time.time()
+        self.stats = None
+        self.samples = 0
+        self.own = collections.Counter()
+        self.inclusive = collections.Counter()
+        self.calls = 0
+        self.traces = collections.deque(maxlen = TRACE_LIMIT)
+
+
+class Profiler(object):
+    """Perfis de execução das sessões de um servidor
+
+    Attributes:
+        active (bool): True enquanto um perfil estiver ligado
+        run (ProfileRun): perfil ligado, ou None
+
+    """
+    def __init__(self, interval = SAMPLE_INTERVAL):
+        """Método construtor do perfilador
+
+        Args:
+            interval (float): segundos entre as amostras do modo 'amostras'
+
+        """
+        self.interval = interval
+        self.active = False
+        self.run = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Threads atendendo um cliente no momento, lidas pela amostragem
+        self.threads = set()
+        self.timer = None
+        self.sampler = None
+
+    def start(self, mode = 'cprofile', duration = 30, filename = 'perfil.txt',
+              slow = None):
+        """Liga um perfil por alguns segundos
+
+        Args:
+            mode (str): 'cprofile', 'amostras' ou 'lentos'
+            duration (float): segundos até o perfil ser desligado e gravado,
+                ou 0 para esperar por ``stop``
+            filename (str): arquivo de texto do relatório
+            slow (float): duração mínima, em segundos, dos comandos lentos
+                registrados, ou None para não registrá-los
+
+        Raises:
+            ValueError: se o modo for desconhecido, se um perfil já estiver
+                ligado ou se o modo 'lentos' vier sem ``slow``
+
+        """
+        if mode not in MODES:
+            raise ValueError("Modo desconhecido: " + str(mode))
+        if mode == 'lentos' and slow is None:
+            raise ValueError("O modo 'lentos' requer a duração mínima")
+        with self.lock:
+            if self.run is not None:
+                raise ValueError("Já existe um perfil em andamento")
+            self.run = ProfileRun(mode, str(filename), slow)
+            if mode == 'amostras':
+                self.sampler = threading.Thread(target = self.sample_loop,
+                                                args = (self.run,),
+                                                daemon = True)
+                self.sampler.start()
+            if duration:
+                self.timer = threading.Timer(duration, self.stop)
+                self.timer.daemon = True
+                self.timer.start()
+            self.active = True
+
+    def stop(self):
+        """Desliga o perfil e grava o relatório
+
+        Medições ainda em andamento são descartadas.
+
+        Returns:
+            (str) arquivo do relatório, ou None se não houver perfil ligado
+
+        """
+        with self.lock:
+            run, self.run = self.run, None
+            self.active = False
+            timer, self.timer = self.timer, None
+            sampler, self.sampler = self.sampler, None
+        if run is None:
+            return None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+        if sampler is not None:
+            sampler.join()
+        self.write(run)
+        print("Perfil gravado em " + run.filename)
+        return run.filename
+
+    def call(self, handler, name, function, *args):
+        """Executa a troca de chaves ou um comando de uma sessão, medindo-o
+
+        Chamado pelo ``ClientHandler`` apenas com o perfil ligado.
+
+        Args:
+            handler (ClientHandler): sessão que executa a função
+            name (str): nome do comando
+            function (function): função a executar
+            *args: argumentos da função
+
+        Returns:
+            (object) resultado da função
+
+        """
+        run = self.run
+        if run is None:
+            return function(*args)
+        trace = self.local.trace = Trace(name, handler.usr)
+        ident = threading.get_ident()
+        profile = None
+        if run.mode == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Outra ferramenta de perfil já ocupa esta thread
+                profile = None
+        elif run.mode == 'amostras':
+            self.threads.add(ident)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            self.threads.discard(ident)
+            self.local.trace = None
+            with self.lock:
+                run.calls += 1
+                if profile is not None:
+                    if run.stats is None:
+                        run.stats = pstats.Stats(profile)
+                    else:
+                        run.stats.add(profile)
+            if run.slow is not None and elapsed >= run.slow:
+                self.record(run, trace, elapsed)
+
+    def stage(self, name, elapsed):
+        """Soma o tempo de uma etapa ao comando em andamento nesta thread
+
+        Args:
+            name (str): etapa (ver ``STAGES``)
+            elapsed (float): segundos gastos
+
+        """
+        trace = getattr(self.local, 'trace', None)
+        if trace is not None:
+            trace.stages[name] += elapsed
+
+    def record(self, run, trace, elapsed):
+        """Registra um comando lento
+
+        Args:
+            run (ProfileRun): perfil em que o comando foi medido
+            trace (Trace): medição do comando
+            elapsed (float): duração total, em segundos
+
+        """
+        stages = dict(trace.stages)
+        stages['outros'] = max(0.0, elapsed - sum(trace.stages.values()))
+        entry = {'quando': datetime.datetime.now().isoformat(
+                         timespec = 'seconds'),
+                 'usr': trace.usr, 'comando': trace.name, 'total': elapsed,
+                 'etapas': stages}
+        with self.lock:
+            run.traces.append(entry)
+        print("Comando lento: {0} de {1} em {2:.1f} ms".format(
+                trace.name, trace.usr, elapsed * 1000))
+
+    def sample_loop(self, run):
+        """Laço da thread de amostragem
+
+        Args:
+            run (ProfileRun): perfil que recebe as amostras
+
+        """
+        while self.run is run:
+            frames = sys._current_frames()
+            for ident in list(self.threads):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno,
+                                  code.co_name))
+                    frame = frame.f_back
+                run.samples += 1
+                run.own[stack[0]] += 1
+                run.inclusive.update(set(stack))
+            del frames
+            time.sleep(self.interval)
+
+    def write(self, run):
+        """Grava o relatório de um perfil
+
+        No modo 'cprofile', os dados brutos seguem também em um arquivo com a
+        extensão ``.prof``.
+
+        Args:
+            run (ProfileRun): perfil desligado
+
+        """
+        lines = ["Perfil '{0}' de {1} a {2}".format(
+                         run.mode,
+                         datetime.datetime.fromtimestamp(run.started)
+                         .isoformat(timespec = 'seconds'),
+                         datetime.datetime.now().isoformat(
+                                 timespec = 'seconds')),
+                 "Trocas de chaves e comandos medidos: {0}".format(run.calls)]
+        if run.mode == 'cprofile':
+            lines.append('')
+            if run.stats is None:
+                lines.append("Nenhuma chamada medida.")
+            else:
+                run.stats.dump_stats(os.path.splitext(run.filename)[0] +
+                                     '.prof')
+                out = io.StringIO()
+                run.stats.stream = out
+                run.stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+                lines.append(out.getvalue().strip('\n'))
+        elif run.mode == 'amostras':
+            lines.append("Amostras: {0}".format(run.samples))
+            for title, counter in (("no topo da pilha", run.own),
+                                   ("em qualquer ponto da pilha",
+                                    run.inclusive)):
+                lines.extend(['', "Funções " + title + ":"])
+                for code, count in counter.most_common(REPORT_LINES):
+                    lines.append("{0:6.1f}% {1:8d}  {2}".format(
+                            count * 100 / run.samples, count,
+                            function_name(code)))
+        if run.slow is not None:
+            lines.extend(['', "Comandos com {0:.0f} ms ou mais: {1}".format(
+                    run.slow * 1000, len(run.traces))])
+            lines.append("{0:<19} {1:<16} {2:<10} {3:>10}".format(
+                    'quando', 'usuário', 'comando', 'total ms') + ''.join(
+                    "{0:>10}".format(stage + ' ms')
+                    for stage in STAGES + ('outros',)))
+            for entry in run.traces:
+                lines.append("{0:<19} {1:<16} {2:<10} {3:>10.1f}".format(
+                        entry['quando'], entry['usr'], entry['comando'],
+                        entry['total'] * 1000) + ''.join(
+                        "{0:>10.1f}".format(entry['etapas'][stage] * 1000)
+                        for stage in STAGES + ('outros',)))
+        with open(run.filename, 'w', encoding = 'utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+
+    def status(self):
+        """Descrição do perfil em andamento, exibida pelo menu
+
+        Returns:
+            (str) modo, tempo decorrido e arquivo do perfil ligado
+
+        """
+        run = self.run
+        if run is None:
+            return "Nenhum perfil em andamento."
+        return "Perfil '{0}' há {1:.0f} s, gravado em {2}".format(
+                run.mode, time.time() - run.started, run.filename)
+
+    def __repr__(self):
+        return "Profiler({0})".format(self.run.mode if self.run else
+                                      'desligado')
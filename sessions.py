@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Módulo do registro de sessões do servidor
+
+O registro guarda as sessões abertas, uma por usuário, e os avisos ainda não
+entregues a cada uma (como o de um arquivo compartilhado). Os usuários são
+divididos em partes pelo hash do nome, cada uma com a sua trava, de modo que
+logins e logouts de usuários diferentes raramente disputam a mesma trava e
+todas as consultas continuam O(1). Cada operação (login, logout, aviso) é
+atômica em relação às demais sobre o mesmo usuário.
+
+No MultiHost, um dicionário do ``multiprocessing.Manager`` mantém a presença
+dos usuários entre os processos; os avisos só chegam a usuários conectados
+ao mesmo processo. A presença de um processo que termina, mesmo por uma
+falha, é liberada com ``release``.
+
+Example:
+    >> sessions = SessionRegistry()
+    >> if sessions.login('ana', handler):
+    >>     sessions.notify('ana', 'bia compartilhou foto.png com você')
+    >> sessions.logout('ana', handler)
+
+"""
+
+import collections
+import os
+import threading
+
+# Quantidade padrão de partes do registro
+SHARDS = 16
+
+# Avisos guardados por usuário; os mais antigos são descartados além disso
+NOTICE_LIMIT = 100
+
+
+class Shard(object):
+    """Parte do registro: sessões e avisos de um grupo de usuários
+
+    Attributes:
+        lock (threading.Lock): trava das operações sobre esta parte
+        sessions (dict): sessão de cada usuário conectado
+        notices (dict): avisos pendentes de cada usuário conectado
+
+    """
+    __slots__ = ('lock', 'sessions', 'notices')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = dict()
+        self.notices = dict()
+
+
+class SessionRegistry(object):
+    """Registro das sessões abertas, dividido em partes por usuário
+
+    Também conta as conexões atendidas, autenticadas ou não.
+
+    Attributes:
+        shared (dict): presença dos usuários compartilhada entre processos,
+            ou None
+        connections (int): conexões abertas no momento
+
+    """
+    def __init__(self, shards = SHARDS, shared = None, limit = NOTICE_LIMIT):
+        """Método construtor do registro
+
+        Args:
+            shards (int): quantidade de partes
+            shared (dict): dicionário do ``multiprocessing.Manager`` com os
+                usuários conectados em todos os processos, ou None para um
+                único processo
+            limit (int): avisos guardados por usuário, ou None para não
+                descartar nenhum
+
+        """
+        self.shards = [Shard() for i in range(max(1, int(shards)))]
+        self.shared = shared
+        self.limit = limit
+        self.connections = 0
+        self.counter_lock = threading.Lock()
+
+    def shard(self, usr):
+        """Parte do registro responsável por um usuário
+
+        Args:
+            usr (str): nome de usuário
+
+        Returns:
+            (Shard) parte do usuário
+
+        """
+        return self.shards[hash(usr) % len(self.shards)]
+
+    def connect(self):
+        """Conta uma nova conexão
+
+        """
+        with self.counter_lock:
+            self.connections += 1
+
+    def disconnect(self):
+        """Desconta uma conexão encerrada
+
+        """
+        with self.counter_lock:
+            self.connections -= 1
+
+    def login(self, usr, session):
+        """Registra a sessão de um usuário, se ele não tiver outra aberta
+
+        Args:
+            usr (str): nome de usuário
+            session (object): sessão do usuário, em geral o ``ClientHandler``
+
+        Returns:
+            (bool) False se o usuário já tiver uma sessão aberta, neste ou em
+                outro processo
+
+        """
+        shard = self.shard(usr)
+        with shard.lock:
+            if usr in shard.sessions:
+                return False
+            if self.shared is not None:
+                owner = (os.getpid(), id(session))
+                if self.shared.setdefault(usr, owner) != owner:
+                    return False
+            shard.sessions[usr] = session
+            return True
+
+    def logout(self, usr, session):
+        """Remove a sessão de um usuário
+
+        Args:
+            usr (str): nome de usuário
+            session (object): sessão registrada por ``login``
+
+        Returns:
+            (list) avisos que não chegaram a ser entregues, ou None se
+                ``session`` não for a sessão registrada do usuário
+
+        """
+        shard = self.shard(usr)
+        with shard.lock:
+            if shard.sessions.get(usr) is not session:
+                return None
+            del shard.sessions[usr]
+            if self.shared is not None:
+                self.shared.pop(usr, None)
+            return list(shard.notices.pop(usr, ()))
+
+    def release(self, pid):
+        """Remove da presença compartilhada os usuários de um processo
+
+        Chamado quando um processo do MultiHost termina, inclusive por uma
+        falha, para que os usuários conectados a ele possam entrar de novo.
+
+        Args:
+            pid (int): identificador do processo encerrado
+
+        Returns:
+            (list) usuários liberados
+
+        """
+        if self.shared is None:
+            return []
+        released = []
+        for usr, owner in list(self.shared.items()):
+            if owner[0] == pid:
+                self.shared.pop(usr, None)
+                released.append(usr)
+        return released
+
+    def online(self, usr):
+        """Verifica se um usuário tem uma sessão aberta
+
+        Args:
+            usr (str): nome de usuário
+
+        Returns:
+            (bool) True se o usuário estiver conectado, em qualquer processo
+
+        """
+        if usr in self.shard(usr).sessions:
+            return True
+        return self.shared is not None and usr in self.shared
+
+    def session(self, usr):
+        """Sessão aberta de um usuário neste processo
+
+        Args:
+            usr (str): nome de usuário
+
+        Returns:
+            (object) sessão do usuário, ou None
+
+        """
+        return self.shard(usr).sessions.get(usr)
+
+    def users(self):
+        """Usuários conectados
+
+        Returns:
+            (list) nomes dos usuários com sessão aberta, em todos os processos
+
+        """
+        if self.shared is not None:
+            return list(self.shared.keys())
+        users = []
+        for shard in self.shards:
+            with shard.lock:
+                users.extend(shard.sessions)
+        return users
+
+    def count(self):
+        """Quantidade de sessões abertas neste processo
+
+        Returns:
+            (int) usuários conectados a este processo
+
+        """
+        return sum(len(shard.sessions) for shard in self.shards)
+
+    def notify(self, usr, message):
+        """Deixa um aviso para um usuário conectado
+
+        Args:
+            usr (str): destinatário
+            message (str): texto do aviso
+
+        Returns:
+            (bool) False se o usuário não estiver conectado a este processo
+
+        """
+        shard = self.shard(usr)
+        with shard.lock:
+            if usr not in shard.sessions:
+                return False
+            if usr not in shard.notices:
+                shard.notices[usr] = collections.deque(maxlen = self.limit)
+            shard.notices[usr].append(message)
+            return True
+
+    def pending(self, usr):
+        """Verifica, sem travar, se há avisos para um usuário
+
+        Args:
+            usr (str): nome de usuário
+
+        Returns:
+            (bool) True se houver avisos pendentes
+
+        """
+        return bool(self.shard(usr).notices.get(usr))
+
+    def notices(self, usr, session):
+        """Retira os avisos pendentes de um usuário
+
+        Args:
+            usr (str): nome de usuário
+            session (object): sessão registrada do usuário
+
+        Returns:
+            (list) avisos, do mais antigo ao mais recente; vazia se não houver
+                avisos ou se ``session`` não for a sessão do usuário
+
+        """
+        shard = self.shard(usr)
+        with shard.lock:
+            if shard.sessions.get(usr) is not session:
+                return []
+            return list(shard.notices.pop(usr, ()))
+
+    def __len__(self):
+        return len(self.users())
+
+    def __repr__(self):
+        return "SessionRegistry({0} partes, {1} conexões)".format(
+                len(self.shards), self.connections)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Testes da codificação das mensagens e dos arquivos do servidor
+
+Conferem as mensagens cifradas e os arquivos de usuários e de configurações
+nos dois formatos, Base85 e binário, e executam em tamanho reduzido os
+benchmarks de codificação do ``benchmark``, que comparam os dois.
+
+Example:
+    $ python3 -m pytest test_encoding.py
+
+"""
+
+import benchmark
+from console import RSA_BLOCK
+from host import Host
+from journal import USERS_MAGIC, decode_users, encode_user, read_users
+from journal import write_users
+import os
+import socket
+import tempfile
+
+import pytest
+
+
+@pytest.mark.parametrize('binary', [False, True], ids = ['a85', 'binario'])
+@pytest.mark.parametrize('session', [True, False], ids = ['sessao', 'rsa'])
+@pytest.mark.parametrize('size', [0, 1, RSA_BLOCK, RSA_BLOCK + 1, 4096])
+def test_message_round_trip(session, binary, size):
+    server, client = benchmark.console_pair()
+    if session:
+        server.session_key = client.session_key = os.urandom(32)
+    server.binary_wire = client.binary_wire = binary
+    msg = os.urandom(size)
+    try:
+        assert server.decrypt(client.encrypt(msg)) == msg
+    finally:
+        server.sock.close()
+        client.sock.close()
+
+
+@pytest.mark.parametrize('session', [True, False], ids = ['sessao', 'rsa'])
+def test_encoding_benchmark(session):
+    result = benchmark.bench_encoding(n = 50, session = session, size = 4096)
+    print(result)
+    assert result['binary_bytes'] < result['a85_bytes']
+    if session:
+        # No modo de sessão o Base85 domina o custo de cada mensagem
+        assert result['binary_encode_us'] < result['a85_encode_us']
+        assert result['binary_decode_us'] < result['a85_decode_us']
+
+
+@pytest.mark.parametrize('binary', [False, True], ids = ['a85', 'binario'])
+def test_users_file_round_trip(binary):
+    filename = os.path.join(tempfile.mkdtemp(), 'usr.txt')
+    users = [('ana', 'senha'), ('bia', 'com @ e espaço'), ('çé', '')]
+    write_users(filename, users, binary)
+    with open(filename, 'rb') as file:
+        assert file.read().startswith(USERS_MAGIC) == binary
+    loaded = dict()
+    assert read_users(filename, loaded) == len(users)
+    assert loaded == dict(users)
+
+
+def test_users_journal_ignores_torn_record():
+    data = USERS_MAGIC + encode_user('ana', 'senha') + \
+        encode_user('bia', 'senha')[:-2]
+    users, end = decode_users(data)
+    assert users == [('ana', 'senha')]
+    assert end == len(USERS_MAGIC) + len(encode_user('ana', 'senha'))
+
+
+def test_users_file_benchmark():
+    result = benchmark.bench_users_file(users = 20000)
+    print(result)
+    assert result['binary_bytes'] < result['a85_bytes']
+    assert result['binary_read_s'] < result['a85_read_s']
+
+
+@pytest.mark.parametrize('binary', [False, True], ids = ['a85', 'binario'])
+def test_settings_round_trip(binary):
+    server = benchmark.start_host(Host, binary = binary, pipeline = False)
+    filename = os.path.join(server.tmp, 'host.txt')
+    try:
+        server.export_settings(filename)
+        loaded = Host.load_host(filename)
+        try:
+            assert loaded.root == server.root
+            assert loaded.binary == binary
+            assert loaded.pipeline is False
+        finally:
+            loaded.sock.close()
+    finally:
+        benchmark.stop_host(server)
+
+
+@pytest.mark.parametrize('binary', [False, True], ids = ['a85', 'binario'])
+def test_settings_skip_runtime_options(binary):
+    tmp = tempfile.mkdtemp()
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    server = Host(port = 0, root = os.path.join(tmp, 'root'),
+                  key_file = os.path.join(tmp, 'host.key'),
+                  file_usr = os.path.join(tmp, 'usr.txt'), binary = binary,
+                  listener = listener, metrics_port = None,
+                  maintenance = False, max_sessions = 8)
+    filename = os.path.join(tmp, 'host.txt')
+    try:
+        server.export_settings(filename)
+        loaded = Host.load_host(filename)
+        try:
+            assert loaded.metrics_port is None
+            assert loaded.sock is not listener
+            assert loaded.root == server.root
+            assert loaded.max_sessions == 8
+        finally:
+            loaded.sock.close()
+    finally:
+        listener.close()
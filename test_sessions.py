@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Testes do registro de sessões com o servidor em execução
+
+Os clientes simulados do ``benchmark`` entram, compartilham arquivos e saem
+ao mesmo tempo, e o registro de sessões do servidor é conferido ao final.
+
+Example:
+    $ python3 -m pytest test_sessions.py
+
+"""
+
+import benchmark
+import host
+from host import Host, AsyncHost, MultiHost
+import concurrent.futures
+import os
+import signal
+import tempfile
+import time
+import uuid
+
+import pytest
+
+
+def unique_names(count):
+    """Nomes de usuário ainda não cadastrados
+
+    Os usuários cadastrados continuam em ``host.USR_DICT`` entre um servidor
+    e outro do mesmo processo.
+
+    Args:
+        count (int): quantidade de nomes
+
+    Returns:
+        (list) nomes de usuário
+    """
+    prefix = uuid.uuid4().hex[:8]
+    return ['{0}u{1}'.format(prefix, i) for i in range(count)]
+
+
+def wait_until(condition, timeout = 10):
+    """Aguarda uma condição se tornar verdadeira
+
+    Returns:
+        (bool) valor final da condição
+    """
+    limit = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < limit:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture(params = [Host, AsyncHost], ids = ['Host', 'AsyncHost'])
+def server(request):
+    server = benchmark.start_host(request.param, pipeline = True)
+    yield server
+    benchmark.stop_host(server)
+
+
+def test_concurrent_login_share_logout(server):
+    users = unique_names(8)
+    directory = tempfile.mkdtemp()
+    for usr in users:
+        client = benchmark.open_session(server.port, usr, quiet = True)
+        filename = os.path.join(directory, usr + '.txt')
+        with open(filename, 'w') as file:
+            file.write(usr)
+        benchmark.post_file(client, filename)
+        benchmark.close_session(client)
+    assert wait_until(lambda: host.SESSIONS.count() == 0)
+
+    def login(usr):
+        return benchmark.login_session(server.port, usr, quiet = True)
+
+    def share(i):
+        client = sessions[users[i]]
+        client.send('share {0}.txt {1}'.format(
+                users[i], users[(i + rounds) % len(users)]))
+        return client.receive()
+
+    # A cada rodada, dois clientes disputam cada usuário; só um deve entrar
+    with concurrent.futures.ThreadPoolExecutor(16) as executor:
+        for rounds in range(1, 4):
+            clients = list(executor.map(login, users * 2))
+            sessions = {client.usr: client for client in clients}
+            assert sorted(sessions) == sorted(users + ['guest'])
+            assert sum(client.usr == 'guest' for client in clients) == \
+                len(users)
+            replies = list(executor.map(share, range(len(users))))
+            assert all('compartilhado' in reply for reply in replies)
+            list(executor.map(benchmark.close_session, clients))
+            assert wait_until(lambda: host.SESSIONS.count() == 0 and
+                              host.SESSIONS.connections == 0)
+
+    # Cada usuário vê o próprio arquivo e os compartilhados com ele
+    for i, usr in enumerate(users):
+        client = login(usr)
+        assert client.usr == usr
+        client.send('show')
+        listing = client.receive()
+        for shift in range(4):
+            assert users[i - shift] + '.txt' in listing
+        benchmark.close_session(client)
+
+
+def test_logout_frees_user(server):
+    usr, = unique_names(1)
+    first = benchmark.open_session(server.port, usr, quiet = True)
+    refused = benchmark.login_session(server.port, usr, quiet = True)
+    assert refused.usr == 'guest'
+    benchmark.close_session(refused)
+    benchmark.close_session(first)
+    assert wait_until(lambda: not host.SESSIONS.online(usr))
+    again = benchmark.login_session(server.port, usr, quiet = True)
+    assert again.usr == usr
+    benchmark.close_session(again)
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGKILL'),
+                    reason = "requer o envio de SIGKILL")
+def test_multihost_releases_crashed_process():
+    server = benchmark.start_host(MultiHost, processes = 2)
+    try:
+        usr, = unique_names(1)
+        client = benchmark.open_session(server.port, usr, quiet = True)
+        assert wait_until(lambda: usr in host.SESSIONS.shared)
+        pid = host.SESSIONS.shared[usr][0]
+        os.kill(pid, signal.SIGKILL)
+        client.sock.close()
+        assert wait_until(lambda: usr not in host.SESSIONS.shared)
+        again = benchmark.login_session(server.port, usr, quiet = True)
+        assert again.usr == usr
+        benchmark.close_session(again)
+    finally:
+        benchmark.stop_host(server)